@@ -10,7 +10,13 @@ from ModbusDeviceNode import ModbusDeviceNode
 class ModbusControllerNode(udi_interface.Node):
     id = 'modbuscontroll'
     """This is a list of properties that were defined in the nodedef"""
-    drivers = [{'driver': 'ST', 'value': 0, 'uom': 2, 'name': 'Status'}]
+    drivers = [{'driver': 'ST', 'value': 0, 'uom': 2, 'name': 'Status'}, {
+        'driver': 'GV0', 'value': 0, 'uom': 42, 'name': 'Last Poll Time'},
+        {'driver': 'GV1', 'value': 0, 'uom': 42, 'name': 'Request Time p99'
+        }, {'driver': 'GV2', 'value': 0, 'uom': 56, 'name': 'Errors'}, {
+        'driver': 'GV3', 'value': 0, 'uom': 56, 'name': 'Timeouts'}, {
+        'driver': 'GV4', 'value': 0, 'uom': 56, 'name': 'Reconnects'}, {
+        'driver': 'GV5', 'value': 0, 'uom': 56, 'name': 'Stale Values'}]
     children = [{'node_class': 'ModbusDeviceNode', 'id': 'modbus', 'name':
         'ModbusDevice', 'parent': 'modbuscontroll'}]
 
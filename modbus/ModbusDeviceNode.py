@@ -11,7 +11,8 @@ class ModbusDeviceNode(udi_interface.Node):
         'name': 'Load Shave Amps'}, {'driver': 'GV4', 'value': 0, 'uom': 72,
         'name': 'Batt DC Voltage'}, {'driver': 'GV5', 'value': 0, 'uom': 25,
         'name': 'Force Charge'}, {'driver': 'GV6', 'value': 0, 'uom': 25,
-        'name': 'AC1 Qualification'}]
+        'name': 'AC1 Qualification'}, {'driver': 'ERR', 'value': 0, 'uom':
+        56, 'name': 'Stale Values'}]
 
     def __init__(self, polyglot, protocolHandler, controller=
         'modbuscontroll', address='modbus', name='ModbusDevice'):
@@ -1,10 +1,17 @@
 
-import udi_interface, os, sys, json, time
+import udi_interface, os, sys, json, time, threading
 import socket, ipaddress
 LOGGER = udi_interface.LOGGER
 Custom = udi_interface.Custom
-import shutil
+import shutil, filecmp
+from ioxplugin import Plugin
 from iox_to_modbus import ModbusIoX
+from modbus_node import ModbusGenericNode
+from modbus_scheduler import ModbusPollScheduler
+from modbus_report import ModbusReportFilter
+from modbus_discovery import ModbusDiscovery, ModbusDiscoveryConfig, MODBUS_DISCOVERY_MAP_FILE
+from modbus_metrics import MODBUS_METRICS_FILE, MODBUS_STALE_DRIVER, addMetricsProperties
+from modbus_server import ModbusServerTable, ModbusRegisterServer, MODBUS_SERVER_DEFAULT_HOST, MODBUS_SERVER_DEFAULT_PORT
 from udi_interface import LOG_HANDLER
 
 class ModbusProtocolHandler:
@@ -19,18 +26,69 @@ class ModbusProtocolHandler:
 
     def __init__(self, plugin):
         self.plugin = plugin
+        self.controller = None
         self.host = None
         self.port = 502
         self.isValidConfig = False
+        self.started = False
         self.modbus = ModbusIoX(plugin)
         self.nodes = {}
+        #only changes beyond the deadbands are reported to IoX. Nodes in forceReport report everything
+        self.reportFilter = ModbusReportFilter(self.modbus.max_silence_ms)
+        self.forceReport = set()
+        #nodes whose queries are answered from the last known good values without reading the devices
+        self.fromCache = set()
+        #nodes whose registers were just read in blocks. Their queries are served from the values read
+        self.fromReads = set()
+        self.discovery:ModbusDiscovery = None
+        #serves the drivers of the nodes as modbus registers if the protocol has a server section
+        self.server:ModbusRegisterServer = None
+        self.lastMetricsDump = time.monotonic()
+        #registers with their own poll interval are read by the scheduler rather than shortPoll
+        self.scheduler = ModbusPollScheduler(self.pollRegisters)
+        self.scheduleRegisters()
+        #nodedef id -> {property id: precision}
         self.precisions = {}
-        if plugin:
+        self.loadPrecisions()
+
+    def scheduleRegisters(self):
+        for node_id, mnode in self.modbus.nodes.items():
+            for register in mnode.getScheduledRegisters():
+                self.scheduler.add(node_id, register)
+
+    def loadPrecisions(self):
+        self.precisions = {}
+        if self.plugin:
             try:
-                self.precisions = (next(iter(plugin.nodedefs.getNodeDefs().values()))).getPrecisions()
+                for nodedef_id, nodedef in self.plugin.nodedefs.getNodeDefs().items():
+                    self.precisions[nodedef_id] = nodedef.getPrecisions()
             except Exception as ex:
                 pass
 
+    def getPrecision(self, address:str, property_id:str)->int:
+        nodedef_id = self.getNodeDefId(address)
+        if not nodedef_id in self.precisions or not property_id in self.precisions[nodedef_id]:
+            return 0
+        return self.precisions[nodedef_id][property_id]
+
+    ###
+    # The node definition, drivers, and settable properties of the node at address, see ModbusGenericNode
+    ###
+    def getNodeDefId(self, address:str)->str:
+        if not address in self.modbus.nodes:
+            return None
+        return self.modbus.nodes[address].nodedef_id
+
+    def getDrivers(self, address:str):
+        if not address in self.modbus.nodes:
+            return []
+        return [dict(driver) for driver in self.modbus.nodes[address].drivers]
+
+    def getSettable(self, address:str):
+        if not address in self.modbus.nodes:
+            return []
+        return list(self.modbus.nodes[address].settable)
+
     @staticmethod
     def isValidHost(host:str)->bool:
         try:
@@ -62,6 +120,26 @@ class ModbusProtocolHandler:
     def setController(self, controller):
         self.controller = controller
 
+    ###
+    # Updates the metrics drivers of the controller and dumps all metrics every metrics interval
+    ###
+    def updateMetrics(self)->bool:
+        try:
+            if self.controller != None:
+                summary = self.modbus.metrics.getSummary()
+                summary['GV5'] = len(self.modbus.cache.stale)
+                for driver, value in summary.items():
+                    self.controller.setDriver(driver, value)
+                    if self.server != None:
+                        self.server.table.update(self.controller.address, driver, value)
+            if self.modbus.metrics_interval > 0 and time.monotonic() - self.lastMetricsDump >= self.modbus.metrics_interval:
+                self.lastMetricsDump = time.monotonic()
+                return self.modbus.metrics.dump(MODBUS_METRICS_FILE)
+            return True
+        except Exception as ex:
+            LOGGER.error(str(ex))
+            return False
+
     ####
     #  You need to implement these methods!
     ####
@@ -72,12 +150,12 @@ class ModbusProtocolHandler:
     ####
     def setProperty(self, node, property_id, value):
         try:
-            precision = self.precisions[propert_id]
-            val = int(value)
+            precision = self.getPrecision(node.address, property_id)
+            val = value
             if precision > 1:
                 mult = pow(10, precision)
-                val = val * mult
-            return self.modbus.setProperty(node.address, property_id, value)
+                val = int(round(float(value) * mult))
+            return self.modbus.setProperty(node.address, property_id, val)
         except Exception as ex:
             LOGGER.error(f'setProperty failed .... ')
             return False
@@ -88,19 +166,59 @@ class ModbusProtocolHandler:
     ####
     def queryProperty(self, node, property_id):
         try:
-            precision = self.precisions[property_id]
-
-            val = self.modbus.queryProperty(node.address, property_id)
-            if val != None and precision > 1:
-                div = pow(10, precision)
-                fval = round(float(val/div), precision)
-                return fval
-
-            return val
+            if property_id == MODBUS_STALE_DRIVER['driver']:
+                return self.reportValue(node, property_id, self.modbus.cache.countStale(node.address))
+            return self.reportValue(node, property_id, self.modbus.queryProperty(node.address, property_id, self.isCached(node)))
         except Exception as ex:
             LOGGER.error(f'queryProperty failed .... ')
             return False
 
+    ####
+    # Queries several properties of a node reading each register at most once.
+    # Returns {property id: value} with None for the values not to report
+    ####
+    def queryProperties(self, node, property_ids)->dict:
+        try:
+            stale = MODBUS_STALE_DRIVER['driver']
+            values = self.modbus.queryProperties(node.address, [property_id for property_id in property_ids if property_id != stale], self.isCached(node))
+            #counted once the values it covers were queried
+            if stale in property_ids:
+                values[stale] = self.modbus.cache.countStale(node.address)
+            return {property_id: self.reportValue(node, property_id, val) for property_id, val in values.items()}
+        except Exception as ex:
+            LOGGER.error(f'queryProperties failed .... ')
+            return {}
+
+    #True if the queries of the node must not read the device
+    def isCached(self, node)->bool:
+        return node.address in self.fromCache or node.address in self.fromReads
+
+    #queries all the properties of the node from the values its block reads just got
+    def queryRead(self, node):
+        self.fromReads.add(node.address)
+        try:
+            node.queryAll()
+        finally:
+            self.fromReads.discard(node.address)
+
+    #applies the precision to the value read and returns None if it should not be reported to IoX
+    def reportValue(self, node, property_id, val):
+        precision = self.getPrecision(node.address, property_id)
+        if val != None and precision > 1:
+            div = pow(10, precision)
+            val = round(float(val/div), precision)
+
+        #the server table gets every value, not only the ones reported
+        if val != None and self.server != None:
+            self.server.table.update(node.address, property_id, val)
+
+        #returning None tells the node there's nothing to update
+        if val != None and not self.reportFilter.shouldReport(node.address, property_id, val,
+                self.modbus.getRegister(node.address, property_id), node.address in self.forceReport):
+            return None
+
+        return val
+
     ####
     # This method is called by IoX to send a command 
     # to the node/device or service
@@ -108,7 +226,16 @@ class ModbusProtocolHandler:
     def processCommand(self, node, command_name, **kwargs):
         try:
             if command_name == 'Query':
-                return node.queryAll()
+                #answer right away with the last known good values, then read the device in the background
+                self.forceReport.add(node.address)
+                self.fromCache.add(node.address)
+                try:
+                    node.queryAll()
+                finally:
+                    self.forceReport.discard(node.address)
+                    self.fromCache.discard(node.address)
+                threading.Thread(target=self.refreshNode, args=[node], name='ModbusQuery', daemon=True).start()
+                return True
             #for key, value in kwargs.items():
             #    print(f"{key}: {value}")
             return False
@@ -123,6 +250,10 @@ class ModbusProtocolHandler:
     ####
     def getNodeAddress(self, nodedef_id):
         try:
+            #the first device of the node definition if it has instances
+            for address, mnode in self.modbus.nodes.items():
+                if mnode.nodedef_id == nodedef_id:
+                    return address
             return nodedef_id
         except Exception as ex:
             LOGGER.error(str(ex))
@@ -139,7 +270,14 @@ class ModbusProtocolHandler:
                 self.setNotices('host','Please provide the host/port in the configuration tab')
                 return False
 
-            return self.modbus.connect(self.host, self.port) 
+            #values saved at the last stop are served until the devices are read
+            self.modbus.cache.load(self.modbus.nodes)
+            if not self.modbus.connect(self.host, self.port):
+                return False
+            self.scheduler.start()
+            self.startServer()
+            self.started = True
+            return True
         except Exception as ex:
             LOGGER.error(f'start failed .... ')
             LOGGER.error(str(ex))
@@ -152,6 +290,13 @@ class ModbusProtocolHandler:
     ####
     def stop(self)->bool:
         try:
+            self.started = False
+            self.stopServer()
+            self.scheduler.stop()
+            self.modbus.disconnect()
+            self.modbus.cache.save(self.modbus.nodes)
+            if self.modbus.metrics_interval > 0:
+                self.modbus.metrics.dump(MODBUS_METRICS_FILE)
             return True
         except Exception as ex:
             LOGGER.error(f'discover failed .... ')
@@ -163,9 +308,38 @@ class ModbusProtocolHandler:
     ####
     def discover(self)->bool:
         try:
+            if self.modbus.serial_bus != None:
+                LOGGER.warning("discovery scans Modbus TCP gateways, not serial lines ...")
+                return False
+            config = ModbusDiscoveryConfig(self.modbus.discovery, self.host, self.port if self.port and self.port > 0 else 502)
+            if self.discovery == None:
+                self.discovery = ModbusDiscovery(self.modbus.createProbeClient, config)
+            self.discovery.config = config
+            #scanning a network takes a while, so it's done in the background
+            threading.Thread(target=self.runDiscovery, name='ModbusDiscoveryScan', daemon=True).start()
             return True
         except Exception as ex:
             LOGGER.error(f'discover failed .... ')
+            LOGGER.error(str(ex))
+            return False
+
+    ###
+    # Scans for units and saves a candidate register map for them
+    ###
+    def runDiscovery(self)->bool:
+        try:
+            results = self.discovery.scan()
+            units = sum([len(gateway['units']) for gateway in results.values()])
+            if units == 0:
+                self.setNotices('discovery', 'Discovery did not find any modbus units')
+                return False
+            if not self.discovery.saveRegisterMap(results):
+                return False
+            self.setNotices('discovery', f'Discovery found {units} modbus units. Their registers are in {os.path.abspath(MODBUS_DISCOVERY_MAP_FILE)}')
+            return True
+        except Exception as ex:
+            LOGGER.error(f'discovery failed .... ')
+            LOGGER.error(str(ex))
             return False
 
 
@@ -181,7 +355,8 @@ class ModbusProtocolHandler:
             if node == None:
                 return False
             self.nodes[node.address] = node
-            node.queryAll()
+            self.modbus.readNode(node.address)
+            self.queryRead(node)
             return True
         except Exception as ex:
             LOGGER.error(str(ex))
@@ -195,6 +370,8 @@ class ModbusProtocolHandler:
             if node == None:
                 return False
             del self.nodes[node.address]
+            self.reportFilter.forget(node.address)
+            self.modbus.cache.forget(node.address)
             return True
         except Exception as ex:
             LOGGER.error(str(ex))
@@ -249,14 +426,136 @@ class ModbusProtocolHandler:
     ####
     def filesUploaded(self, path:str)->bool:
         try:
-            for filename in os.listdir(path):
-                pass
-                ###copy files, something like this:
-                #file_path = os.path.join(path, filename)
-                #if os.path.isfile(file_path):
-                #    dest_path = os.path.join('./', filename)
-                #    shutil.copy(file_path, dest_path)
-                ###
+            if self.plugin == None:
+                return True
+            uploaded = os.path.join(path, self.plugin.meta.plugin_file)
+            if not os.path.isfile(uploaded):
+                return True
+            return self.reloadPlugin(uploaded, os.path.join(self.plugin.path, self.plugin.meta.plugin_file))
+        except Exception as ex:
+            LOGGER.error(str(ex))
+            return False
+
+    ###
+    # Replaces the register map with the uploaded plugin file without a restart. The profile
+    # is sent to IoX again and nodes are added, updated, or removed, see addNodes
+    ###
+    def reloadPlugin(self, uploaded:str, plugin_file:str)->bool:
+        try:
+            if os.path.exists(plugin_file) and filecmp.cmp(uploaded, plugin_file, shallow=False):
+                return True
+            plugin = Plugin(uploaded, path=self.plugin.path)
+            #the metrics drivers are in the profile and the nodes, see addMetricsProperties
+            addMetricsProperties(plugin)
+            if not self.modbus.reload(plugin, self.started):
+                self.setNotices('upload', f'{os.path.basename(uploaded)} is not a valid register map, the current one is still used')
+                return False
+            shutil.copy(uploaded, plugin_file)
+            plugin.meta.setPluginFile(plugin_file)
+            self.plugin = plugin
+            self.loadPrecisions()
+            self.reportFilter.max_silence_ms = self.modbus.max_silence_ms
+            self.scheduler.stop()
+            self.scheduler.clear()
+            self.scheduleRegisters()
+            plugin.toIoX()
+            if self.controller != None:
+                self.controller.poly.updateProfile()
+            if self.started:
+                self.scheduler.start()
+                #the table is built again for the new register map
+                self.stopServer()
+                self.startServer()
+                self.addNodes()
+            LOGGER.info(f'reloaded {plugin_file} ...')
+            return True
+        except Exception as ex:
+            LOGGER.error(f'reloading the plugin file failed .... ')
+            LOGGER.error(str(ex))
+            self.setNotices('upload', f'{os.path.basename(uploaded)} could not be loaded, the current register map is still used')
+            return False
+
+    ###
+    # Device nodes are generic nodes built from the register map rather than the generated classes.
+    # Adds a node for each device in the map, updates the drivers and commands of the nodes that
+    # are already there, and removes the nodes that are no longer in the map
+    ###
+    def addNodes(self)->bool:
+        try:
+            poly = self.controller.poly
+            for address in list(self.nodes.keys()):
+                if address in self.modbus.nodes:
+                    continue
+                LOGGER.info(f'removing {address}, it is no longer in the register map ...')
+                self.nodeRemoved(self.nodes[address])
+                poly.delNode(address)
+            for address, mnode in self.modbus.nodes.items():
+                if not address in self.nodes:
+                    node = poly.addNode(ModbusGenericNode(poly, self, self.controller.address, address, mnode.name))
+                    if node:
+                        self.nodeAdded(node)
+                    continue
+                node = self.nodes[address]
+                if not isinstance(node, ModbusGenericNode):
+                    continue
+                #everything is reported at the next poll with the new drivers
+                node.setRegisterMap(mnode.nodedef_id, mnode.drivers, mnode.settable)
+                poly.addNode(node)
+                self.reportFilter.forget(address)
+            return True
+        except Exception as ex:
+            LOGGER.error(f'adding nodes failed .... ')
+            LOGGER.error(str(ex))
+            return False
+
+    ###
+    # Serves the drivers of the nodes as holding/input registers. The registers are the ones in the
+    # server section of the protocol or, if it has none, the registers of the register map mirrored
+    # at the same unit and address. The table starts with the current values of the drivers
+    ###
+    def startServer(self)->bool:
+        try:
+            config = self.modbus.server
+            if config == None:
+                return True
+            if 'registers' in config:
+                entries = config['registers']
+            else:
+                entries = ModbusServerTable.mirrorEntries(self.modbus.nodes, self.getPrecision)
+            table = ModbusServerTable(entries, self.modbus.byte_order, self.modbus.word_order)
+            if table.isEmpty():
+                LOGGER.warning('there are no registers to serve, not starting the modbus server ...')
+                return False
+            nodes = list(self.nodes.values()) + ([self.controller] if self.controller != None else [])
+            for node in nodes:
+                for driver in node.drivers:
+                    table.update(node.address, driver['driver'], driver['value'])
+            server = ModbusRegisterServer(table, config['host'] if 'host' in config else MODBUS_SERVER_DEFAULT_HOST,
+                    int(config['port']) if 'port' in config else MODBUS_SERVER_DEFAULT_PORT)
+            if not server.start():
+                self.setNotices('server', f'The modbus server could not listen on {server.host}:{server.port}')
+                return False
+            self.server = server
+            return True
+        except Exception as ex:
+            LOGGER.error(f'starting the modbus server failed .... ')
+            LOGGER.error(str(ex))
+            return False
+
+    def stopServer(self)->bool:
+        server = self.server
+        self.server = None
+        if server == None:
+            return True
+        return server.stop()
+
+    ###
+    # Reads the node from the device and updates what changed in IoX
+    ###
+    def refreshNode(self, node)->bool:
+        try:
+            self.modbus.readNode(node.address)
+            self.queryRead(node)
             return True
         except Exception as ex:
             LOGGER.error(str(ex))
@@ -267,8 +566,37 @@ class ModbusProtocolHandler:
     ####
     def shortPoll(self)->bool:
         try:
+            start = time.perf_counter()
+            #read all registers in blocks first so that queryAll is served
+            #from the values just read instead of one request per property.
+            #Registers whose block failed are not read again one by one
+            self.modbus.readNodes(list(self.nodes.keys()))
             for _, node in self.nodes.items():
-                node.queryAll()
+                self.queryRead(node)
+            self.modbus.metrics.recordPoll(time.perf_counter() - start)
+            self.updateMetrics()
+            return True
+        except Exception as ex:
+            LOGGER.error(str(ex))
+            return False
+
+    ####
+    # This method is called by the scheduler with the registers of a node that are due.
+    # They are read together and the properties they serve are updated in IoX
+    ####
+    def pollRegisters(self, node_id:str, registers)->bool:
+        try:
+            if not node_id in self.nodes:
+                return False
+            node = self.nodes[node_id]
+            self.modbus.readRegisters(node_id, registers)
+            values = self.modbus.queryProperties(node_id, self.modbus.nodes[node_id].getPropertyIds(registers), True)
+            if node.getUOM(MODBUS_STALE_DRIVER['driver']) != None:
+                values[MODBUS_STALE_DRIVER['driver']] = self.modbus.cache.countStale(node_id)
+            for property_id, val in values.items():
+                val = self.reportValue(node, property_id, val)
+                if val != None:
+                    self.updateProperty(node, property_id, val, True)
             return True
         except Exception as ex:
             LOGGER.error(str(ex))
@@ -279,6 +607,8 @@ class ModbusProtocolHandler:
     ####
     def longPoll(self)->bool:
         try:
+            self.modbus.reapConnections()
+            self.modbus.cache.save(self.modbus.nodes)
             return True
         except Exception as ex:
             LOGGER.error(str(ex))
@@ -295,8 +625,7 @@ class ModbusProtocolHandler:
             self.host=self.isValidHost(params['host'])
             self.port=self.isValidPort(params['port'])
             if self.host == None or self.port < 0:
-                self.hostPortNotice()
-                return False
+                return self.gatewaysOnlyConfig()
 
             self.isValidConfig=True
             self.clearNotices()
@@ -304,8 +633,20 @@ class ModbusProtocolHandler:
         except Exception as ex:
             pass
         
-        self.hostPortNotice()
-        return False
+        return self.gatewaysOnlyConfig()
+
+    ###
+    # host/port are only the default gateway. They are not needed if every node
+    # has its own gateway in the protocol config
+    ###
+    def gatewaysOnlyConfig(self)->bool:
+        if not self.modbus.hasGateways():
+            self.hostPortNotice()
+            return False
+        self.host = None
+        self.isValidConfig=True
+        self.clearNotices()
+        return True
 
     ###
     # Convenient methods to access the system
@@ -338,6 +679,17 @@ class ModbusProtocolHandler:
     def getNode(self, address:str):
         return self.controller.poly.getNode()
 
+    ###
+    # Call this method to update a property for a node when you don't know the
+    # name of the generated update method for it.
+    ###
+    def updateProperty(self, node, property_id:str, value, force:bool, text:str=None):
+        try:
+            return node.setDriver(property_id, value, force=force, text=text)
+        except Exception as ex:
+            LOGGER.error(str(ex))
+            return False
+
     ###
     # If your plugin is an OAuth client, use this method to call APIs that 
     # automatically include all the tokens for authorization and authentication 
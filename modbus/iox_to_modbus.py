@@ -7,23 +7,49 @@ Copyright (C) 2024 Universal Devices
 """
 import udi_interface
 LOGGER = udi_interface.LOGGER
-import os
+import os, struct, time
 from datetime import datetime
 from ioxplugin import NodePropertyDetails, NodeProperties, NodeDefs, NodeDefDetails, Plugin, IoXTransport, IoXTCPTransport
+from pymodbus import FramerType
 from pymodbus.client import ModbusTcpClient
+from modbus_eval import ModbusExpression
+from modbus_codec import ModbusCodec, parseOrder, packRegisters
+from modbus_pool import ModbusConnectionPool, ModbusConnection, MODBUS_DEFAULT_IDLE_TIMEOUT, MODBUS_DEFAULT_REQUEST_TIMEOUT
+from modbus_report import MODBUS_DEFAULT_MAX_SILENCE_MS
+from modbus_writes import ModbusWriteQueue, MODBUS_DEFAULT_WRITE_WINDOW_MS
+from modbus_serial import ModbusSerialBus, parseSerialParams
+from modbus_metrics import ModbusMetrics, MODBUS_DEFAULT_METRICS_INTERVAL, MODBUS_STALE_DRIVER
+from modbus_cache import ModbusValueCache, MODBUS_DEFAULT_MAX_STALE_MS, registerKey
 
 
 MODBUS_REGISTER_TYPES=('coil', 'discrete-input', 'input', 'holding')
 MODBUS_REGISTER_DATA_TYPES=('int16','uint16','int32','uint32', 'int64', 'uint64', 'float32','float64', 'string')
 
 
-#MODBUS_COMMUNICATION_MODES=('TCP', 'Serial')
-#for now just TCP
-MODBUS_COMMUNICATION_MODES=('TCP')
+#Serial is RTU over a serial line such as RS-485, see ModbusSerialBus
+MODBUS_COMMUNICATION_MODES=('TCP', 'Serial')
 MODBUS_ADDRESSING_MODES=('0-based', '1-based')
 
-iox_modbus_byte_order = "big" 
-iox_modbus_word_order = "big"
+#protocol limits for a single read request
+MODBUS_MAX_READ_REGISTERS=125
+MODBUS_MAX_READ_BITS=2000
+#the maximum number of unused registers between two registers
+#that can still be read together in one request
+MODBUS_DEFAULT_READ_GAP=8
+#registers without their own poll interval are not read more often than this
+MODBUS_MIN_READ_INTERVAL_MS=750
+
+#sync: blocking client, nodes are read one after the other
+#async: asyncio client, all nodes are read concurrently on one event loop
+MODBUS_ENGINES=('sync', 'async')
+#unit ids a device can have
+MODBUS_MIN_UNIT=0
+MODBUS_MAX_UNIT=247
+
+
+#the address of the node of a device of a node definition at unit. IoX addresses are at most 14 characters
+def instanceAddress(nodedef_id:str, unit:int)->str:
+    return f"{nodedef_id[:10]}_{unit}".lower()
 
 
 class ModbusComm:
@@ -33,6 +59,28 @@ class ModbusComm:
         self.transport = None 
         self._client = None
         self.bRtu = False
+        self.mode = 'TCP'
+        #serial port parameters if mode is Serial
+        self.serial = None
+        self.max_read_gap = MODBUS_DEFAULT_READ_GAP
+        self.engine = 'sync'
+        self.request_timeout = MODBUS_DEFAULT_REQUEST_TIMEOUT
+        self.idle_timeout = MODBUS_DEFAULT_IDLE_TIMEOUT
+        self.max_silence_ms = MODBUS_DEFAULT_MAX_SILENCE_MS
+        self.write_window_ms = MODBUS_DEFAULT_WRITE_WINDOW_MS
+        #byte order within a register and word order of values that span registers
+        self.byte_order = 'big'
+        self.word_order = 'big'
+        #nodedef id -> {'host':..., 'port':...} for nodes that are not behind the default gateway
+        self.gateways = {}
+        #nodedef id -> [{'unit':..., 'name':..., 'host':..., 'port':...}] for node definitions shared by several devices
+        self.instances = {}
+        self.metrics_interval = MODBUS_DEFAULT_METRICS_INTERVAL
+        self.max_stale_ms = MODBUS_DEFAULT_MAX_STALE_MS
+        #the discovery section, see ModbusDiscoveryConfig
+        self.discovery = None
+        #the server section, see ModbusRegisterServer. None if IoX values are not served as registers
+        self.server = None
         if comm_data == None:
             LOGGER.warning("no comm data, using defaults ...")
             return
@@ -48,33 +96,132 @@ class ModbusComm:
             return
 
         try: 
-            global iox_modbus_byte_order
-            global iox_modbus_word_order
             if 'transport' in comm_data:
                 self._transport:IoXTransport = IoXTransport(comm_data['transport'])
+                self.mode = self._transport.getMode()
+                if self.mode == 'Serial':
+                    self.serial = parseSerialParams(comm_data['transport'])
             if 'addressing_mode' in comm_data:
                 self.addressing_mode = comm_data['addressing_mode']
             if 'is_rtu' in comm_data:
                 self.bRtu = bool(comm_data['is_rtu'])
             if 'byte_order' in comm_data:
-                iox_modbus_byte_order = comm_data['byte_order'].lower()
+                self.byte_order = parseOrder(comm_data['byte_order'])
             if 'word_order' in comm_data:
-                iox_modbus_word_order = comm_data['word_order'].lower()
+                self.word_order = parseOrder(comm_data['word_order'])
+            if 'max_read_gap' in comm_data:
+                self.max_read_gap = int(comm_data['max_read_gap'])
+            if 'engine' in comm_data:
+                self.engine = comm_data['engine'].lower()
+            if 'request_timeout' in comm_data:
+                self.request_timeout = float(comm_data['request_timeout'])
+            if 'idle_timeout' in comm_data:
+                self.idle_timeout = float(comm_data['idle_timeout'])
+            if 'gateways' in comm_data:
+                self.gateways = comm_data['gateways']
+            if 'instances' in comm_data:
+                self.instances = comm_data['instances']
+            if 'max_silence_ms' in comm_data:
+                self.max_silence_ms = int(comm_data['max_silence_ms'])
+            if 'write_window_ms' in comm_data:
+                self.write_window_ms = int(comm_data['write_window_ms'])
+            if 'max_stale_ms' in comm_data:
+                self.max_stale_ms = int(comm_data['max_stale_ms'])
+            if 'metrics_interval' in comm_data:
+                self.metrics_interval = int(comm_data['metrics_interval'])
+            if 'discovery' in comm_data:
+                self.discovery = comm_data['discovery']
+            if 'server' in comm_data:
+                self.server = comm_data['server']
             
         except Exception as ex:
             raise
 
+    def getGateway(self, nodedef_id:str):
+        if not nodedef_id in self.gateways:
+            return None, None
+        gateway = self.gateways[nodedef_id]
+        return gateway['host'], int(gateway['port']) if 'port' in gateway else 502
+
+    #returns [(address, unit, name, host, port)] of the devices of the node definition. unit is None
+    #if the node definition has no instances in which case the unit of each register is used
+    def getInstances(self, nodedef_id:str, name:str):
+        host, port = self.getGateway(nodedef_id)
+        if not nodedef_id in self.instances:
+            return [(nodedef_id, None, name, host, port)]
+        instances = []
+        for instance in self.instances[nodedef_id]:
+            unit = int(instance['unit'])
+            instance_host, instance_port = host, port
+            if 'host' in instance:
+                instance_host, instance_port = instance['host'], int(instance['port']) if 'port' in instance else 502
+            instances.append((instanceAddress(nodedef_id, unit), unit, instance['name'] if 'name' in instance else f"{name} {unit}",
+                    instance_host, instance_port))
+        return instances
+
+    def isSerial(self)->bool:
+        return self.mode == 'Serial'
+
     def is_valid(self):
+        for nodedef_id, gateway in self.gateways.items():
+            if not 'host' in gateway:
+                LOGGER.error(f"gateway for {nodedef_id} needs a host ..")
+                return False
+        for nodedef_id, instances in self.instances.items():
+            units = [instance['unit'] if 'unit' in instance else None for instance in instances]
+            if None in units or not all([isinstance(unit, int) and MODBUS_MIN_UNIT <= unit <= MODBUS_MAX_UNIT for unit in units]):
+                LOGGER.error(f"each instance of {nodedef_id} needs a unit between {MODBUS_MIN_UNIT} and {MODBUS_MAX_UNIT} ..")
+                return False
+            if len(set(units)) != len(units):
+                LOGGER.error(f"instances of {nodedef_id} need different units ..")
+                return False
+        if self.server != None and 'registers' in self.server:
+            for entry in self.server['registers']:
+                if not all([key in entry for key in ('node', 'property', 'register_type', 'register_address')]):
+                    LOGGER.error(f"server register {entry} needs a node, property, register_type, and register_address ..")
+                    return False
         if self._transport == None:
             return True
         if not self._transport.getMode() in MODBUS_COMMUNICATION_MODES:
             LOGGER.error(f"{self._transport.getMode()} is not a valid communication mode for this plugin ..")
             return False
+        if self.isSerial() and not self.serial['port']:
+            LOGGER.error("serial transport needs a port such as /dev/ttyUSB0 ..")
+            return False
+        if not self.engine in MODBUS_ENGINES:
+            LOGGER.error(f"{self.engine} is not a valid engine for this plugin ..")
+            return False
         return True
 
 
+#issues a single read request for count registers (or bits) starting at address
+def readModbusRange(client, register_type:str, address:int, count:int, unit:int):
+    if register_type == 'coil':
+        return client.read_coils(address, count=count, slave=unit)
+    elif register_type == 'holding':
+        return client.read_holding_registers(address, count=count, slave=unit)
+    elif register_type == 'input':
+        return client.read_input_registers(address, count=count, slave=unit)
+    elif register_type == 'discrete-input':
+        return client.read_discrete_inputs(address, count=count, slave=unit)
+    return None
+
+#issues a single write request for the registers (or bits) in payload starting at address
+def writeModbusRange(client, register_type:str, address:int, payload, unit:int):
+    if register_type == 'coil':
+        return client.write_coils(address, payload, slave=unit)
+    elif register_type == 'holding':
+        return client.write_registers(address, payload, slave=unit)
+    return None
+
+def maxReadCount(register_type:str)->int:
+    if register_type == 'coil' or register_type == 'discrete-input':
+        return MODBUS_MAX_READ_BITS
+    return MODBUS_MAX_READ_REGISTERS
+
+
 class ModbusRegister:
-    def __init__(self, protocol_data):
+    def __init__(self, protocol_data, byte_order:str='big', word_order:str='big'):
         if protocol_data == None:
             raise Exception ("Need protocol data ...")
 
@@ -84,10 +231,27 @@ class ModbusRegister:
         self.register_data_type = None
         self.num_registers = 1
         self.eval = None
-        self.value = None
+        self.expression:ModbusExpression = None
+        self.val = None
         self.unit = 0
         self.is_master = True
-        self.last_updated_time = datetime.now()
+        #for a reference register, the master register it derives its value from
+        self.master:ModbusRegister = None
+        #for a master register, the reference registers that derive their values from it
+        self.references = []
+        self.property_id = None
+        #if set, the register is read by the poll scheduler at this interval instead of every short poll
+        self.poll_interval_ms = None
+        #change detection for reporting to IoX, see ModbusReportFilter
+        self.deadband = None
+        self.deadband_percent = None
+        self.max_silence_ms = None
+        self.last_updated_time = None
+        #when val was last read from the device. Unlike last_updated_time, it's kept when the value must be read again
+        self.last_good_time = None
+        #False if the last read of val failed, None until it's read. Values are stale while it's not True
+        self.read_ok = None
+        self.codec:ModbusCodec = None
         self._client:ModbusTcpClient = None
 
         try:
@@ -104,6 +268,15 @@ class ModbusRegister:
                 self.unit = protocol_data['unit']
             if 'eval' in protocol_data:
                 self.eval = protocol_data['eval']
+                self.expression = ModbusExpression(self.eval)
+            if 'poll_interval_ms' in protocol_data and protocol_data['poll_interval_ms']:
+                self.poll_interval_ms = int(protocol_data['poll_interval_ms'])
+            if 'deadband' in protocol_data:
+                self.deadband = float(protocol_data['deadband'])
+            if 'deadband_percent' in protocol_data:
+                self.deadband_percent = float(protocol_data['deadband_percent'])
+            if 'max_silence_ms' in protocol_data:
+                self.max_silence_ms = int(protocol_data['max_silence_ms'])
 
             if self.register_address == None:
                 raise Exception("Expected a register address ... ")
@@ -131,142 +304,128 @@ class ModbusRegister:
             elif self.register_data_type == 'int64' or self.register_data_type == 'uint64' or self.register_data_type == 'float64':
                 self.num_registers = 4
 
+            self.codec = ModbusCodec(self.register_data_type, self.num_registers, byte_order, word_order)
 
         except Exception as ex:
             raise
 
+    #the register that is read from the device for this one
+    def getMaster(self):
+        return self if self.is_master else self.master
+
     def canRead(self):
+        if self.last_updated_time == None:
+            return True
         now = datetime.now()
         elapsed_time:datetime = now - self.last_updated_time
-        return True if (elapsed_time.total_seconds() * 1000) >= 750 else False
+        min_interval = self.poll_interval_ms if self.poll_interval_ms else MODBUS_MIN_READ_INTERVAL_MS
+        return True if (elapsed_time.total_seconds() * 1000) >= min_interval else False
 
     #return the last value stored and apply the eval expression
     #the eval expression that is passed takes precedence over the eval expression in the object
-    def getRegisterValue(self, eval_expression):
+    def getRegisterValue(self, expression:ModbusExpression):
+        if self.val == None:
+            return None
         #apply eval
-        eeval = eval_expression if eval_expression else self.eval
-        if not eeval:
+        expression = expression if expression else self.expression
+        if not expression:
             return self.val
 
-        eeval = eeval.replace('{rval}', f'{self.val}')
-        unsafe_array = ['return','def','class','import', 'as', 'from', 'os', 'json', 'with', 'file', 'for', 'while', 'url', 'requests']
-        for unsafe in unsafe_array:
-            if unsafe in eeval:
-                LOGGER.error(f"eval expression is not safe and cannot be run for {self.register_address if self.is_master else self.ref_address}")
-                return None
         try:
-            return eval(eeval)
+            return expression.evaluate(self.val)
         except Exception as ex:
-            LOGGER.error(str(ex))
-            return None
-    
-    def readRegister(self, eval_expression):
-        if self._client == None or not self._client.connected:
+            LOGGER.error(f"eval expression {expression.source} failed for {self.register_address if self.is_master else self.ref_address}: {str(ex)}")
             return None
 
+    #decodes the value of this register from a read response
+    #offset is the position of this register within the response
+    def decodeResponse(self, response, offset:int=0)->bool:
+        try:
+            if self.register_type == 'coil' or self.register_type == 'discrete-input':
+                self.setValue(1 if response.bits[offset] else 0)
+            else:
+                self.setValue(self.codec.decode(packRegisters(response.registers), offset * 2))
+            return True
+        except Exception as ex:
+            LOGGER.error(f"Failed decoding {self.register_type} @ {self.register_address}: {str(ex)}")
+            self.read_ok = False
+            return False
+
+    def setValue(self, val):
+        self.val = val
+        self.last_updated_time = datetime.now()
+        self.last_good_time = self.last_updated_time
+        self.read_ok = True
+
+    #reads the register from the device unless the value is recent enough
+    #returns False if there's no current value
+    def refresh(self)->bool:
         if not self.canRead():
-            return self.getRegisterValue(None)
+            return True
+
+        if self._client == None or not self._client.connected:
+            self.read_ok = False
+            return False
 
         try:
-            response = None
-
-            if self.register_type == 'coil':
-                response = self._client.read_coils(self.register_address, self.num_registers, slave=self.unit)
-            elif self.register_type == 'holding':
-                response = self._client.read_holding_registers(self.register_address, self.num_registers, slave=self.unit)
-            elif self.register_type == 'input':
-                response = self._client.read_input_registers(self.register_address, self.num_registers, slave=self.unit)
-            elif self.register_type == 'discrete-input':
-                response = self._client.read_discrete_inputs(self.register_address, self.num_registers, slave=self.unit)
-            
-            if response.isError():
+            response = readModbusRange(self._client, self.register_type, self.register_address, self.num_registers, self.unit)
+            if response == None or response.isError():
                 LOGGER.error(f"Failed reading {self.register_type} @ {self.register_address}")
-                return None
+                self.read_ok = False
+                return False
 
-            global iox_modbus_byte_order
-            global iox_modbus_word_order
-            #decoder = BinaryPayloadDecoder.fromRegisters(response.registers, byteorder=iox_modbus_byte_order, wordorder=iox_modbus_word_order)
-            self.val = self._client.convert_from_registers(response.registers, data_type=self.register_data_type,  wordorder=iox_modbus_word_order) 
-
-            """old style
-            if self.register_data_type == 'int16': 
-                self.val = decoder.decode_16bit_int()
-            elif self.register_data_type == 'int32':
-                self.val = decoder.decode_32bit_int()
-            elif self.register_data_type == 'int64':
-                self.val = decoder.decode_64bit_int()
-            elif self.register_data_type == 'uint16': 
-                self.val = decoder.decode_16bit_uint()
-            elif self.register_data_type == 'uint32':
-                self.val = decoder.decode_32bit_uint()
-            elif self.register_data_type == 'uint64': 
-                self.val = decoder.decode_64bit_uint()
-            elif self.register_data_type == 'float32':
-                self.val = decoder.decode_32bit_float()
-            elif self.register_data_type == 'float64':
-                self.val = decoder.decode_64bit_float()
-            elif self.register_data_type == 'string':
-                byte_array = decoder.decode_string(self.num_registers*2)
-                self.val = byte_array.decode('utf-8').rstrip('\x00')
-            else:
-                LOGGER.error(f"Invalid register data type : {self.register_data_type}")
-                return None
-            """ 
+            return self.decodeResponse(response)
 
         except Exception as ex:
             LOGGER.critical(str(ex))
+            self.read_ok = False
+            return False
+
+    def readRegister(self, expression:ModbusExpression):
+        if not self.refresh():
             return None
+        return self.getRegisterValue(expression)
         
+    #encodes the value into the registers (or bits for coils) to be written
+    def encodeValue(self, value):
+        if self.register_type == 'coil':
+            return [bool(value)]
+        if self.register_data_type == 'string': 
+            if not isinstance(value, str):
+                LOGGER.error(f"{value} is not a string ")
+                return None
+        return self.codec.encode(value)
+
+    def canWrite(self, value)->bool:
+        if value == None:
+            return False
+        if not self.is_master:
+            LOGGER.error(f"This is a reference register {self.ref_address} ... ignore writing to it ")
+            return False
+        if self.register_type != 'coil' and self.register_type != 'holding':
+            LOGGER.error(f"{self.register_type} @ {self.register_address} is read only ... ignore writing to it ")
+            return False
+        return True
+
+    #the value changed on the device, so make sure the next read gets it from there
+    def written(self, response)->bool:
+        if response == None or response.isError():
+            LOGGER.error(f"Failed writing {self.register_type} @ {self.register_address}")
+            return False
+        self.last_updated_time = None
+        return True
+
     def writeRegister(self, value)->bool:
         try:
-            if value == None:
+            if not self.canWrite(value):
                 return False
-            if not self.is_master:
-                LOGGER.error(f"This is a reference register {self.ref_address} ... ignore writing to it ")
+            if self._client == None or not self._client.connected:
                 return False
-
-            global iox_modbus_byte_order
-            global iox_modbus_word_order
-            #builder = BinaryPayloadBuilder(byteorder=iox_modbus_byte_order.BIG, wordorder=iox_modbus_word_order)
-            #get the value from modbus sending it the number of registers to be read
-            if self.register_data_type == 'string': 
-                if not isinstance(value, str):
-                    LOGGER.error(f"{value} is not a string ")
-                    return False
-            payload = self._client.convert_to_registers(value, data_type=self.register_data_type, wordorder=iox_modbus_word_order)
-            """old style
-            if self.register_data_type == 'string': 
-                builder.add_string(value)
-            elif self.register_data_type == 'int16':
-                builder.add_16bit_int(value) 
-            elif self.register_data_type == 'int32': 
-                builder.add_32bit_int(value) 
-            elif self.register_data_type == 'int64': 
-                builder.add_64bit_int(value) 
-            elif self.register_data_type == 'uint16':
-                builder.add_16bit_uint(value) 
-            elif self.register_data_type == 'uint32': 
-                builder.add_32bit_uint(value) 
-            elif self.register_data_type == 'uint64': 
-                builder.add_64bit_uint(value) 
-            elif self.register_data_type == 'float32':
-                builder.add_32bit_float(value) 
-            elif self.register_data_type == 'float64':
-                builder.add_64bit_float(value) 
-            else:
-                LOGGER.error(f"Invalid data type {self.register_data.type}")
-                return False
-            payload = builder.to_registers()
-            if not payload:
-                LOGGER.error(f"Failed encoding the value for data type {self.register_data.type}")
+            payload = self.encodeValue(value)
+            if payload == None:
                 return False
-            """
-
-            self._client.write_registers(self.register_address, payload)
-
-            value = (value)
-            #set the value
-            return True
+            response = writeModbusRange(self._client, self.register_type, self.register_address, payload, self.unit)
+            return self.written(response)
         except Exception as ex:
             LOGGER.critical(str(ex))
             return False 
@@ -274,13 +433,140 @@ class ModbusRegister:
     def setClient(self, client):
         self._client = client
 
+class ModbusReadBlock:
+    '''
+        A range of registers of the same type on the same unit that are
+        read in one request. The decoded values are sliced back out to 
+        each register in the block.
+    '''
+    def __init__(self, register:ModbusRegister):
+        self.unit = register.unit
+        self.register_type = register.register_type
+        self.start = register.register_address
+        self.end = register.register_address + register.num_registers
+        self.registers = [register]
+        self._layout = None
+
+    def count(self)->int:
+        return self.end - self.start
+
+    def canAdd(self, register:ModbusRegister, max_gap:int)->bool:
+        if register.unit != self.unit or register.register_type != self.register_type:
+            return False
+        if register.register_address - self.end > max_gap:
+            return False
+        end = max(self.end, register.register_address + register.num_registers)
+        return (end - self.start) <= maxReadCount(self.register_type)
+
+    def add(self, register:ModbusRegister):
+        self.registers.append(register)
+        self.end = max(self.end, register.register_address + register.num_registers)
+        self._layout = None
+
+    #one struct for the whole block with padding for the gaps so that all values are unpacked at once
+    #returns (struct, registers in address order) or None if the registers overlap or cannot be unpacked directly
+    def getLayout(self):
+        if self._layout != None:
+            return self._layout if self._layout else None
+        self._layout = False
+        registers = sorted(self.registers, key=lambda register: register.register_address)
+        prefix = registers[0].codec.prefix
+        fields = []
+        position = self.start
+        for register in registers:
+            if register.codec.field == None or register.codec.prefix != prefix or register.register_address < position:
+                return None
+            if register.register_address > position:
+                fields.append(f'{(register.register_address - position) * 2}x')
+            fields.append(register.codec.field)
+            position = register.register_address + register.num_registers
+        self._layout = (struct.Struct(prefix + ''.join(fields)), registers)
+        return self._layout
+
+    #the values of the block could not be read
+    def failed(self):
+        for register in self.registers:
+            register.read_ok = False
+
+    #returns None if the request itself failed, for instance if the connection dropped
+    def read(self, client)->bool:
+        if client == None or not client.connected:
+            self.failed()
+            return False
+        try:
+            response = readModbusRange(client, self.register_type, self.start, self.count(), self.unit)
+            return self.decode(response)
+        except Exception as ex:
+            LOGGER.error(str(ex))
+            self.failed()
+            return None
+
+    def decode(self, response)->bool:
+        if response == None or response.isError():
+            LOGGER.error(f"Failed reading {self.count()} {self.register_type} @ {self.start}")
+            self.failed()
+            return False
+        if self.register_type == 'coil' or self.register_type == 'discrete-input':
+            for register in self.registers:
+                register.decodeResponse(response, register.register_address - self.start)
+            return True
+        try:
+            buffer = packRegisters(response.registers)
+            layout = self.getLayout()
+            if layout != None:
+                block_struct, registers = layout
+                for register, raw in zip(registers, block_struct.unpack_from(buffer)):
+                    register.setValue(register.codec.value(raw))
+            else:
+                for register in self.registers:
+                    register.setValue(register.codec.decode(buffer, (register.register_address - self.start) * 2))
+            return True
+        except Exception as ex:
+            LOGGER.error(f"Failed decoding {self.count()} {self.register_type} @ {self.start}: {str(ex)}")
+            self.failed()
+            return False
+
+
+#groups all master registers by unit and register type and merges
+#nearby address ranges into as few read requests as possible
+def planReads(registers, max_gap:int=MODBUS_DEFAULT_READ_GAP)->[]:
+    groups = {}
+    for register in registers:
+        if not register.is_master or register.register_address == None:
+            continue
+        key = (register.unit, register.register_type)
+        if not key in groups:
+            groups[key] = []
+        groups[key].append(register)
+
+    blocks = []
+    for _, group in groups.items():
+        group.sort(key=lambda register: register.register_address)
+        block = None
+        for register in group:
+            if block != None and block.canAdd(register, max_gap):
+                block.add(register)
+                continue
+            block = ModbusReadBlock(register)
+            blocks.append(block)
+
+    return blocks
+
 class ModbusIoXNode:
 
-    def __init__(self, node:NodeDefDetails):
+    #if unit is given, all registers are read from that unit instead of the unit in their protocol
+    def __init__(self, node:NodeDefDetails, max_read_gap:int=MODBUS_DEFAULT_READ_GAP, host:str=None, port:int=None, byte_order:str='big', word_order:str='big',
+            unit:int=None, name:str=None):
         self.registers = {}
+        self.read_blocks = []
+        #the gateway for this node. If None, the default gateway is used
+        self.host = host
+        self.port = port
         if node == None:
             LOGGER.critical("No node definitions provided ...")
             raise Exception ("No node definitions provided ...")
+        self.nodedef_id = node.id
+        self.name = name if name != None else node.name
         try:
             nps:NodeProperties=node.properties
             if nps == None:
@@ -290,56 +576,157 @@ class ModbusIoXNode:
             if protocol_data == None or len (protocol_data) == 0:
                 raise Exception (f"No protocol data for {node.name} ...")
 
+            #drivers and settable properties of the node in IoX, see ModbusGenericNode
+            self.drivers = nps.getPG3Drivers()
+            self.settable = [pid for pid, np in nps.getAll().items() if np.isSet()]
+
             for pid in protocol_data:
-                self.registers[pid]=ModbusRegister(protocol_data[pid])
+                #the stale values driver is not a register, see addMetricsProperties
+                if pid == MODBUS_STALE_DRIVER['driver'] and protocol_data[pid] == None:
+                    continue
+                self.registers[pid]=ModbusRegister(protocol_data[pid], byte_order, word_order)
+                self.registers[pid].property_id = pid
+                if unit != None:
+                    self.registers[pid].unit = unit
 
+            #address -> master register. If more than one master has the same address, the first one is used
+            self.masters = {}
+            for _, item in self.registers.items():
+                if item.is_master and not item.register_address in self.masters:
+                    self.masters[item.register_address] = item
+            #link the references to their masters
             for _, item in self.registers.items():
-                if not item.is_master: 
+                if item.is_master or not item.register_address in self.masters:
                     continue
-                #it's master. So, now find all the other items
-                #that have the same address
-                for _, sitem in self.registers.items():
-                    if sitem.is_master:
-                        continue
-                    if item.register_address == sitem.register_address:
-                        sitem.ref_address = item.register_address
-                        sitem.register_address = None
+                master = self.masters[item.register_address]
+                item.ref_address = item.register_address
+                item.register_address = None
+                item.master = master
+                master.references.append(item)
+
+            #registers with their own poll interval are read by the scheduler
+            self.max_read_gap = max_read_gap
+            self.read_blocks = planReads([register for register in self.registers.values() if not register.poll_interval_ms], max_read_gap)
 
         except Exception as ex:
             LOGGER.critical(str(ex))
             raise
 
-    def setClient(self, client):
-        for _, register in self.registers.items():
-            register.setClient(client)
+    #keeps the values read by the same master registers of the node this one replaces
+    def copyValues(self, node):
+        for address, register in self.masters.items():
+            if not address in node.masters:
+                continue
+            previous = node.masters[address]
+            if registerKey(previous) == registerKey(register) and previous.register_data_type == register.register_data_type:
+                register.val = previous.val
+                register.last_good_time = previous.last_good_time
 
-    def getMaster(self, ref:str)->ModbusRegister:
+    def getUnits(self):
+        units = set()
         for _, register in self.registers.items():
-            if not register.is_master:
+            if register.is_master:
+                units.add(register.unit)
+        return units
+
+    #returns the master registers that have their own poll interval
+    def getScheduledRegisters(self):
+        return [register for register in self.registers.values() if register.is_master and register.poll_interval_ms]
+
+    #returns the ids of the properties served by these master registers including their references
+    def getPropertyIds(self, registers):
+        property_ids = []
+        for register in registers:
+            property_ids.append(register.property_id)
+            property_ids.extend([reference.property_id for reference in register.references])
+        return property_ids
+
+    #groups the given properties by the master register they are read from
+    #returns {master: [property ids]} and the property ids that have no master
+    def getMasters(self, property_ids):
+        masters = {}
+        orphans = []
+        for property_id in property_ids:
+            register = self.registers[property_id] if property_id in self.registers else None
+            master = register.getMaster() if register != None else None
+            if master == None:
+                orphans.append(property_id)
                 continue
-            if register.register_address == ref:
-                return register
-
-        return None
+            if not master in masters:
+                masters[master] = []
+            masters[master].append(property_id)
+        return masters, orphans
+
+    #reads the given blocks using one request per block and one connection per unit from the pool
+    @staticmethod
+    def readBlocks(blocks, pool:ModbusConnectionPool, host:str, port:int)->bool:
+        rc = True
+        for block in blocks:
+            connection = pool.getConnection(host, port, block.unit)
+            if not pool.connect(connection):
+                block.failed()
+                rc = False
+                continue
+            with connection.lock:
+                rc_block = ModbusIoXNode.readBlock(block, connection.client, pool, host, port)
+                if rc_block == None:
+                    pool.failed(connection)
+                    rc = False
+                    continue
+                if rc_block:
+                    continue
+                if len(block.registers) == 1:
+                    rc = False
+                    continue
+                #the device refused the block, for instance because the gap contains
+                #unmapped addresses, so read each register on its own
+                for register in block.registers:
+                    if not ModbusIoXNode.readBlock(ModbusReadBlock(register), connection.client, pool, host, port):
+                        rc = False
+        return rc
+
+    #reads the block and records how long it took in the pool
+    @staticmethod
+    def readBlock(block:ModbusReadBlock, client, pool:ModbusConnectionPool, host:str, port:int)->bool:
+        start = time.perf_counter()
+        rc = block.read(client)
+        pool.recordRequest(host, port, block.unit, block.register_type, block.start, block.count(), time.perf_counter() - start, rc)
+        return rc
+
+    def getMaster(self, ref:int)->ModbusRegister:
+        return self.masters[ref] if ref in self.masters else None
 
     def queryProperty(self, property_id:str):
         if property_id == None:
             LOGGER.error("You need to have a property id ...")
             return None
-        mregister:ModbusRegister = self.registers[property_id]
-        if mregister == None:
-            LOGGER.error(f"No registers for {property_id}")
-            return None
-        eval_expression = None
-        if not mregister.is_master:
-            eval_expression = mregister.eval
-            mregister = self.getMaster(mregister.ref_address)
-
-        if mregister == None:
+        return self.queryProperties([property_id])[property_id]
+
+    #returns {property id: value} for the given properties. Each master register is
+    #read at most once and its value serves all the properties derived from it
+    def queryProperties(self, property_ids)->dict:
+        masters, orphans = self.getMasters(property_ids)
+        values = {}
+        for property_id in orphans:
             LOGGER.error(f"Couldn't find master register for {property_id}")
-            return None
-
-        return mregister.readRegister(eval_expression)
+            values[property_id] = None
+        for master, ids in masters.items():
+            values.update(self.readMaster(master, ids))
+        return values
+
+    #reads the master register if need be and returns the values of the given properties derived from it
+    def readMaster(self, master:ModbusRegister, property_ids)->dict:
+        if not master.refresh():
+            return {property_id: None for property_id in property_ids}
+        return self.getValues(master, property_ids)
+
+    #returns the values of the given properties derived from the last value of the master register
+    def getValues(self, master:ModbusRegister, property_ids)->dict:
+        values = {}
+        for property_id in property_ids:
+            register = self.registers[property_id]
+            values[property_id] = master.getRegisterValue(None if register.is_master else register.expression)
+        return values
     
     def setProperty(self, property_id:str, value):
         if property_id == None or value == None:
@@ -349,19 +736,42 @@ class ModbusIoXNode:
         if mregister == None:
             LOGGER.error(f"No registers for {property_id}")
             return None
-        return mregister.setRegisterValue(value)
+        return mregister.writeRegister(value)
 
 class ModbusIoX:
     def __init__(self, plugin:Plugin):
         self.nodes = {}
-        self._client = None
         self.host = None
         self.port = None
         self.is_rtu = False
+        self.engine = None
+        self.engine_type = 'sync'
+        self.request_timeout = MODBUS_DEFAULT_REQUEST_TIMEOUT
+        self.max_silence_ms = MODBUS_DEFAULT_MAX_SILENCE_MS
+        #latency, errors, timeouts, and reconnects of each device
+        self.metrics = ModbusMetrics()
+        self.metrics_interval = MODBUS_DEFAULT_METRICS_INTERVAL
+        self.pool = ModbusConnectionPool(self.createClient, metrics=self.metrics)
+        #all units on a serial line share one client and take turns on the line
+        self.serial_bus:ModbusSerialBus = None
+        #writes to contiguous registers that arrive together are sent in one request
+        self.writes = ModbusWriteQueue(self.writeRange)
+        self.discovery = None
+        #the server section of the protocol and the orders to encode its registers with
+        self.server = None
+        self.byte_order = 'big'
+        self.word_order = 'big'
+        #last known good values served when devices cannot be read
+        self.cache = ModbusValueCache()
         
         if plugin == None or plugin.nodedefs == None:
             LOGGER.error("No plugin and/or node definitions provided ...")
             return 
+        self.configure(plugin)
+
+    #sets up the protocol and the nodes of the plugin. Each node definition has one node
+    #or one per instance keyed by the address of the node in IoX, see ModbusComm.getInstances
+    def configure(self, plugin:Plugin):
         try:
             if not plugin.protocol.isModbus():
                 LOGGER.error("This plugin does not support modbus")
@@ -369,66 +779,184 @@ class ModbusIoX:
 
             comm = ModbusComm(plugin.protocol)
             if not comm.is_valid():
-                raise Exception ("Invalid protocol. Currently TCP only ...")
-            self.is_rtu=comm.bRtu
-
+                raise Exception ("Invalid protocol ...")
+            #build the nodes first so that a bad register map leaves the current one in place
+            nodes = {}
             nodedefs=plugin.nodedefs.getNodeDefs()
             for n in nodedefs: 
                 node:NodeDefDetails=nodedefs[n]
-                if not node.isController:
-                    self.nodes[node.id]=ModbusIoXNode(node)
+                if node.isController:
+                    continue
+                for address, unit, name, host, port in comm.getInstances(node.id, node.name):
+                    if comm.isSerial():
+                        #every node is on the serial line
+                        host, port = comm.serial['port'], comm.serial['baudrate']
+                    nodes[address]=ModbusIoXNode(node, comm.max_read_gap, host, port, comm.byte_order, comm.word_order, unit, name)
+
+            self.nodes = nodes
+            self.serial_bus = None
+            self.pool = ModbusConnectionPool(self.createClient, metrics=self.metrics)
+            self.is_rtu=comm.bRtu
+            self.engine_type=comm.engine
+            self.request_timeout=comm.request_timeout
+            self.pool.idle_timeout=comm.idle_timeout
+            self.max_silence_ms=comm.max_silence_ms
+            self.writes.window_ms=comm.write_window_ms
+            self.discovery=comm.discovery
+            self.server=comm.server
+            self.byte_order=comm.byte_order
+            self.word_order=comm.word_order
+            self.metrics_interval=comm.metrics_interval
+            self.cache.max_stale_ms=comm.max_stale_ms
+            self.pool.request_timeout=comm.request_timeout
+            if comm.isSerial():
+                self.serial_bus = ModbusSerialBus(comm.serial)
+                self.pool.lock = self.serial_bus.lock
+                self.pool.request_timeout = comm.serial['timeout']
+                if self.engine_type == 'async':
+                    LOGGER.warning("a serial line can only do one request at a time, using the sync engine ...")
+                    self.engine_type = 'sync'
         except Exception as ex:
             LOGGER.critical(str(ex))
             raise
 
+    #replaces the register map with the one of the plugin without a restart. If connect, connections
+    #are opened again since the protocol may have changed. Values read by registers that are still
+    #in the map are kept. Returns False and keeps the current map if the plugin is not valid
+    def reload(self, plugin:Plugin, connect:bool=True)->bool:
+        if plugin == None or plugin.nodedefs == None or plugin.protocol == None:
+            LOGGER.error("No plugin and/or node definitions provided ...")
+            return False
+        nodes = self.nodes
+        self.disconnect()
+        try:
+            self.configure(plugin)
+        except Exception as ex:
+            LOGGER.error(f"keeping the current register map: {str(ex)}")
+            if connect:
+                self.connect(self.host, self.port)
+            return False
+        for address, node in self.nodes.items():
+            if address in nodes:
+                node.copyValues(nodes[address])
+        LOGGER.info(f"reloaded the register map with {len(self.nodes)} nodes")
+        if connect:
+            self.connect(self.host, self.port)
+        return True
+
+    def createClient(self, host:str, port:int):
+        if self.serial_bus != None:
+            return self.serial_bus.client
+        framer = FramerType.RTU if self.is_rtu else FramerType.SOCKET
+        #the pool sets the timeout of each gateway before every request. A retry is
+        #enough to ride out a lost packet, more would only delay reading the other devices
+        return ModbusTcpClient(host=host, port=port, framer=framer, timeout=self.request_timeout, retries=1)
+
+    #a client for probing units during discovery, with a short timeout
+    def createProbeClient(self, host:str, port:int, timeout:float):
+        framer = FramerType.RTU if self.is_rtu else FramerType.SOCKET
+        return ModbusTcpClient(host=host, port=port, framer=framer, timeout=timeout, retries=0)
+
+    #returns the gateway (host, port) for the node
+    def getGateway(self, node:ModbusIoXNode):
+        if node.host != None:
+            return node.host, node.port
+        return self.host, self.port
+
+    #whether or not every node has its own gateway, in which case the default host/port are optional
+    def hasGateways(self)->bool:
+        for _, node in self.nodes.items():
+            if node.host == None:
+                return False
+        return True
+
+    #returns all the (host, port, unit) needed by the nodes
+    def getConnectionKeys(self):
+        keys = set()
+        for _, node in self.nodes.items():
+            host, port = self.getGateway(node)
+            if host == None or port == None:
+                continue
+            for unit in node.getUnits():
+                keys.add((host, port, unit))
+        return keys
+
+    def getConnection(self, node:ModbusIoXNode, unit:int)->ModbusConnection:
+        host, port = self.getGateway(node)
+        if host == None or port == None:
+            return None
+        return self.pool.getConnection(host, port, unit)
+
+    #registers keep the client of the unit they belong to. The pool keeps the same
+    #client object for the life of the connection, even across reconnects
+    def bindClients(self):
+        for _, node in self.nodes.items():
+            for _, register in node.registers.items():
+                if self.engine_type == 'async' or not register.is_master:
+                    register.setClient(None)
+                    continue
+                connection = self.getConnection(node, register.unit)
+                register.setClient(connection.client if connection else None)
+
     def isConnected(self):
-        return True if (self._client and self._client.connected) else False
+        if self.engine != None:
+            return self.engine.isConnected()
+        return self.pool.isConnected()
         
     def disconnect(self):
-        if self.isConnected():
-            self._client.close()
-            self._client = None
-            for _, node in self.nodes.items():
-                node.setClient(None)
+        if self.engine != None:
+            self.engine.stop()
+            self.engine = None
+        self.pool.closeAll()
+
+    #closes connections that have not been used within the idle timeout
+    def reapConnections(self):
+        if self.serial_bus != None:
+            #the serial port is local and shared by all units, keep it open
+            return []
+        if self.engine != None:
+            return self.engine.reap()
+        return self.pool.reap()
         
+    #host/port are the default gateway for nodes that don't have their own
+    #returns True if at least one gateway is connected
     def connect(self, host, port)->bool:
-        if self.isConnected():
-            LOGGER.warn("Already connected ... ignoring")
-            return True
+        if host != None and len (host) > 0 and port != None and port > 0:
+            self.host = host
+            self.port = port
 
-        if host == None or len (host) <= 0 or port == None or port <= 0:
+        keys = self.getConnectionKeys()
+        if len(keys) == 0:
             LOGGER.error("To connect to modbus tcp, both host and port are mandatory ...")
             return False
 
-        if self.host == None or self.host != host:
-            self.host = host
-
-        if self.port == None or self.port != port:
-            self.port = port
+        self.bindClients()
+        if self.engine_type == 'async':
+            return self.connectAsync(keys)
 
-        try:
-            if self.is_rtu:
-                from pymodbus.transaction import ModbusRtuFramer as ModbusFramer
-                self._client = ModbusTcpClient(host=host, port=port, framer=ModbusFramer)
+        rc = False
+        for key in keys:
+            connection = self.pool.getConnection(key[0], key[1], key[2])
+            if self.pool.connect(connection):
+                rc = True
             else:
-                self._client = ModbusTcpClient(host=host, port=port)
-            self._client.comm_params.timeout_connect=20 
-            self._client.comm_params.timeout=20 
-            connection = self._client.connect()
-            if not connection:
-                LOGGER.error(f"failed connecting to modbus server @ {client.host}:{client.port}")
-                return False
-            LOGGER.info(f"connected to modbus server @ {host}:{port}")
+                LOGGER.error(f"failed connecting to modbus server @ {connection}")
+        return rc
 
-            for _,node in self.nodes.items():
-                node.setClient(self._client)
-            
-            return True
+    #all reads and writes go through the async engine. Nodes are not given a client
+    #so queries are answered from the values the engine decoded last
+    def connectAsync(self, keys)->bool:
+        try:
+            from modbus_async import ModbusAsyncEngine
+            if self.engine == None:
+                self.engine = ModbusAsyncEngine(self.request_timeout, self.is_rtu, self.pool.idle_timeout, self.metrics)
+            return self.engine.connect(keys)
         except Exception as ex:
             LOGGER.error(str(ex))
             return False
 
-    def queryProperty(self, node_id:str, property_id:str):
+    #if cached, the value is not read from the device, see queryProperties
+    def queryProperty(self, node_id:str, property_id:str, cached:bool=False):
         if node_id == None or property_id == None:
             LOGGER.error("Need node id and property id ...")
             return None
@@ -438,16 +966,129 @@ class ModbusIoX:
             LOGGER.error(f"No node for {node_id} ...")
             return None
 
-        if not self.isConnected():
-            LOGGER.warning("Modbus client is not connected ... trying to reconnect")
-            if not self.connect(self.host, self.port):
-                LOGGER.warning("Failed connecting to modbus client ...")
-                return None
+        return self.queryProperties(node_id, [property_id], cached)[property_id]
+
+    #returns {property id: value} for the given properties of a node reading each master register at most once
+    #registers that cannot be read are served from the cache if their last good value is recent enough
+    #if cached, nothing is read from the device and the last good values are served
+    def queryProperties(self, node_id:str, property_ids, cached:bool=False)->dict:
+        if node_id == None or property_ids == None:
+            LOGGER.error("Need node id and property ids ...")
+            return {}
+
+        if not node_id in self.nodes:
+            LOGGER.error(f"No node for {node_id} ...")
+            return {property_id: None for property_id in property_ids}
+        node:ModbusIoXNode = self.nodes[node_id]
+
+        masters, orphans = node.getMasters(property_ids)
+        for property_id in orphans:
+            LOGGER.error(f"Couldn't find master register for {property_id}")
+        values = {property_id: None for property_id in orphans}
+        for master, ids in masters.items():
+            #a value is stale only if its own read failed
+            fresh = master.read_ok == True if cached else self.refreshMaster(node, master)
+            if not fresh and not self.cache.canServe(master):
+                self.cache.setStale(node_id, ids, False)
+                values.update({property_id: None for property_id in ids})
+                continue
+            self.cache.setStale(node_id, ids, not fresh)
+            values.update(node.getValues(master, ids))
+        return values
+
+    #reads the master register unless its value is recent enough. Returns False if the last read failed
+    def refreshMaster(self, node:ModbusIoXNode, master:ModbusRegister)->bool:
+        if not master.canRead():
+            return True
+        if master.poll_interval_ms:
+            #only the scheduler reads the registers that have their own poll interval
+            return master.read_ok == True
+        if self.engine != None:
+            #the engine reads the blocks of all nodes. Nodes have no client of their own
+            return master.read_ok == True
+        #the pool reconnects if need be unless the gateway is backing off 
+        connection = self.getConnection(node, master.unit)
+        if connection == None or not self.pool.connect(connection):
+            master.read_ok = False
+            return False
+        with connection.lock:
+            return master.refresh()
+
+    #refreshes all the registers of a node in as few requests as possible
+    #subsequent queryProperty calls are then served from the values read
+    def readNode(self, node_id:str)->bool:
+        if node_id == None:
+            LOGGER.error("Need node id ...")
+            return False
+
+        if not node_id in self.nodes:
+            LOGGER.error(f"No node for {node_id} ...")
+            return False
+        node:ModbusIoXNode = self.nodes[node_id]
+        host, port = self.getGateway(node)
+        if host == None or port == None:
+            LOGGER.error(f"No gateway for {node_id} ...")
+            return False
+
+        if self.engine != None:
+            results = self.engine.readNodes({node_id:(node.read_blocks, host, port)})
+            return results[node_id] if node_id in results else False
+
+        return ModbusIoXNode.readBlocks(node.read_blocks, self.pool, host, port)
+
+    #reads the given master registers of a node batched in as few requests as possible
+    def readRegisters(self, node_id:str, registers)->bool:
+        if node_id == None or not node_id in self.nodes:
+            LOGGER.error(f"No node for {node_id} ...")
+            return False
+        node:ModbusIoXNode = self.nodes[node_id]
+        host, port = self.getGateway(node)
+        if host == None or port == None:
+            LOGGER.error(f"No gateway for {node_id} ...")
+            return False
+
+        blocks = planReads(registers, node.max_read_gap)
+        if self.engine != None:
+            results = self.engine.readNodes({node_id:(blocks, host, port)})
+            return results[node_id] if node_id in results else False
 
-        return node.queryProperty(property_id) 
+        return ModbusIoXNode.readBlocks(blocks, self.pool, host, port)
+
+    #refreshes all the registers of the given nodes. With the async engine
+    #all nodes are read concurrently otherwise one after the other
+    def readNodes(self, node_ids)->bool:
+        if node_ids == None:
+            LOGGER.error("Need node ids ...")
+            return False
+
+        if self.engine == None:
+            rc = True
+            for node_id in node_ids:
+                if not self.readNode(node_id):
+                    rc = False
+            return rc
+
+        nodes = {}
+        for node_id in node_ids:
+            if not node_id in self.nodes:
+                LOGGER.error(f"No node for {node_id} ...")
+                continue
+            node = self.nodes[node_id]
+            host, port = self.getGateway(node)
+            if host == None or port == None:
+                LOGGER.error(f"No gateway for {node_id} ...")
+                continue
+            nodes[node_id] = (node.read_blocks, host, port)
+        results = self.engine.readNodes(nodes)
+        return len(results) == len(nodes) and all(results.values())
+
+    def getRegister(self, node_id:str, property_id:str)->ModbusRegister:
+        if not node_id in self.nodes or not property_id in self.nodes[node_id].registers:
+            return None
+        return self.nodes[node_id].registers[property_id]
 
     def setProperty(self, node_id:str, property_id:str, value):
-        if nodeid == None or property_id == None or value == None:
+        if node_id == None or property_id == None or value == None:
             LOGGER.error("Need node id, property id, and value ...")
             return None
 
@@ -456,8 +1097,74 @@ class ModbusIoX:
             LOGGER.error(f"No node for {node_id} ...")
             return None
 
-        if not self.isConnected():
-            LOGGER.error("Modbus client is not connected ... trying to reconnect")
-            return self.connect(self.host, self.port)
+        if not property_id in node.registers:
+            LOGGER.error(f"No registers for {property_id}")
+            return False
+        register:ModbusRegister = node.registers[property_id]
+
+        host, port = self.getGateway(node)
+        if host == None or port == None:
+            LOGGER.error(f"No gateway for {node_id} ...")
+            return False
+
+        if not register.canWrite(value):
+            return False
+        payload = register.encodeValue(value)
+        if payload == None:
+            return False
+
+        if self.writes.window_ms <= 0:
+            return register.written(self.writeRange(host, port, register.unit, register.register_type, register.register_address, payload))
+        #connecting and writing may each take up to the request timeout
+        return self.writes.write(host, port, register, payload, self.writeTimeout())
+
+    #sets several properties of a node at once so that contiguous registers are written together. Returns {property_id:bool}
+    def setProperties(self, node_id:str, values:dict)->dict:
+        results = {}
+        pending = {}
+        node:ModbusIoXNode = self.nodes[node_id] if node_id in self.nodes else None
+        if node == None:
+            LOGGER.error(f"No node for {node_id} ...")
+            return results
+        host, port = self.getGateway(node)
+        for property_id, value in values.items():
+            results[property_id] = False
+            if host == None or port == None or not property_id in node.registers:
+                LOGGER.error(f"No gateway or registers for {node_id}/{property_id}")
+                continue
+            register:ModbusRegister = node.registers[property_id]
+            if not register.canWrite(value):
+                continue
+            payload = register.encodeValue(value)
+            if payload == None:
+                continue
+            pending[property_id] = self.writes.submit(host, port, register, payload)
+        for property_id, write in pending.items():
+            results[property_id] = self.writes.wait(write, self.writeTimeout())
+        return results
+
+    #how long a caller waits for its queued write: the window, connecting, and writing
+    def writeTimeout(self)->float:
+        return self.request_timeout * 4 + 2
+
+    #writes payload starting at address on the gateway and returns the response or None if it failed
+    def writeRange(self, host:str, port:int, unit:int, register_type:str, address:int, payload:list):
+        if self.engine != None:
+            return self.engine.writeRange(host, port, unit, register_type, address, payload)
+
+        connection = self.pool.getConnection(host, port, unit)
+        if not self.pool.connect(connection):
+            LOGGER.warning(f"Failed connecting to modbus server @ {connection} ...")
+            return None
 
-        return node.setProperty(propety_id, value) 
+        with connection.lock:
+            start = time.perf_counter()
+            try:
+                response = writeModbusRange(connection.client, register_type, address, payload, unit)
+            except Exception as ex:
+                LOGGER.error(str(ex))
+                self.pool.failed(connection)
+                response = None
+            self.pool.recordRequest(host, port, unit, f"write {register_type}", address, len(payload), time.perf_counter() - start,
+                    None if response == None else not response.isError())
+            return response
@@ -8,6 +8,7 @@ import version
 import ioxplugin
 from ioxplugin import Plugin
 from ModbusProtocolHandler import ModbusProtocolHandler
+from modbus_metrics import addMetricsProperties
 
 PLUGIN_FILE_NAME = "modbus.iox_plugin.json"
 PLUGIN_FILE_NAME_DEST = f"{os.getcwd()}/{PLUGIN_FILE_NAME}"
@@ -28,6 +29,15 @@ def configurePluginFile():
                 return False
    return True
 
+#device nodes are generic nodes built from the register map (see ModbusGenericNode) rather than
+#the generated node classes so that an uploaded register map is used without a restart
+def createController(polyglot, protocolHandler):
+    from ModbusControllerNode import ModbusControllerNode
+    class ModbusController(ModbusControllerNode):
+        def addAllNodes(self):
+            return self.protocolHandler.addNodes()
+    return ModbusController(polyglot, protocolHandler)
+
 if __name__ == '__main__':
     try:
         polyglot = udi_interface.Interface([])
@@ -38,11 +48,12 @@ if __name__ == '__main__':
         else:
             polyglot.Notices.clear()
             plugin = Plugin(PLUGIN_FILE_NAME)
+            #before the profile, the controller node, and the register map are built so that they all have the metrics drivers
+            addMetricsProperties(plugin)
             plugin.toIoX()
             plugin.generateCode(path='./')
-            from ModbusControllerNode import ModbusControllerNode
             protocolHandler = ModbusProtocolHandler(plugin)
-            controller = ModbusControllerNode(polyglot, protocolHandler)
+            controller = createController(polyglot, protocolHandler)
             protocolHandler.setController(controller)
 #            controller.start()
             polyglot.ready()
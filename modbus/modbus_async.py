@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+
+"""
+Asynchronous modbus engine: reads all nodes concurrently on one event loop
+Copyright (C) 2024 Universal Devices
+"""
+import udi_interface
+LOGGER = udi_interface.LOGGER
+import asyncio, threading, time
+import concurrent.futures
+from pymodbus import FramerType
+from pymodbus.client import AsyncModbusTcpClient
+from pymodbus.exceptions import ModbusIOException
+from iox_to_modbus import ModbusReadBlock, readModbusRange, writeModbusRange
+from modbus_pool import ModbusConnectionPool, ModbusConnection, MODBUS_DEFAULT_IDLE_TIMEOUT
+
+
+class ModbusAsyncEngine:
+    '''
+        Runs an asyncio event loop in its own thread. Blocks of the same node
+        are read one after the other since they go to the same device while
+        nodes are read concurrently. Each request has its own deadline so
+        a poll takes as long as the slowest device and not the sum of all.
+        Connections are kept in a pool and are only used on the engine loop.
+        Requests wait for the timeout of their gateway and gateways whose
+        breaker is open are skipped, see ModbusGatewayHealth.
+    '''
+    def __init__(self, request_timeout:float, is_rtu:bool=False, idle_timeout:float=MODBUS_DEFAULT_IDLE_TIMEOUT, metrics=None):
+        self.request_timeout = request_timeout
+        self.is_rtu = is_rtu
+        self.metrics = metrics
+        self.pool = ModbusConnectionPool(self.createClient, idle_timeout, metrics=metrics, request_timeout=request_timeout)
+        self._loop = None
+        self._thread = None
+
+    def start(self):
+        if self._loop != None:
+            return
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name='ModbusAsyncEngine', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._loop == None:
+            return
+        self.disconnect()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout=self.request_timeout)
+        self._loop = None
+        self._thread = None
+
+    #runs the coroutine on the engine loop and waits at most timeout seconds for the result
+    def _run(self, coroutine, timeout:float):
+        future = asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            LOGGER.error(f"modbus async engine timed out after {timeout} seconds")
+            return None
+        except Exception as ex:
+            LOGGER.error(str(ex))
+            return None
+
+    def createClient(self, host:str, port:int):
+        framer = FramerType.RTU if self.is_rtu else FramerType.SOCKET
+        return AsyncModbusTcpClient(host, port=port, framer=framer, timeout=self.request_timeout)
+
+    def isConnected(self)->bool:
+        return self.pool.isConnected()
+
+    #returns a connected client or None if it cannot connect, it's backing off, or the breaker of the gateway is open
+    async def _getClient(self, host:str, port:int, unit:int):
+        connection:ModbusConnection = self.pool.getConnection(host, port, unit)
+        if not self.pool.canUse(connection):
+            return None
+        if connection.isConnected():
+            connection.touch()
+            return connection.client
+        if not connection.canConnect():
+            return None
+        try:
+            if await asyncio.wait_for(connection.client.connect(), self.pool.getTimeout(host, port)):
+                LOGGER.info(f"connected (async) to modbus server @ {connection}")
+                self.pool.connected(connection)
+                return connection.client
+        except (asyncio.TimeoutError, ModbusIOException):
+            LOGGER.error(f"Timed out connecting to modbus server @ {connection}")
+        except Exception as ex:
+            LOGGER.error(str(ex))
+        self.pool.failed(connection)
+        return None
+
+    #connects to all (host, port, unit) keys concurrently. Returns True if any is connected
+    def connect(self, keys)->bool:
+        self.start()
+
+        async def _connect():
+            clients = await asyncio.gather(*[self._getClient(key[0], key[1], key[2]) for key in keys])
+            return any([client != None for client in clients])
+
+        return self._run(_connect(), self.request_timeout * 2) == True
+
+    def disconnect(self):
+        if self._loop == None:
+            return
+        self._loop.call_soon_threadsafe(self.pool.closeAll)
+
+    def reap(self):
+        if self._loop == None:
+            return []
+        async def _reap():
+            return self.pool.reap()
+        reaped = self._run(_reap(), self.request_timeout)
+        return reaped if reaped != None else []
+
+    #writes payload starting at address and returns the response or None if it failed
+    def writeRange(self, host:str, port:int, unit:int, register_type:str, address:int, payload:list):
+        if self._loop == None:
+            return None
+
+        async def _write():
+            client = await self._getClient(host, port, unit)
+            if client == None:
+                return None
+            start = time.perf_counter()
+            try:
+                response = await asyncio.wait_for(writeModbusRange(client, register_type, address, payload, unit), self.pool.getTimeout(host, port))
+            except (asyncio.TimeoutError, ModbusIOException):
+                LOGGER.error(f"Timed out writing {register_type} @ {address}")
+                self.pool.failed(self.pool.getConnection(host, port, unit))
+                response = None
+            self.pool.recordRequest(host, port, unit, f"write {register_type}", address, len(payload), time.perf_counter() - start,
+                    None if response == None else not response.isError())
+            return response
+
+        return self._run(_write(), self.request_timeout * 2 + 1)
+
+    #returns None if the device did not respond in time
+    async def _readBlock(self, client, block:ModbusReadBlock, host:str, port:int)->bool:
+        start = time.perf_counter()
+        rc = await self._readBlockResponse(client, block, self.pool.getTimeout(host, port))
+        self.pool.recordRequest(host, port, block.unit, block.register_type, block.start, block.count(), time.perf_counter() - start, rc)
+        return rc
+
+    async def _readBlockResponse(self, client, block:ModbusReadBlock, timeout:float)->bool:
+        try:
+            response = await asyncio.wait_for(readModbusRange(client, block.register_type, block.start, block.count(), block.unit), timeout)
+            return block.decode(response)
+        except (asyncio.TimeoutError, ModbusIOException):
+            #pymodbus reports the cancellation by wait_for as an IO error
+            LOGGER.error(f"Timed out reading {block.count()} {block.register_type} @ {block.start}")
+            block.failed()
+            return None
+        except Exception as ex:
+            LOGGER.error(str(ex))
+            block.failed()
+            return False
+
+    async def _readBlocks(self, blocks, host:str, port:int)->bool:
+        rc = True
+        for index, block in enumerate(blocks):
+            client = await self._getClient(host, port, block.unit)
+            if client == None:
+                block.failed()
+                rc = False
+                continue
+            rc_block = await self._readBlock(client, block, host, port)
+            if rc_block == None:
+                #the device is not responding, don't wait for the rest of the blocks
+                self.pool.failed(self.pool.getConnection(host, port, block.unit))
+                for skipped in blocks[index + 1:]:
+                    skipped.failed()
+                return False
+            if rc_block:
+                continue
+            if len(block.registers) == 1:
+                rc = False
+                continue
+            #the device refused the block, read each register on its own
+            for register in block.registers:
+                rc_block = await self._readBlock(client, ModbusReadBlock(register), host, port)
+                if rc_block == None:
+                    self.pool.failed(self.pool.getConnection(host, port, block.unit))
+                    for skipped in blocks[index + 1:]:
+                        skipped.failed()
+                    return False
+                if not rc_block:
+                    rc = False
+        return rc
+
+    async def _readNodes(self, nodes:dict)->dict:
+        node_ids = list(nodes.keys())
+        results = await asyncio.gather(*[self._readBlocks(*nodes[node_id]) for node_id in node_ids])
+        return dict(zip(node_ids, results))
+
+    #reads the blocks of all the given nodes {node_id:([ModbusReadBlock], host, port)} concurrently and returns {node_id:bool}
+    def readNodes(self, nodes:dict)->dict:
+        if self._loop == None or nodes == None or len(nodes) == 0:
+            return {}
+        #worst case: connecting, then every block and each of its registers times out
+        num_requests = max([sum([1 if len(block.registers) == 1 else len(block.registers) + 1 for block in blocks]) for blocks, _, _ in nodes.values()])
+        results = self._run(self._readNodes(nodes), self.request_timeout * (num_requests + 1) + 1)
+        return results if results != None else {}
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark of modbus poll cycles against simulated devices
+Copyright (C) 2024 Universal Devices
+
+Generates a plugin with nodes of mixed register types, runs the simulated
+devices in their own process, and drives ModbusProtocolHandler.shortPoll the
+way PG3 does. Reports transactions/sec, p50/p99 poll latency, and CPU per poll.
+Save the results of a known good tree with --save and compare later runs with
+--compare to catch regressions in iox_to_modbus.py.
+"""
+import argparse, json, multiprocessing, os, random, socket, statistics, sys, tempfile, time
+
+MODBUS_BENCHMARK_DATA_TYPES=(('int16', 1), ('uint16', 1), ('int32', 2), ('uint32', 2), ('float32', 2), ('int64', 4))
+#(register type, eval expression, editor). Editors come from modbus.iox_plugin.json
+MODBUS_BENCHMARK_VARIANTS=(
+    ('holding', None, 'load_shave_amps'),
+    ('input', None, 'dc_voltage'),
+    ('holding', '({rval} - 1000) / 10', 'batt_temp'),
+    ('input', 'int({rval}) & 0xff', 'force_charge')
+)
+#how much slower or more CPU hungry than the saved results is a regression
+MODBUS_BENCHMARK_TOLERANCE=0.2
+
+
+class BenchmarkNode:
+    '''
+        Stands in for the generated node: queryAll asks the handler for each
+        property and counts what would be sent to IoX.
+    '''
+    def __init__(self, address:str, property_ids, handler):
+        self.address = address
+        self.property_ids = property_ids
+        self.handler = handler
+        self.updates = 0
+
+    def setDriver(self, property_id, value, force=False, text=None):
+        self.updates += 1
+
+    def queryAll(self):
+        for property_id in self.property_ids:
+            val = self.handler.queryProperty(self, property_id)
+            if val != None:
+                self.setDriver(property_id, val, True)
+
+
+#returns the plugin json with nodes of registers each, all with the same layout on units 1..nodes
+def buildPlugin(template:dict, nodes:int, registers:int, gap:int, seed:int):
+    rand = random.Random(seed)
+    properties = []
+    address = 0
+    for i in range(registers):
+        data_type, count = rand.choice(MODBUS_BENCHMARK_DATA_TYPES)
+        register_type, expression, editor = rand.choice(MODBUS_BENCHMARK_VARIANTS)
+        protocol = {'register_address': hex(address), 'register_data_type': data_type, 'register_type': register_type}
+        if expression:
+            protocol['eval'] = expression
+        properties.append({'id': f"Register {i} | GV{i}", 'name': f"Register {i}", 'editor': {'idref': editor}, 'protocol': protocol})
+        address += count + rand.randint(0, gap)
+    plugin = dict(template)
+    plugin['protocol'] = {'name': 'Modbus', 'config': {}}
+    plugin['nodedefs'] = []
+    for unit in range(1, nodes + 1):
+        node_properties = json.loads(json.dumps(properties))
+        for node_property in node_properties:
+            node_property['protocol']['unit'] = unit
+        plugin['nodedefs'].append({'id': f"meter{unit}", 'name': f"Meter{unit}", 'icon': 'Electricity', 'properties': node_properties})
+    return plugin, address
+
+def freePort()->int:
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+def percentile(values, p:float)->float:
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(p / 100 * len(values) + 0.5)) - 1))
+    return values[index]
+
+def run(args)->dict:
+    from modbus_simulator import serve, waitForServer
+    here = os.path.dirname(os.path.abspath(__file__))
+    with open(os.path.join(here, 'modbus.iox_plugin.json')) as file:
+        template = json.load(file)
+    plugin_json, size = buildPlugin(template, args.nodes, args.registers, args.gap, args.seed)
+    config = plugin_json['protocol']['config']
+    config['engine'] = args.engine
+    if args.read_gap != None:
+        config['max_read_gap'] = args.read_gap
+    port = freePort()
+    if args.serial:
+        config['transport'] = {'mode': 'Serial', 'port': f'socket://localhost:{port}', 'baudrate': 115200}
+    units = list(range(1, args.nodes + 1))
+
+    #spawn so that the simulator does not inherit the state of this process
+    context = multiprocessing.get_context('spawn')
+    requests = context.Value('L', 0)
+    simulator = context.Process(target=serve, daemon=True,
+            args=(units, 'localhost', port, args.serial, size + 8, requests, args.changing))
+    simulator.start()
+    waitForServer('localhost', port, 10)
+
+    #the handler and the generated code work in the current directory
+    workdir = tempfile.mkdtemp()
+    os.chdir(workdir)
+    plugin_file = os.path.join(workdir, 'benchmark.iox_plugin.json')
+    with open(plugin_file, 'w') as file:
+        json.dump(plugin_json, file)
+    from ioxplugin import Plugin
+    from ModbusProtocolHandler import ModbusProtocolHandler
+    handler = ModbusProtocolHandler(Plugin(plugin_file))
+    handler.host, handler.port, handler.isValidConfig = 'localhost', port, True
+    if not handler.start():
+        raise Exception("could not connect to the simulated devices")
+    for node_id, node in handler.modbus.nodes.items():
+        handler.nodeAdded(BenchmarkNode(node_id, list(node.registers.keys()), handler))
+
+    latencies, cpus, transactions = [], [], []
+    for cycle in range(args.warmup + args.cycles):
+        before = requests.value
+        cpu = time.process_time()
+        start = time.perf_counter()
+        handler.shortPoll()
+        elapsed = time.perf_counter() - start
+        cpu = time.process_time() - cpu
+        if cycle >= args.warmup:
+            latencies.append(elapsed)
+            cpus.append(cpu)
+            transactions.append(requests.value - before)
+        if args.interval > 0:
+            time.sleep(args.interval)
+
+    handler.stop()
+    simulator.terminate()
+    updates = sum([node.updates for node in handler.nodes.values()])
+    return {
+        'engine': args.engine, 'serial': args.serial, 'nodes': args.nodes, 'registers': args.registers, 'gap': args.gap, 'read_gap': args.read_gap,
+        'cycles': args.cycles, 'transactions_per_poll': statistics.mean(transactions),
+        'transactions_per_sec': sum(transactions) / sum(latencies),
+        'p50_ms': percentile(latencies, 50) * 1000, 'p99_ms': percentile(latencies, 99) * 1000,
+        'cpu_ms_per_poll': statistics.mean(cpus) * 1000, 'updates': updates
+    }
+
+#returns the metrics that got worse than the saved results by more than the tolerance
+def compare(results:dict, baseline:dict, tolerance:float)->list:
+    regressions = []
+    for metric in ('p50_ms', 'p99_ms', 'cpu_ms_per_poll', 'transactions_per_poll'):
+        if metric in baseline and baseline[metric] > 0 and results[metric] > baseline[metric] * (1 + tolerance):
+            regressions.append(f"{metric}: {baseline[metric]:.3f} -> {results[metric]:.3f}")
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of modbus poll cycles against simulated devices')
+    parser.add_argument('--nodes', type=int, default=4, help='number of devices, each on its own unit')
+    parser.add_argument('--registers', type=int, default=200, help='registers per device')
+    parser.add_argument('--gap', type=int, default=4, help='the most unused registers between two registers')
+    parser.add_argument('--read-gap', type=int, help='max_read_gap of the protocol (default is the plugin default)')
+    parser.add_argument('--engine', choices=('sync', 'async'), default='sync')
+    parser.add_argument('--serial', action='store_true', help='RTU over a simulated serial line')
+    parser.add_argument('--changing', action='store_true', help='register values keep changing')
+    parser.add_argument('--cycles', type=int, default=50)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--interval', type=float, default=0, help='seconds between polls')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--save', help='save the results to this file')
+    parser.add_argument('--compare', help='compare the results with the ones saved in this file')
+    parser.add_argument('--tolerance', type=float, default=MODBUS_BENCHMARK_TOLERANCE)
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    results = run(args)
+    #udi_interface redirects stdout to its log
+    out = sys.__stdout__
+    print(f"{results['nodes']} nodes x {results['registers']} registers, {results['engine']}{' serial' if results['serial'] else ''}, {results['cycles']} polls", file=out)
+    print(f"  transactions/poll {results['transactions_per_poll']:.1f}  transactions/sec {results['transactions_per_sec']:.0f}", file=out)
+    print(f"  poll p50 {results['p50_ms']:.2f} ms  p99 {results['p99_ms']:.2f} ms  cpu {results['cpu_ms_per_poll']:.2f} ms/poll", file=out)
+    print(f"  updates sent to IoX {results['updates']}", file=out)
+    if args.save:
+        with open(args.save, 'w') as file:
+            json.dump(results, file, indent=2)
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f"  REGRESSION {regression}", file=out)
+        sys.exit(1 if len(regressions) > 0 else 0)
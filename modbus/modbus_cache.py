@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+"""
+Last known good values of modbus registers
+Copyright (C) 2024 Universal Devices
+"""
+import udi_interface
+LOGGER = udi_interface.LOGGER
+import json, os, threading
+from datetime import datetime
+
+MODBUS_CACHE_FILE='modbus_cache.json'
+#values older than this are not served when a device cannot be read. 0 never serves them
+MODBUS_DEFAULT_MAX_STALE_MS=3600000
+
+
+#the key of a master register in the cache file
+def registerKey(register)->str:
+    return f"{register.unit}/{register.register_type}/{register.register_address}"
+
+
+class ModbusValueCache:
+    '''
+        Staleness policy for the last known good values of master registers.
+        The values themselves live in the registers (val and last_good_time)
+        so that reads do not pay for a second copy. When a register cannot be
+        read, its last good value is served if it's not older than
+        max_stale_ms and the properties it serves are flagged stale until the
+        register is read again. Values are saved to disk and loaded at start
+        so that a restart has values to serve before the first poll.
+    '''
+    def __init__(self, max_stale_ms:int=MODBUS_DEFAULT_MAX_STALE_MS, path:str=MODBUS_CACHE_FILE):
+        self.max_stale_ms = max_stale_ms
+        self.path = path
+        #(node id, property id) that were last served from the cache
+        self.stale = set()
+        self._lock = threading.Lock()
+
+    def canServe(self, register)->bool:
+        if self.max_stale_ms <= 0 or register.val == None or register.last_good_time == None:
+            return False
+        return (datetime.now() - register.last_good_time).total_seconds() * 1000 <= self.max_stale_ms
+
+    def setStale(self, node_id:str, property_ids, stale:bool):
+        with self._lock:
+            if stale:
+                self.stale.update([(node_id, property_id) for property_id in property_ids])
+            elif len(self.stale) > 0:
+                self.stale.difference_update([(node_id, property_id) for property_id in property_ids])
+
+    def isStale(self, node_id:str, property_id:str)->bool:
+        return (node_id, property_id) in self.stale
+
+    #the number of properties of the node that were last served from the cache
+    def countStale(self, node_id:str)->int:
+        with self._lock:
+            return len([key for key in self.stale if key[0] == node_id])
+
+    def forget(self, node_id:str):
+        with self._lock:
+            self.stale = set([key for key in self.stale if key[0] != node_id])
+
+    #saves the last good value of the master registers of all nodes {node_id: ModbusIoXNode}
+    def save(self, nodes:dict)->bool:
+        if self.max_stale_ms <= 0:
+            return True
+        try:
+            data = {}
+            for node_id, node in nodes.items():
+                values = {}
+                for register in node.masters.values():
+                    if register.val != None and register.last_good_time != None:
+                        values[registerKey(register)] = [register.val, register.last_good_time.timestamp()]
+                if len(values) > 0:
+                    data[node_id] = values
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as file:
+                json.dump(data, file)
+            os.replace(tmp_path, self.path)
+            return True
+        except Exception as ex:
+            LOGGER.error(f"failed saving the register cache {self.path}: {str(ex)}")
+            return False
+
+    #gives the registers of the nodes the values saved that are still recent enough
+    #they are read again at the first poll and served as stale until then. Returns how many were loaded
+    def load(self, nodes:dict)->int:
+        if self.max_stale_ms <= 0 or not os.path.exists(self.path):
+            return 0
+        try:
+            with open(self.path) as file:
+                data = json.load(file)
+            loaded = 0
+            for node_id, values in data.items():
+                if not node_id in nodes:
+                    continue
+                node = nodes[node_id]
+                for register in node.masters.values():
+                    key = registerKey(register)
+                    if not key in values:
+                        continue
+                    val, timestamp = values[key]
+                    register.val = val
+                    register.last_good_time = datetime.fromtimestamp(timestamp)
+                    if not self.canServe(register):
+                        register.val = None
+                        register.last_good_time = None
+                        continue
+                    self.setStale(node_id, node.getPropertyIds([register]), True)
+                    loaded += 1
+            LOGGER.info(f"loaded {loaded} register values from {self.path}")
+            return loaded
+        except Exception as ex:
+            LOGGER.error(f"ignoring the register cache {self.path}: {str(ex)}")
+            return 0
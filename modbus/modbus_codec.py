@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+"""
+Decodes and encodes register values with precompiled structs
+Copyright (C) 2024 Universal Devices
+"""
+import struct
+
+MODBUS_ORDERS=('big', 'little')
+#struct format for each register data type. string is handled on its own
+MODBUS_STRUCT_FORMATS={'int16':'h', 'uint16':'H', 'int32':'i', 'uint32':'I', 'int64':'q', 'uint64':'Q', 'float32':'f', 'float64':'d'}
+MODBUS_STRING_ENCODING='utf-8'
+
+
+#accepts Endian.BIG/Endian.LITTLE as used in the protocol schema as well as big/little
+def parseOrder(order:str)->str:
+    normalized = str(order).strip().lower()
+    if normalized.startswith('endian.'):
+        normalized = normalized[len('endian.'):]
+    if not normalized in MODBUS_ORDERS:
+        raise Exception(f"{order} is not a valid byte/word order ...")
+    return normalized
+
+def orderPrefix(order:str)->str:
+    return '>' if order == 'big' else '<'
+
+#the registers of a response as they were on the wire: big endian 16 bit words
+def packRegisters(registers)->memoryview:
+    return memoryview(struct.pack(f'>{len(registers)}H', *registers))
+
+def swapBytes(word:int)->int:
+    return ((word & 0xff) << 8) | (word >> 8)
+
+
+class ModbusCodec:
+    '''
+        Decoder and encoder for one register data type, compiled once from the
+        data type and the byte/word order of the protocol. If the bytes on the
+        wire are already in the order of the value (single register, or byte
+        order equal to word order), the value is unpacked straight from the
+        response buffer and field can be used in a struct for a whole block.
+        Otherwise the words are reordered first.
+    '''
+    def __init__(self, data_type:str, num_registers:int, byte_order:str='big', word_order:str='big'):
+        self.data_type = data_type
+        self.num_registers = num_registers
+        self.size = num_registers * 2
+        self.is_string = data_type == 'string'
+        self.byte_order = byte_order
+        self.word_order = word_order
+        self.prefix = orderPrefix(byte_order)
+        char = f'{self.size}s' if self.is_string else MODBUS_STRUCT_FORMATS[data_type]
+        if self.is_string:
+            #strings have no byte order of their own, the bytes are read as they come
+            direct = byte_order == 'big' and word_order == 'big'
+        else:
+            direct = num_registers == 1 or byte_order == word_order
+        #format of this value within a block struct or None if it cannot be unpacked directly
+        self.field = char if direct else None
+        if direct:
+            self.struct = struct.Struct(self.prefix + char)
+        else:
+            self.struct = struct.Struct('>' + char)
+            self._words = struct.Struct(f'>{num_registers}H')
+
+    #decodes the value that starts at offset bytes into the buffer of big endian words
+    def decode(self, buffer, offset:int=0):
+        if self.field != None:
+            return self.value(self.struct.unpack_from(buffer, offset)[0])
+        words = list(self._words.unpack_from(buffer, offset))
+        if self.byte_order == 'little':
+            words = [swapBytes(word) for word in words]
+        if self.word_order == 'little':
+            words.reverse()
+        return self.value(self.struct.unpack(self._words.pack(*words))[0])
+
+    #the value from what the struct unpacked
+    def value(self, raw):
+        if self.is_string:
+            return raw.rstrip(b'\x00').decode(MODBUS_STRING_ENCODING)
+        return raw
+
+    #encodes the value into the registers to be written
+    def encode(self, value)->list:
+        if self.is_string:
+            raw = value.encode(MODBUS_STRING_ENCODING)
+            if len(raw) > self.size:
+                raise Exception(f"{value} does not fit in {self.num_registers} registers")
+            value = raw
+        elif self.data_type.startswith('float'):
+            value = float(value)
+        else:
+            value = int(value)
+        if self.field != None:
+            return list(struct.unpack(f'>{self.num_registers}H', self.struct.pack(value)))
+        words = list(self._words.unpack(self.struct.pack(value)))
+        if self.word_order == 'little':
+            words.reverse()
+        if self.byte_order == 'little':
+            words = [swapBytes(word) for word in words]
+        return words
+
+
+#micro-benchmark of decoding a block with convert_from_registers per register and with one struct
+if __name__ == '__main__':
+    import timeit
+    from pymodbus.client import ModbusTcpClient
+    layout = [('int16', 1), ('uint16', 1), ('int32', 2), ('uint32', 2), ('float32', 2), ('int64', 4), ('uint16', 1)]
+    registers = list(range(1000, 1000 + sum([count for _, count in layout])))
+    def convert():
+        offset = 0
+        values = []
+        for data_type, count in layout:
+            values.append(ModbusTcpClient.convert_from_registers(registers[offset:offset+count], data_type=ModbusTcpClient.DATATYPE[data_type.upper()], word_order='big'))
+            offset += count
+        return values
+    block = struct.Struct('>' + ''.join([ModbusCodec(data_type, count).field for data_type, count in layout]))
+    def unpack():
+        return block.unpack_from(packRegisters(registers))
+    assert convert() == list(unpack())
+    number = 20000
+    for name, function in (('convert_from_registers', convert), ('block struct', unpack)):
+        seconds = min(timeit.repeat(function, number=number, repeat=5))
+        print(f"{name:>22}: {seconds / number * 1e6:.3f} us per block of {len(layout)} registers")
@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+
+"""
+Discovers modbus units and readable register windows behind gateways
+Copyright (C) 2024 Universal Devices
+"""
+import udi_interface
+LOGGER = udi_interface.LOGGER
+import hashlib, ipaddress, json, os, socket, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from iox_to_modbus import readModbusRange
+
+MODBUS_DISCOVERY_DEFAULT_UNITS='1-16'
+#register windows probed on each unit when none are configured
+MODBUS_DISCOVERY_DEFAULT_WINDOWS=[
+    {'register_type': 'holding', 'start': 0, 'count': 128},
+    {'register_type': 'input', 'start': 0, 'count': 128}
+]
+#registers (or bits) read per probe. A window is readable in steps of this many
+MODBUS_DISCOVERY_CHUNK=16
+MODBUS_DISCOVERY_MAX_CONCURRENCY=8
+#seconds to wait for a gateway to accept a connection or a unit to respond
+MODBUS_DISCOVERY_TIMEOUT=1
+#seconds a cached scan of a gateway is used instead of probing it again
+MODBUS_DISCOVERY_CACHE_TTL=86400
+MODBUS_DISCOVERY_CACHE_FILE='modbus_discovery.json'
+MODBUS_DISCOVERY_MAP_FILE='modbus_discovered.iox_plugin.json'
+#the most hosts in one scan so that a typo does not scan a whole network
+MODBUS_DISCOVERY_MAX_HOSTS=1024
+#exception codes from gateways that mean there's no such unit behind them
+MODBUS_GATEWAY_PATH_UNAVAILABLE=0x0a
+MODBUS_GATEWAY_TARGET_FAILED=0x0b
+#properties of a discovered node definition, the drivers GV0 to GV30. Units with more readable registers get more node definitions
+MODBUS_DISCOVERY_MAX_PROPERTIES=31
+MODBUS_DISCOVERY_MAX_PARTS=100
+MODBUS_DISCOVERY_EDITOR={'id': 'modbus_raw', 'min': 0, 'max': 65535, 'uom': 'The raw value as reported by the device | 56', 'precision': 0, 'step': 1}
+
+
+#"1-10,12" -> [1, ..., 10, 12]
+def parseRange(value)->list:
+    if isinstance(value, int):
+        return [value]
+    if isinstance(value, list):
+        return [int(item) for item in value]
+    result = []
+    for part in str(value).split(','):
+        part = part.strip()
+        if part == '':
+            continue
+        if '-' in part:
+            first, last = part.split('-', 1)
+            result.extend(range(int(first), int(last) + 1))
+        else:
+            result.append(int(part))
+    return result
+
+#"192.168.1.0/28", "192.168.1.10-192.168.1.20", "192.168.1.10-20", or hosts separated by commas
+def parseHosts(value)->list:
+    hosts = []
+    parts = value if isinstance(value, list) else str(value).split(',')
+    for part in parts:
+        part = part.strip()
+        if part == '':
+            continue
+        if '/' in part:
+            network = ipaddress.ip_network(part, strict=False)
+            addresses = list(network.hosts()) if network.num_addresses > 1 else [network.network_address]
+            hosts.extend([str(address) for address in addresses])
+        elif '-' in part and part.split('-', 1)[0].count('.') == 3:
+            first, last = part.split('-', 1)
+            first = ipaddress.ip_address(first.strip())
+            if last.strip().isdigit():
+                last = ipaddress.ip_address(str(first).rsplit('.', 1)[0] + '.' + last.strip())
+            else:
+                last = ipaddress.ip_address(last.strip())
+            hosts.extend([str(ipaddress.ip_address(address)) for address in range(int(first), int(last) + 1)])
+        else:
+            hosts.append(part)
+        if len(hosts) > MODBUS_DISCOVERY_MAX_HOSTS:
+            raise Exception(f"{value} has more than {MODBUS_DISCOVERY_MAX_HOSTS} hosts ...")
+    return hosts
+
+#merges contiguous [start, count] windows
+def mergeWindows(windows)->list:
+    merged = []
+    for start, count in sorted(windows):
+        if len(merged) > 0 and merged[-1][0] + merged[-1][1] == start:
+            merged[-1][1] += count
+        else:
+            merged.append([start, count])
+    return merged
+
+
+class ModbusDiscoveryConfig:
+    '''
+        The discovery section in the protocol of the JSON file.
+    '''
+    def __init__(self, config:dict=None, host:str=None, port:int=502):
+        self.hosts = host
+        self.port = port
+        self.units = MODBUS_DISCOVERY_DEFAULT_UNITS
+        self.windows = MODBUS_DISCOVERY_DEFAULT_WINDOWS
+        self.max_concurrency = MODBUS_DISCOVERY_MAX_CONCURRENCY
+        self.timeout = MODBUS_DISCOVERY_TIMEOUT
+        self.cache_ttl = MODBUS_DISCOVERY_CACHE_TTL
+        if config == None:
+            return
+        if 'hosts' in config:
+            self.hosts = config['hosts']
+        if 'port' in config:
+            self.port = int(config['port'])
+        if 'units' in config:
+            self.units = config['units']
+        if 'windows' in config:
+            self.windows = config['windows']
+        if 'max_concurrency' in config:
+            self.max_concurrency = max(1, int(config['max_concurrency']))
+        if 'timeout' in config:
+            self.timeout = float(config['timeout'])
+        if 'cache_ttl' in config:
+            self.cache_ttl = float(config['cache_ttl'])
+
+    def getHosts(self)->list:
+        return parseHosts(self.hosts) if self.hosts else []
+
+    def getUnits(self)->list:
+        return [unit for unit in parseRange(self.units) if 0 < unit < 248]
+
+
+class ModbusDiscovery:
+    '''
+        Scans gateways for units and the register windows they can read.
+        Each (gateway, unit) is probed on its own connection and at most
+        max_concurrency probes run at the same time. Gateways that do not
+        accept a connection are skipped without probing their units.
+        Scans are cached on disk by gateway so that a rescan only probes
+        gateways that were not scanned within cache_ttl seconds.
+        client_factory(host, port, timeout) returns an unconnected sync client.
+    '''
+    def __init__(self, client_factory, config:ModbusDiscoveryConfig, cache_path:str=MODBUS_DISCOVERY_CACHE_FILE):
+        self.client_factory = client_factory
+        self.config = config
+        self.cache_path = cache_path
+        self.cache = self.loadCache()
+        #one scan at a time
+        self._lock = threading.Lock()
+
+    def loadCache(self)->dict:
+        try:
+            if os.path.exists(self.cache_path):
+                with open(self.cache_path) as file:
+                    return json.load(file)
+        except Exception as ex:
+            LOGGER.error(f"ignoring discovery cache {self.cache_path}: {str(ex)}")
+        return {}
+
+    def saveCache(self)->bool:
+        try:
+            tmp_path = self.cache_path + '.tmp'
+            with open(tmp_path, 'w') as file:
+                json.dump(self.cache, file, indent=2)
+            os.replace(tmp_path, self.cache_path)
+            return True
+        except Exception as ex:
+            LOGGER.error(f"failed saving discovery cache {self.cache_path}: {str(ex)}")
+            return False
+
+    def isCached(self, host:str, port:int)->bool:
+        key = f"{host}:{port}"
+        return key in self.cache and time.time() - self.cache[key]['time'] < self.config.cache_ttl
+
+    #returns {'host:port': {'host':..., 'port':..., 'time':..., 'units': {unit: {register type: [[start, count], ...]}}}}
+    #for the configured gateways. force probes gateways even if they are cached
+    def scan(self, force:bool=False)->dict:
+        with self._lock:
+            return self._scan(force)
+
+    def _scan(self, force:bool)->dict:
+        port = self.config.port
+        hosts = self.config.getHosts()
+        units = self.config.getUnits()
+        if len(hosts) == 0 or len(units) == 0:
+            LOGGER.error("discovery needs hosts and units to scan ...")
+            return {}
+        to_scan = [host for host in hosts if force or not self.isCached(host, port)]
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=self.config.max_concurrency, thread_name_prefix='ModbusDiscovery') as executor:
+            alive = [host for host, ok in zip(to_scan, executor.map(lambda host: self.isReachable(host, port), to_scan)) if ok]
+            for host in to_scan:
+                self.cache[f"{host}:{port}"] = {'host': host, 'port': port, 'time': time.time(), 'units': {}}
+            probes = [(host, unit) for host in alive for unit in units]
+            for (host, unit), windows in zip(probes, executor.map(lambda probe: self.probeUnit(probe[0], port, probe[1]), probes)):
+                if windows != None:
+                    self.cache[f"{host}:{port}"]['units'][str(unit)] = windows
+        self.saveCache()
+        LOGGER.info(f"discovery probed {len(to_scan)} of {len(hosts)} gateways ({len(alive)} reachable) in {time.time() - start:.1f} seconds")
+        return {f"{host}:{port}": self.cache[f"{host}:{port}"] for host in hosts if f"{host}:{port}" in self.cache}
+
+    def isReachable(self, host:str, port:int)->bool:
+        try:
+            socket.create_connection((host, port), timeout=self.config.timeout).close()
+            return True
+        except OSError:
+            return False
+
+    #returns the readable windows of the unit or None if the unit does not respond
+    def probeUnit(self, host:str, port:int, unit:int):
+        client = self.client_factory(host, port, self.config.timeout)
+        try:
+            if not client.connect():
+                return None
+            responded = False
+            readable = {}
+            for window in self.config.windows:
+                register_type = window['register_type']
+                first = int(window['start'])
+                end = first + int(window['count'])
+                for address in range(first, end, MODBUS_DISCOVERY_CHUNK):
+                    count = min(MODBUS_DISCOVERY_CHUNK, end - address)
+                    try:
+                        response = readModbusRange(client, register_type, address, count, unit)
+                    except Exception as ex:
+                        response = None
+                    if response == None:
+                        #no response at all: the unit is not there or stopped responding
+                        if not responded:
+                            return None
+                        break
+                    if response.isError():
+                        code = getattr(response, 'exception_code', None)
+                        if code in (MODBUS_GATEWAY_PATH_UNAVAILABLE, MODBUS_GATEWAY_TARGET_FAILED):
+                            return None
+                        responded = True
+                        continue
+                    responded = True
+                    #some devices answer reads past their last register with fewer values instead of an exception
+                    values = response.bits if register_type in ('coil', 'discrete-input') else response.registers
+                    if len(values) < count:
+                        continue
+                    if not register_type in readable:
+                        readable[register_type] = []
+                    readable[register_type].append([address, count])
+            if not responded:
+                return None
+            LOGGER.info(f"discovered unit {unit} @ {host}:{port}")
+            return {register_type: mergeWindows(windows) for register_type, windows in readable.items()}
+        except Exception as ex:
+            LOGGER.error(f"discovery failed for unit {unit} @ {host}:{port}: {str(ex)}")
+            return None
+        finally:
+            client.close()
+
+    #a short id for the node definition of a unit that stays the same across scans: u{unit}_{hash of the gateway}
+    #and _{part} for the parts after the first one, at most 14 characters
+    @staticmethod
+    def getNodeDefId(host:str, port:int, unit:int, part:int=0)->str:
+        digest = hashlib.sha1(f"{host}:{port}".encode()).hexdigest()[:6]
+        return f"u{unit}_{digest}" if part == 0 else f"u{unit}_{digest}_{part}"
+
+    #returns the editors, protocol, and nodedefs of a plugin JSON with node definitions for each unit discovered
+    #and one uint16 property for each readable register, for the user to name, type, and trim before using it.
+    #Each node definition has at most MODBUS_DISCOVERY_MAX_PROPERTIES properties, the gateway is in its name
+    @staticmethod
+    def buildRegisterMap(results:dict)->dict:
+        nodedefs = []
+        gateways = {}
+        for _, gateway in sorted(results.items()):
+            for unit, windows in sorted(gateway['units'].items(), key=lambda item: int(item[0])):
+                registers = []
+                for register_type, ranges in windows.items():
+                    for start, count in ranges:
+                        registers.extend([(register_type, address) for address in range(start, start + count)])
+                parts = (len(registers) + MODBUS_DISCOVERY_MAX_PROPERTIES - 1) // MODBUS_DISCOVERY_MAX_PROPERTIES
+                if parts > MODBUS_DISCOVERY_MAX_PARTS:
+                    LOGGER.warning(f"unit {unit} @ {gateway['host']} has {len(registers)} readable registers, only the first {MODBUS_DISCOVERY_MAX_PARTS * MODBUS_DISCOVERY_MAX_PROPERTIES} are in the map ...")
+                    parts = MODBUS_DISCOVERY_MAX_PARTS
+                for part in range(parts):
+                    properties = []
+                    for register_type, address in registers[part * MODBUS_DISCOVERY_MAX_PROPERTIES:(part + 1) * MODBUS_DISCOVERY_MAX_PROPERTIES]:
+                        properties.append({
+                            'id': f"{register_type.capitalize()} {address} | GV{len(properties)}",
+                            'name': f"{register_type.capitalize()} {address}",
+                            'editor': {'idref': MODBUS_DISCOVERY_EDITOR['id']},
+                            'protocol': {
+                                'unit': int(unit),
+                                'register_address': f"0x{address:04x}",
+                                'register_data_type': 'uint16',
+                                'register_type': register_type
+                            },
+                            'is_settable': False
+                        })
+                    nodedef_id = ModbusDiscovery.getNodeDefId(gateway['host'], gateway['port'], unit, part)
+                    name = f"Unit {unit} @ {gateway['host']}" if parts == 1 else f"Unit {unit} @ {gateway['host']} ({part + 1}/{parts})"
+                    nodedefs.append({'id': nodedef_id, 'name': name, 'icon': 'GenericCtl', 'properties': properties})
+                    gateways[nodedef_id] = {'host': gateway['host'], 'port': gateway['port']}
+        return {
+            'editors': [MODBUS_DISCOVERY_EDITOR],
+            'protocol': {'name': 'Modbus', 'config': {'gateways': gateways}},
+            'nodedefs': nodedefs
+        }
+
+    def saveRegisterMap(self, results:dict, path:str=MODBUS_DISCOVERY_MAP_FILE)->bool:
+        try:
+            with open(path, 'w') as file:
+                json.dump(ModbusDiscovery.buildRegisterMap(results), file, indent=2)
+            return True
+        except Exception as ex:
+            LOGGER.error(f"failed saving the discovered register map {path}: {str(ex)}")
+            return False
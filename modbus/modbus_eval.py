@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+"""
+Compiles the eval expressions used to scale register values
+Copyright (C) 2024 Universal Devices
+"""
+import ast
+
+#the only functions an expression can call
+MODBUS_EVAL_FUNCTIONS={'min':min, 'max':max, 'round':round, 'abs':abs, 'int':int, 'float':float}
+#the largest constant exponent allowed with **
+MODBUS_EVAL_MAX_EXPONENT=64
+
+MODBUS_EVAL_NODES=(
+    ast.Expression, ast.Load, ast.Constant, ast.Name, ast.Call,
+    ast.BinOp, ast.UnaryOp, ast.BoolOp, ast.Compare, ast.IfExp,
+    #arithmetic
+    ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow, ast.UAdd, ast.USub,
+    #bit operations
+    ast.BitAnd, ast.BitOr, ast.BitXor, ast.LShift, ast.RShift, ast.Invert,
+    #comparisons and conditions
+    ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE, ast.And, ast.Or, ast.Not
+)
+
+
+class ModbusExpression:
+    '''
+        An eval expression from the protocol data, parsed and checked once
+        and compiled into a function of the raw register value. {rval} in
+        the expression is the raw register value. Only arithmetic, bit
+        operations, comparisons, conditional expressions, numbers, and the
+        functions in MODBUS_EVAL_FUNCTIONS are allowed.
+    '''
+    def __init__(self, source:str):
+        if source == None or len(source.strip()) == 0:
+            raise Exception("Need an eval expression ...")
+        self.source = source
+        try:
+            tree = ast.parse(source.replace('{rval}', 'rval').strip(), mode='eval')
+        except SyntaxError as ex:
+            raise Exception(f"{source} is not a valid eval expression: {ex.msg}")
+        self._validate(tree)
+        function = ast.Expression(body=ast.Lambda(
+            args=ast.arguments(posonlyargs=[], args=[ast.arg(arg='rval')], kwonlyargs=[], kw_defaults=[], defaults=[]),
+            body=tree.body))
+        ast.fix_missing_locations(function)
+        globals = {'__builtins__': {}}
+        globals.update(MODBUS_EVAL_FUNCTIONS)
+        self._function = eval(compile(function, '<modbus eval>', 'eval'), globals)
+
+    def _validate(self, tree):
+        for node in ast.walk(tree):
+            if not isinstance(node, MODBUS_EVAL_NODES):
+                raise Exception(f"{type(node).__name__} is not allowed in eval expression {self.source}")
+            if isinstance(node, ast.Constant) and not isinstance(node.value, (int, float)):
+                raise Exception(f"only numbers are allowed in eval expression {self.source}")
+            if isinstance(node, ast.Name) and node.id != 'rval' and not node.id in MODBUS_EVAL_FUNCTIONS:
+                raise Exception(f"{node.id} is not allowed in eval expression {self.source}")
+            if isinstance(node, ast.Call):
+                if not isinstance(node.func, ast.Name) or not node.func.id in MODBUS_EVAL_FUNCTIONS or len(node.keywords) > 0:
+                    raise Exception(f"only calls to {', '.join(MODBUS_EVAL_FUNCTIONS)} are allowed in eval expression {self.source}")
+            if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Pow):
+                if not isinstance(node.right, ast.Constant) or abs(node.right.value) > MODBUS_EVAL_MAX_EXPONENT:
+                    raise Exception(f"the exponent must be a number up to {MODBUS_EVAL_MAX_EXPONENT} in eval expression {self.source}")
+
+    def evaluate(self, rval):
+        return self._function(rval)
+
+
+#micro-benchmark of the per read cost of the old string substitution + eval and the compiled expression
+if __name__ == '__main__':
+    import timeit
+    source = "({rval} - 27300) / 100"
+    rval = 29815
+    def old_style():
+        eeval = source.replace('{rval}', f'{rval}')
+        unsafe_array = ['return','def','class','import', 'as', 'from', 'os', 'json', 'with', 'file', 'for', 'while', 'url', 'requests']
+        for unsafe in unsafe_array:
+            if unsafe in eeval:
+                return None
+        return eval(eeval)
+    expression = ModbusExpression(source)
+    number = 100000
+    for name, function in (('string + eval', old_style), ('compiled', lambda: expression.evaluate(rval))):
+        seconds = min(timeit.repeat(function, number=number, repeat=5))
+        print(f"{name:>15}: {seconds / number * 1e6:.3f} us per read")
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+"""
+Adaptive request timeout and circuit breaker of a modbus gateway
+Copyright (C) 2024 Universal Devices
+"""
+import udi_interface
+LOGGER = udi_interface.LOGGER
+import collections, threading, time
+
+#round trip times kept to compute the timeout
+MODBUS_RTT_SAMPLES=100
+#until there are this many round trip times, the timeout is the configured one
+MODBUS_RTT_MIN_SAMPLES=10
+#the timeout is this many times the 99th percentile of the round trip times, within the bounds
+MODBUS_TIMEOUT_RTT_FACTOR=4
+MODBUS_MIN_TIMEOUT=0.5
+#consecutive failures (no response, or no connection) that open the breaker
+MODBUS_BREAKER_THRESHOLD=3
+#seconds the breaker stays open: doubles each time it opens again without a success in between
+MODBUS_BREAKER_WINDOW_MIN=5
+MODBUS_BREAKER_WINDOW_MAX=600
+
+
+class ModbusGatewayHealth:
+    '''
+        Health of a gateway (host, port) shared by all the units behind it.
+        The request timeout adapts to the round trip times of the gateway:
+        a multiple of their 99th percentile, at most max_timeout. After
+        MODBUS_BREAKER_THRESHOLD consecutive failures the breaker opens and
+        the gateway is not polled for a window that doubles each time it
+        opens again. Once the window is over, the breaker is half open: one
+        request goes through as a probe while the others are still rejected,
+        and its success closes the breaker while its failure opens it again
+        right away.
+    '''
+    def __init__(self, name:str, max_timeout:float):
+        self.name = name
+        self.max_timeout = max_timeout
+        self.rtts = collections.deque(maxlen=MODBUS_RTT_SAMPLES)
+        self.failures = 0
+        self.trips = 0
+        self.open_until = 0
+        #until when the probe of the half open breaker is waited for
+        self.probe_until = 0
+        self._timeout = max_timeout
+        self._lock = threading.Lock()
+
+    def isOpen(self)->bool:
+        return time.monotonic() < self.open_until
+
+    #whether a request can be sent to the gateway. When the breaker is half open, only the
+    #first caller is let through until it succeeds or fails, or it's been twice the timeout
+    def allowRequest(self)->bool:
+        with self._lock:
+            now = time.monotonic()
+            if now < self.open_until:
+                return False
+            if self.trips == 0:
+                return True
+            if now < self.probe_until:
+                return False
+            self.probe_until = now + self._timeout * 2
+            LOGGER.info(f"probing modbus gateway @ {self.name}")
+            return True
+
+    #seconds to wait for a response from this gateway
+    def timeout(self)->float:
+        return self._timeout
+
+    #the gateway responded in seconds, even if with an error
+    def succeeded(self, seconds:float):
+        with self._lock:
+            self.rtts.append(seconds)
+            if self.trips > 0:
+                LOGGER.info(f"modbus gateway @ {self.name} is responding again, closing the breaker")
+            self.failures = 0
+            self.trips = 0
+            self.open_until = 0
+            self.probe_until = 0
+            if len(self.rtts) >= MODBUS_RTT_MIN_SAMPLES:
+                rtts = sorted(self.rtts)
+                p99 = rtts[min(len(rtts) - 1, int(len(rtts) * 0.99))]
+                self._timeout = min(self.max_timeout, max(MODBUS_MIN_TIMEOUT, p99 * MODBUS_TIMEOUT_RTT_FACTOR))
+
+    #the gateway did not respond or could not be connected to
+    def failed(self):
+        with self._lock:
+            self.failures += 1
+            self.probe_until = 0
+            if self.failures < MODBUS_BREAKER_THRESHOLD or self.isOpen():
+                return
+            window = min(MODBUS_BREAKER_WINDOW_MAX, MODBUS_BREAKER_WINDOW_MIN * pow(2, self.trips))
+            self.trips += 1
+            self.open_until = time.monotonic() + window
+            LOGGER.warning(f"modbus gateway @ {self.name} failed {self.failures} times in a row ... not polling it for {window} seconds")
+
+    def toDict(self)->dict:
+        return {'timeout': round(self._timeout, 3), 'failures': self.failures, 'trips': self.trips, 'open': self.isOpen()}
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+
+"""
+Latency histograms, errors, timeouts, and reconnects of modbus devices
+Copyright (C) 2024 Universal Devices
+"""
+import udi_interface
+LOGGER = udi_interface.LOGGER
+import bisect, json, os, threading, time
+from ioxplugin.node_properties import NodePropertyDetails
+
+#upper bounds in milliseconds of the latency buckets. Anything slower goes in the last one
+MODBUS_LATENCY_BUCKETS_MS=(5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+MODBUS_METRICS_FILE='modbus_metrics.json'
+#seconds between dumps of the metrics to MODBUS_METRICS_FILE. 0 does not dump them
+MODBUS_DEFAULT_METRICS_INTERVAL=300
+#drivers of the controller node, see addMetricsProperties. Counters are totals since the plugin started.
+#Stale Values is the number of properties served from the last known good values, see ModbusValueCache
+MODBUS_METRICS_DRIVERS=[
+    {'driver': 'GV0', 'value': 0, 'uom': 42, 'name': 'Last Poll Time'},
+    {'driver': 'GV1', 'value': 0, 'uom': 42, 'name': 'Request Time p99'},
+    {'driver': 'GV2', 'value': 0, 'uom': 56, 'name': 'Errors'},
+    {'driver': 'GV3', 'value': 0, 'uom': 56, 'name': 'Timeouts'},
+    {'driver': 'GV4', 'value': 0, 'uom': 56, 'name': 'Reconnects'},
+    {'driver': 'GV5', 'value': 0, 'uom': 56, 'name': 'Stale Values'}
+]
+#driver of each device node with the number of its properties served from the last known good values
+MODBUS_STALE_DRIVER={'driver': 'ERR', 'value': 0, 'uom': 56, 'name': 'Stale Values'}
+#the editors of the metrics drivers by uom
+MODBUS_METRICS_EDITORS={
+    42: {'id': 'modbus_metric_ms', 'min': 0, 'max': 2147483647, 'uom': 'Milliseconds | 42', 'precision': 0},
+    56: {'id': 'modbus_metric_count', 'min': 0, 'max': 2147483647, 'uom': 'Raw Value | 56', 'precision': 0}
+}
+
+
+#adds the metrics drivers to the controller node definition of the plugin and the stale values driver to
+#the device node definitions so that the profile sent to IoX and the nodes have them. Call it before
+#plugin.toIoX() and before the register map is built from the plugin
+def addMetricsProperties(plugin)->bool:
+    try:
+        controller = plugin.nodedefs.getControllerNodeDef() if plugin.nodedefs != None else None
+        if controller == None:
+            LOGGER.error('the plugin has no controller node definition for the metrics ...')
+            return False
+        for editor in MODBUS_METRICS_EDITORS.values():
+            if not editor['id'] in plugin.editors.editors:
+                plugin.editors.addEditor(editor)
+        for driver in MODBUS_METRICS_DRIVERS:
+            addMetricsProperty(controller, driver)
+        for nodedef in plugin.nodedefs.getNodeDefs().values():
+            if not nodedef.isController and not addMetricsProperty(nodedef, MODBUS_STALE_DRIVER):
+                LOGGER.warning(f"{nodedef.id} has its own {MODBUS_STALE_DRIVER['driver']} property, its stale values are not shown ...")
+        return True
+    except Exception as ex:
+        LOGGER.error(f"adding the metrics to the controller failed: {str(ex)}")
+        return False
+
+#returns False if the node definition already has a property with the id of the driver
+def addMetricsProperty(nodedef, driver:dict)->bool:
+    properties = nodedef.properties.node_properties
+    if driver['driver'] in properties:
+        return properties[driver['driver']].name == driver['name']
+    properties[driver['driver']] = NodePropertyDetails({
+        'id': f"{driver['name']} | {driver['driver']}",
+        'name': driver['name'],
+        'editor': {'idref': MODBUS_METRICS_EDITORS[driver['uom']]['id']},
+        'is_settable': False
+    })
+    return True
+
+
+class ModbusLatencyHistogram:
+    '''
+        Counts of latencies per bucket of MODBUS_LATENCY_BUCKETS_MS with the
+        total and the maximum. Percentiles are the upper bound of the bucket
+        they fall in.
+    '''
+    def __init__(self):
+        self.buckets = [0] * (len(MODBUS_LATENCY_BUCKETS_MS) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, ms:float):
+        self.buckets[bisect.bisect_left(MODBUS_LATENCY_BUCKETS_MS, ms)] += 1
+        self.count += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    def percentile(self, p:float)->float:
+        if self.count == 0:
+            return 0
+        rank = p / 100 * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank and count > 0:
+                return MODBUS_LATENCY_BUCKETS_MS[index] if index < len(MODBUS_LATENCY_BUCKETS_MS) else self.max_ms
+        return self.max_ms
+
+    def toDict(self)->dict:
+        return {
+            'count': self.count,
+            'avg_ms': round(self.total_ms / self.count, 2) if self.count else 0,
+            'p50_ms': self.percentile(50),
+            'p99_ms': self.percentile(99),
+            'max_ms': round(self.max_ms, 2),
+            'buckets': dict(zip([f"<={bound}" for bound in MODBUS_LATENCY_BUCKETS_MS] + ['more'], self.buckets))
+        }
+
+
+class ModbusRequestMetrics:
+    '''
+        Latency and outcomes of the requests for one range of registers or for a whole device.
+    '''
+    def __init__(self):
+        self.latency = ModbusLatencyHistogram()
+        self.errors = 0
+        self.timeouts = 0
+        self.last_error = None
+
+    #result is True if it succeeded, False if the device returned an error, and None if it did not respond
+    def record(self, ms:float, result):
+        self.latency.observe(ms)
+        if result == None:
+            self.timeouts += 1
+            self.last_error = time.time()
+        elif not result:
+            self.errors += 1
+            self.last_error = time.time()
+
+    def toDict(self)->dict:
+        return {'latency': self.latency.toDict(), 'errors': self.errors, 'timeouts': self.timeouts, 'last_error': self.last_error}
+
+
+class ModbusDeviceMetrics(ModbusRequestMetrics):
+    '''
+        Metrics of a unit behind a gateway and of each range of registers read from it.
+    '''
+    def __init__(self):
+        super().__init__()
+        self.reconnects = 0
+        self.connect_failures = 0
+        self.registers = {}
+
+    def recordRange(self, register_type:str, address:int, count:int, ms:float, result):
+        self.record(ms, result)
+        key = f"{register_type} {address}+{count}"
+        if not key in self.registers:
+            self.registers[key] = ModbusRequestMetrics()
+        self.registers[key].record(ms, result)
+
+    def toDict(self)->dict:
+        device = super().toDict()
+        device['reconnects'] = self.reconnects
+        device['connect_failures'] = self.connect_failures
+        device['registers'] = {key: metrics.toDict() for key, metrics in self.registers.items()}
+        return device
+
+
+class ModbusMetrics:
+    '''
+        Metrics of all devices keyed by (host, port, unit) and of the poll
+        cycles. Recording is thread safe so the sync pool, the async engine,
+        and the write queue can all record into the same metrics.
+    '''
+    def __init__(self):
+        self.devices = {}
+        self.polls = ModbusLatencyHistogram()
+        self.last_poll_ms = 0
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def getDevice(self, host:str, port:int, unit:int)->ModbusDeviceMetrics:
+        key = (host, port, unit)
+        if not key in self.devices:
+            self.devices[key] = ModbusDeviceMetrics()
+        return self.devices[key]
+
+    #a request for count registers (or bits) at address that took seconds. See ModbusRequestMetrics.record for result
+    def recordRequest(self, host:str, port:int, unit:int, register_type:str, address:int, count:int, seconds:float, result):
+        with self._lock:
+            self.getDevice(host, port, unit).recordRange(register_type, address, count, seconds * 1000, result)
+
+    def recordConnect(self, host:str, port:int, unit:int, connected:bool, reconnect:bool=True):
+        with self._lock:
+            device = self.getDevice(host, port, unit)
+            if not connected:
+                device.connect_failures += 1
+            elif reconnect:
+                device.reconnects += 1
+
+    def recordPoll(self, seconds:float):
+        with self._lock:
+            self.last_poll_ms = seconds * 1000
+            self.polls.observe(self.last_poll_ms)
+
+    #totals across all devices for the controller drivers
+    def getSummary(self)->dict:
+        with self._lock:
+            latency = ModbusLatencyHistogram()
+            errors = timeouts = reconnects = 0
+            for device in self.devices.values():
+                for index, count in enumerate(device.latency.buckets):
+                    latency.buckets[index] += count
+                latency.count += device.latency.count
+                latency.max_ms = max(latency.max_ms, device.latency.max_ms)
+                errors += device.errors
+                timeouts += device.timeouts
+                reconnects += device.reconnects
+            return {
+                'GV0': round(self.last_poll_ms),
+                'GV1': round(latency.percentile(99)),
+                'GV2': errors,
+                'GV3': timeouts,
+                'GV4': reconnects
+            }
+
+    def toDict(self)->dict:
+        with self._lock:
+            return {
+                'time': time.time(),
+                'uptime': round(time.time() - self.started),
+                'polls': self.polls.toDict(),
+                'last_poll_ms': round(self.last_poll_ms, 2),
+                'devices': {f"{host}:{port}/{unit}": device.toDict() for (host, port, unit), device in self.devices.items()}
+            }
+
+    def dump(self, path:str=MODBUS_METRICS_FILE)->bool:
+        try:
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'w') as file:
+                json.dump(self.toDict(), file, indent=2)
+            os.replace(tmp_path, path)
+            return True
+        except Exception as ex:
+            LOGGER.error(f"failed dumping modbus metrics to {path}: {str(ex)}")
+            return False
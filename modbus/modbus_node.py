@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+"""
+Node whose drivers and commands come from the register map at runtime
+Copyright (C) 2024 Universal Devices
+"""
+import udi_interface
+LOGGER = udi_interface.LOGGER
+import json
+
+
+class ModbusGenericNode(udi_interface.Node):
+    '''
+        Stands in for the generated node classes. Drivers are the properties
+        of the ModbusIoXNode at the address and every settable property is a
+        command, so one class serves all node definitions, every device that
+        shares one at a different unit, and register maps uploaded while the
+        plugin runs. The node definition in the profile is still generated
+        from the plugin file.
+    '''
+    def __init__(self, polyglot, protocolHandler, primary:str, address:str, name:str):
+        #the node definition and the drivers are looked up before Node copies them
+        self.id = protocolHandler.getNodeDefId(address)
+        self.drivers = protocolHandler.getDrivers(address)
+        super().__init__(polyglot, primary, address, name)
+        self.protocolHandler = protocolHandler
+        self.commands = self.getCommands(protocolHandler.getSettable(address))
+
+    def setProtocolHandler(self, protocolHandler):
+        self.protocolHandler = protocolHandler
+
+    #runCmd calls the commands with the node, like the methods of the generated classes
+    @staticmethod
+    def getCommands(settable)->dict:
+        commands = {property_id: ModbusGenericNode.setProperty for property_id in settable}
+        commands['QUERY'] = ModbusGenericNode.queryCommand
+        return commands
+
+    #takes the drivers and commands of a new register map. The node needs to be added again for PG3 to get them
+    def setRegisterMap(self, nodedef_id:str, drivers, settable):
+        values = {driver['driver']: driver['value'] for driver in self.drivers}
+        self.id = nodedef_id
+        self.drivers = [dict(driver, value=values[driver['driver']]) if driver['driver'] in values else dict(driver) for driver in drivers]
+        self.commands = self.getCommands(settable)
+
+    def getUOM(self, property_id:str):
+        for driver in self.drivers:
+            if driver['driver'] == property_id:
+                return driver['uom']
+        return None
+
+    def queryAll(self):
+        if not self.protocolHandler:
+            return
+        for property_id, val in self.protocolHandler.queryProperties(self, [driver['driver'] for driver in self.drivers]).items():
+            if val != None:
+                self.setDriver(property_id, val, force=True)
+
+    def queryCommand(self, command):
+        if self.protocolHandler:
+            return self.protocolHandler.processCommand(self, 'Query')
+        return False
+
+    #the value is in the query of the command as {property id}.uom{uom} or in its value
+    def setProperty(self, command):
+        try:
+            property_id = command['cmd']
+            value = None
+            if 'query' in command and command['query']:
+                query = json.loads(str(command['query']).replace("'", '"'))
+                key = f"{property_id}.uom{self.getUOM(property_id)}"
+                if key in query:
+                    value = query[key]
+            if value == None and 'value' in command:
+                value = command['value']
+            if value == None:
+                LOGGER.error(f'no value to set {property_id} ... ')
+                return False
+            value = float(value)
+            if value.is_integer():
+                value = int(value)
+            if self.protocolHandler:
+                if self.protocolHandler.setProperty(self, property_id, value):
+                    self.setDriver(property_id, value, force=True)
+                    return True
+            return False
+        except Exception as ex:
+            LOGGER.error(f'failed parsing parameters ... ')
+            return False
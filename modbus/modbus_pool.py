@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+
+"""
+Pool of modbus connections keyed by gateway (host, port) and unit
+Copyright (C) 2024 Universal Devices
+"""
+import udi_interface
+LOGGER = udi_interface.LOGGER
+import time, threading
+from modbus_gateway import ModbusGatewayHealth
+
+#seconds of inactivity after which a connection is closed
+MODBUS_DEFAULT_IDLE_TIMEOUT=300
+#reconnect backoff in seconds: doubles after each failure up to the max
+MODBUS_RECONNECT_BACKOFF_MIN=1
+MODBUS_RECONNECT_BACKOFF_MAX=300
+#seconds to wait for a gateway until its round trip times are known, see ModbusGatewayHealth
+MODBUS_DEFAULT_REQUEST_TIMEOUT=3
+
+
+class ModbusConnection:
+    '''
+        A client to one unit behind a gateway and the bookkeeping needed to
+        reuse it across polls, close it when idle, and reconnect it with
+        backoff when it fails. The client object lives as long as the
+        connection so registers can keep a reference to it.
+    '''
+    def __init__(self, key:tuple, client, lock=None):
+        self.key = key
+        self.client = client
+        self.last_used = time.monotonic()
+        self.failures = 0
+        self.retry_at = 0
+        #successful connects, anything after the first one is a reconnect
+        self.connects = 0
+        #sync clients are not thread safe. Units on the same serial line share the lock of the line
+        self.lock = lock if lock != None else threading.RLock()
+
+    def __str__(self):
+        return f"{self.key[0]}:{self.key[1]}/{self.key[2]}"
+
+    def isConnected(self)->bool:
+        return True if (self.client and self.client.connected) else False
+
+    #whether or not we are out of the backoff window
+    def canConnect(self)->bool:
+        return time.monotonic() >= self.retry_at
+
+    def touch(self):
+        self.last_used = time.monotonic()
+
+    def isIdle(self, idle_timeout:float)->bool:
+        return (time.monotonic() - self.last_used) >= idle_timeout
+
+    def connected(self):
+        if self.failures > 0:
+            LOGGER.info(f"reconnected to modbus server @ {self} after {self.failures} failures")
+        self.failures = 0
+        self.retry_at = 0
+        self.connects += 1
+        self.touch()
+
+    def failed(self):
+        self.failures += 1
+        delay = min(MODBUS_RECONNECT_BACKOFF_MAX, MODBUS_RECONNECT_BACKOFF_MIN * pow(2, self.failures - 1))
+        self.retry_at = time.monotonic() + delay
+        LOGGER.warning(f"modbus server @ {self} failed ({self.failures}) ... next attempt in {delay} seconds")
+        self.close()
+
+    def close(self):
+        try:
+            if self.client:
+                self.client.close()
+        except Exception as ex:
+            LOGGER.error(str(ex))
+
+
+class ModbusConnectionPool:
+    '''
+        Creates connections on first use with client_factory(host, port) and keeps
+        them for reuse. Connecting is left to the caller for async clients,
+        getClient does it for sync clients. If there's a lock, all connections
+        share it, for instance because all units are on the same serial line.
+        If there are metrics, connects and failures to connect are recorded.
+        Each gateway (host, port) has its own request timeout and circuit
+        breaker: while the breaker is open, connections to the gateway are
+        not used so that other gateways keep their poll rate.
+    '''
+    def __init__(self, client_factory, idle_timeout:float=MODBUS_DEFAULT_IDLE_TIMEOUT, lock=None, metrics=None,
+            request_timeout:float=MODBUS_DEFAULT_REQUEST_TIMEOUT):
+        self.client_factory = client_factory
+        self.idle_timeout = idle_timeout
+        self.lock = lock
+        self.metrics = metrics
+        self.request_timeout = request_timeout
+        self.connections = {}
+        self.gateways = {}
+        self._lock = threading.Lock()
+
+    def getConnection(self, host:str, port:int, unit:int)->ModbusConnection:
+        key = (host, port, unit)
+        with self._lock:
+            if not key in self.connections:
+                self.connections[key] = ModbusConnection(key, self.client_factory(host, port), self.lock)
+            return self.connections[key]
+
+    def getGateway(self, host:str, port:int)->ModbusGatewayHealth:
+        key = (host, port)
+        with self._lock:
+            if not key in self.gateways:
+                self.gateways[key] = ModbusGatewayHealth(f"{host}:{port}", self.request_timeout)
+            return self.gateways[key]
+
+    #seconds to wait for the gateway to connect or respond
+    def getTimeout(self, host:str, port:int)->float:
+        return self.getGateway(host, port).timeout()
+
+    #whether or not the breaker of the gateway of the connection lets a request through
+    def canUse(self, connection:ModbusConnection)->bool:
+        return self.getGateway(connection.key[0], connection.key[1]).allowRequest()
+
+    #returns a connected sync client or None if it cannot connect or it's backing off
+    def getClient(self, host:str, port:int, unit:int):
+        connection = self.getConnection(host, port, unit)
+        if self.connect(connection):
+            return connection.client
+        return None
+
+    def connect(self, connection:ModbusConnection)->bool:
+        if not self.canUse(connection):
+            return False
+        with connection.lock:
+            #sync clients wait comm_params.timeout_connect both to connect and for a response
+            connection.client.comm_params.timeout_connect = self.getTimeout(connection.key[0], connection.key[1])
+            if connection.isConnected():
+                connection.touch()
+                return True
+            if not connection.canConnect():
+                return False
+            try:
+                if connection.client.connect():
+                    LOGGER.info(f"connected to modbus server @ {connection}")
+                    self.connected(connection)
+                    return True
+            except Exception as ex:
+                LOGGER.error(str(ex))
+            self.failed(connection)
+            return False
+
+    def connected(self, connection:ModbusConnection):
+        if self.metrics != None:
+            self.metrics.recordConnect(*connection.key, True, connection.connects > 0)
+        connection.connected()
+
+    #the connection could not be established or the device did not respond
+    def failed(self, connection:ModbusConnection):
+        if self.metrics != None:
+            self.metrics.recordConnect(*connection.key, False)
+        self.getGateway(connection.key[0], connection.key[1]).failed()
+        connection.failed()
+
+    #a request for count registers (or bits) at address that took seconds. See ModbusRequestMetrics.record for result
+    #timeouts are reported with failed since they also close the connection
+    def recordRequest(self, host:str, port:int, unit:int, register_type:str, address:int, count:int, seconds:float, result):
+        if self.metrics != None:
+            self.metrics.recordRequest(host, port, unit, register_type, address, count, seconds, result)
+        if result != None:
+            self.getGateway(host, port).succeeded(seconds)
+
+    def isConnected(self)->bool:
+        with self._lock:
+            connections = list(self.connections.values())
+        for connection in connections:
+            if connection.isConnected():
+                return True
+        return False
+
+    #closes the connections that were not used within idle timeout and returns them
+    def reap(self)->[]:
+        reaped = []
+        with self._lock:
+            for key, connection in list(self.connections.items()):
+                if connection.isConnected() and connection.isIdle(self.idle_timeout):
+                    reaped.append(connection)
+        for connection in reaped:
+            LOGGER.info(f"closing idle connection to modbus server @ {connection}")
+            connection.close()
+        return reaped
+
+    def closeAll(self):
+        with self._lock:
+            connections = list(self.connections.values())
+        for connection in connections:
+            connection.close()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+"""
+Decides which values read from registers are worth reporting to IoX
+Copyright (C) 2024 Universal Devices
+"""
+import threading, time
+
+#a property is reported at least this often even if it did not change. 0 disables the heartbeat
+MODBUS_DEFAULT_MAX_SILENCE_MS=600000
+
+
+class ModbusReportFilter:
+    '''
+        Keeps the last value reported for each (node address, property id) and
+        only lets a new value through if it moved beyond the deadbands of the
+        register or if the property has been silent for longer than its max
+        silence. A value has to exceed every deadband that is configured:
+        deadband (absolute, in reported units) and deadband_percent (of the
+        last reported value).
+    '''
+    def __init__(self, max_silence_ms:int=MODBUS_DEFAULT_MAX_SILENCE_MS):
+        self.max_silence_ms = max_silence_ms
+        self._last = {}
+        self._lock = threading.Lock()
+
+    def shouldReport(self, address:str, property_id:str, value, register=None, force:bool=False)->bool:
+        key = (address, property_id)
+        now = time.monotonic()
+        with self._lock:
+            if not force and key in self._last:
+                last_value, last_time = self._last[key]
+                max_silence_ms = self.max_silence_ms
+                if register != None and register.max_silence_ms != None:
+                    max_silence_ms = register.max_silence_ms
+                silent = max_silence_ms and (now - last_time) * 1000 >= max_silence_ms
+                if not silent and not self.changed(last_value, value, register):
+                    return False
+            self._last[key] = (value, now)
+            return True
+
+    @staticmethod
+    def changed(last_value, value, register=None)->bool:
+        if isinstance(value, bool) or isinstance(last_value, bool) or \
+           not isinstance(value, (int, float)) or not isinstance(last_value, (int, float)):
+            return value != last_value
+        delta = abs(value - last_value)
+        if delta == 0:
+            return False
+        if register == None:
+            return True
+        if register.deadband and delta <= register.deadband:
+            return False
+        if register.deadband_percent and delta <= abs(last_value) * register.deadband_percent / 100:
+            return False
+        return True
+
+    #forget what was reported for a node so that its next values are all reported
+    def forget(self, address:str):
+        with self._lock:
+            for key in [key for key in self._last if key[0] == address]:
+                del self._last[key]
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+"""
+Schedules the registers that have their own poll interval
+Copyright (C) 2024 Universal Devices
+"""
+import udi_interface
+LOGGER = udi_interface.LOGGER
+import heapq, itertools, threading, time
+
+#registers due within this many seconds of each other are read together
+MODBUS_SCHEDULER_BATCH_WINDOW=0.05
+
+
+class ModbusPollScheduler:
+    '''
+        Priority queue of registers keyed by the time they are due next.
+        A thread waits for the earliest due time, pops everything that is due
+        (within the batch window) and calls callback(node_id, [registers])
+        once per node so the registers can be read together.
+    '''
+    def __init__(self, callback):
+        self.callback = callback
+        self._queue = []
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._running = False
+        self._thread = None
+
+    def add(self, node_id:str, register):
+        if not register.poll_interval_ms:
+            return
+        with self._lock:
+            heapq.heappush(self._queue, (time.monotonic(), next(self._sequence), node_id, register))
+        self._wakeup.set()
+
+    def size(self)->int:
+        return len(self._queue)
+
+    #removes all registers, for instance because the register map was replaced
+    def clear(self):
+        with self._lock:
+            self._queue = []
+        self._wakeup.set()
+
+    #seconds until the next register is due or None if there's nothing scheduled
+    def nextDue(self, now:float):
+        with self._lock:
+            if len(self._queue) == 0:
+                return None
+            return max(0, self._queue[0][0] - now)
+
+    #removes the due registers, reschedules them, and returns them grouped by node {node_id:[registers]}
+    def popDue(self, now:float)->dict:
+        due = {}
+        with self._lock:
+            while len(self._queue) > 0 and self._queue[0][0] <= now + MODBUS_SCHEDULER_BATCH_WINDOW:
+                due_time, _, node_id, register = heapq.heappop(self._queue)
+                if not node_id in due:
+                    due[node_id] = []
+                due[node_id].append(register)
+                #if we fell behind, skip the missed cycles instead of bursting
+                next_due = due_time + register.poll_interval_ms / 1000
+                if next_due < now:
+                    next_due = now + register.poll_interval_ms / 1000
+                heapq.heappush(self._queue, (next_due, next(self._sequence), node_id, register))
+        return due
+
+    def start(self):
+        if self._running or self.size() == 0:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='ModbusPollScheduler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def _run(self):
+        while self._running:
+            self._wakeup.clear()
+            wait = self.nextDue(time.monotonic())
+            if wait == None or wait > 0:
+                self._wakeup.wait(wait)
+                continue
+            for node_id, registers in self.popDue(time.monotonic()).items():
+                try:
+                    self.callback(node_id, registers)
+                except Exception as ex:
+                    LOGGER.error(str(ex))
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+"""
+Modbus RTU over a serial line shared by all the units on it
+Copyright (C) 2024 Universal Devices
+"""
+import udi_interface
+LOGGER = udi_interface.LOGGER
+import threading, time
+from pymodbus import FramerType
+from pymodbus.client import ModbusSerialClient
+
+MODBUS_SERIAL_DEFAULT_BAUDRATE=9600
+#seconds to wait for a unit to respond. RS-485 devices usually respond within tens of milliseconds
+MODBUS_SERIAL_DEFAULT_TIMEOUT=1
+#pyserial parity for the parity in serial.schema.json
+MODBUS_SERIAL_PARITIES={'none':'N', 'even':'E', 'odd':'O', 'mark':'M', 'space':'S'}
+
+
+#returns the serial parameters from the Serial transport in the protocol with defaults for what's missing
+def parseSerialParams(transport:dict)->dict:
+    params = {
+        'port': None,
+        'baudrate': MODBUS_SERIAL_DEFAULT_BAUDRATE,
+        'bytesize': 8,
+        'parity': 'N',
+        'stopbits': 1,
+        'timeout': MODBUS_SERIAL_DEFAULT_TIMEOUT
+    }
+    if transport == None:
+        return params
+    if 'port' in transport:
+        params['port'] = transport['port']
+    if 'baudrate' in transport:
+        params['baudrate'] = int(transport['baudrate'])
+    if 'databits' in transport:
+        params['bytesize'] = int(transport['databits'])
+    if 'parity' in transport:
+        parity = str(transport['parity']).lower()
+        if not parity in MODBUS_SERIAL_PARITIES:
+            raise Exception(f"{transport['parity']} is not a valid parity ...")
+        params['parity'] = MODBUS_SERIAL_PARITIES[parity]
+    if 'stopbits' in transport:
+        params['stopbits'] = int(transport['stopbits'])
+    if 'timeout' in transport and transport['timeout']:
+        params['timeout'] = float(transport['timeout'])
+    return params
+
+
+class ModbusSerialBusClient(ModbusSerialClient):
+    '''
+        RTU client that keeps the line silent for at least 3.5 characters
+        (1.75 ms above 19200 baud) between the end of the last frame and the
+        start of the next one. pymodbus computes the silent interval and
+        records the end of each frame but does not wait for it before sending.
+    '''
+    def send(self, request:bytes, addr=None)->int:
+        if request and self.last_frame_end:
+            wait = self.last_frame_end + self.silent_interval - time.time()
+            if wait > 0:
+                time.sleep(wait)
+        size = super().send(request, addr)
+        if request:
+            #the frame ends once all its characters are on the line
+            self.last_frame_end = time.time() + len(request) * self._t0
+        return size
+
+
+class ModbusSerialBus:
+    '''
+        A serial line with all its units. There is one client for the line
+        and one lock (the arbiter) that every request to any unit on the line
+        holds from send until the response is received, so concurrent polls,
+        scheduled reads, and writes take turns instead of colliding on the wire.
+        The port can be a device such as /dev/ttyUSB0 or any pyserial url such as
+        socket://host:port for a serial server in raw mode.
+    '''
+    def __init__(self, params:dict):
+        self.params = params
+        self.lock = threading.RLock()
+        self.client = ModbusSerialBusClient(params['port'], framer=FramerType.RTU, baudrate=params['baudrate'],
+                bytesize=params['bytesize'], parity=params['parity'], stopbits=params['stopbits'],
+                timeout=params['timeout'], retries=1)
+
+    def __str__(self):
+        return f"{self.params['port']}@{self.params['baudrate']}"
+
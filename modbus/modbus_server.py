@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+
+"""
+Serves IoX driver values as a table of modbus holding and input registers
+Copyright (C) 2024 Universal Devices
+"""
+import udi_interface
+LOGGER = udi_interface.LOGGER
+import asyncio, threading
+from pymodbus import FramerType
+from pymodbus.pdu import ExceptionResponse
+from pymodbus.server import ModbusTcpServer
+from pymodbus.datastore import ModbusSequentialDataBlock, ModbusServerContext
+from pymodbus.datastore.context import ModbusBaseSlaveContext
+from iox_to_modbus import ModbusRegister
+
+MODBUS_SERVER_DEFAULT_HOST='0.0.0.0'
+MODBUS_SERVER_DEFAULT_PORT=5020
+#the table only has registers. Coils and discrete inputs are not served
+MODBUS_SERVER_REGISTER_TYPES={'holding': 'h', 'input': 'i'}
+#seconds to wait for the server to listen or to shut down
+MODBUS_SERVER_START_TIMEOUT=5
+
+
+class ModbusServerUnit(ModbusBaseSlaveContext):
+    '''
+        Holding and input registers of one unit of the server. The table is
+        read only: writes are answered with an illegal function exception and
+        reads outside of the registers with an illegal address exception.
+        Values are set by the table under lock while requests read them on
+        the event loop of the server.
+    '''
+    def __init__(self, sizes:dict, lock:threading.Lock):
+        self.lock = lock
+        self.store = {store: ModbusSequentialDataBlock(0, [0] * size) for store, size in sizes.items()}
+
+    def reset(self):
+        with self.lock:
+            for block in self.store.values():
+                block.values = [0] * len(block.values)
+
+    def getValues(self, fc_as_hex, address, count=1):
+        store = self.decode(fc_as_hex)
+        if not store in self.store or address < 0 or address + count > len(self.store[store].values):
+            return ExceptionResponse.ILLEGAL_ADDRESS
+        with self.lock:
+            return self.store[store].getValues(address, count)
+
+    def setValues(self, fc_as_hex, address, values):
+        return ExceptionResponse.ILLEGAL_FUNCTION
+
+
+class ModbusServerTable:
+    '''
+        Maps properties of IoX nodes to registers. Each entry is a
+        ModbusRegister so values are encoded with the codec of its data type
+        and the byte/word order of the protocol, the reverse of reading them.
+        The value of a property is multiplied by the scale of its entry before
+        it's encoded. Only the registers of a property are written when it
+        changes, requests always read what's in the table.
+    '''
+    def __init__(self, entries, byte_order:str='big', word_order:str='big'):
+        #(node address, property id) -> [(register, scale)]
+        self.registers = {}
+        self._lock = threading.Lock()
+        #(unit, store) -> addresses used, to skip entries that overlap
+        used = {}
+        for entry in entries:
+            try:
+                register = ModbusRegister({
+                    'register_address': entry['register_address'],
+                    'register_type': entry['register_type'],
+                    'register_data_type': entry['register_data_type'] if 'register_data_type' in entry else 'uint16',
+                    'unit': int(entry['unit']) if 'unit' in entry else 1
+                }, byte_order, word_order)
+                if not register.register_type in MODBUS_SERVER_REGISTER_TYPES or register.codec.is_string:
+                    raise Exception(f"only numeric holding and input registers can be served")
+                register.property_id = entry['property']
+                scale = float(entry['scale']) if 'scale' in entry else 1
+                key = (register.unit, MODBUS_SERVER_REGISTER_TYPES[register.register_type])
+                addresses = set(range(register.register_address, register.register_address + register.num_registers))
+                if not key in used:
+                    used[key] = set()
+                if len(used[key] & addresses) > 0:
+                    raise Exception(f"overlaps another register of unit {register.unit}")
+                used[key] |= addresses
+                node_key = (entry['node'], entry['property'])
+                if not node_key in self.registers:
+                    self.registers[node_key] = []
+                self.registers[node_key].append((register, scale))
+            except Exception as ex:
+                LOGGER.error(f"skipping server register {entry}: {str(ex)}")
+
+        units = {}
+        for (unit, store), addresses in used.items():
+            if not unit in units:
+                units[unit] = {}
+            units[unit][store] = max(addresses) + 1
+        self.units = {unit: ModbusServerUnit(sizes, self._lock) for unit, sizes in units.items()}
+        self.context = ModbusServerContext(slaves=self.units, single=False)
+
+    def isEmpty(self)->bool:
+        return len(self.registers) == 0
+
+    #the registers of the protocol of each node that read a value as is, at the same unit, type, and address
+    @staticmethod
+    def mirrorEntries(nodes:dict, precisions)->list:
+        entries = []
+        for address, node in nodes.items():
+            for property_id, register in node.registers.items():
+                if not register.is_master or register.expression != None or register.codec.is_string:
+                    continue
+                if not register.register_type in MODBUS_SERVER_REGISTER_TYPES:
+                    continue
+                #IoX values are divided by 10^precision, see ModbusProtocolHandler.reportValue
+                precision = precisions(address, property_id)
+                entries.append({
+                    'node': address,
+                    'property': property_id,
+                    'unit': register.unit,
+                    'register_type': register.register_type,
+                    'register_address': hex(register.register_address),
+                    'register_data_type': register.register_data_type,
+                    'scale': pow(10, precision) if precision > 1 else 1
+                })
+        return entries
+
+    #sets the registers of the property of the node. Returns False if it's not in the table
+    def update(self, address:str, property_id:str, value)->bool:
+        key = (address, property_id)
+        if value == None or not key in self.registers:
+            return False
+        try:
+            for register, scale in self.registers[key]:
+                #64 bit integers do not survive a float
+                scaled = value if scale == 1 and isinstance(value, int) else float(value) * scale
+                words = register.codec.encode(scaled if register.codec.data_type.startswith('float') else round(scaled))
+                with self._lock:
+                    self.units[register.unit].store[MODBUS_SERVER_REGISTER_TYPES[register.register_type]].setValues(register.register_address, words)
+            return True
+        except Exception as ex:
+            LOGGER.error(f"failed serving {value} for {property_id} of {address}: {str(ex)}")
+            return False
+
+
+class ModbusRegisterServer:
+    '''
+        Modbus TCP server for a ModbusServerTable. It runs on its own event
+        loop in its own thread so that polls and IoX commands are never held
+        up by the clients of the table.
+    '''
+    def __init__(self, table:ModbusServerTable, host:str=MODBUS_SERVER_DEFAULT_HOST, port:int=MODBUS_SERVER_DEFAULT_PORT):
+        self.table = table
+        self.host = host
+        self.port = port
+        self._loop = None
+        self._server:ModbusTcpServer = None
+        self._thread = None
+
+    def isRunning(self)->bool:
+        return self._thread != None and self._thread.is_alive()
+
+    def start(self)->bool:
+        if self.isRunning():
+            return True
+        listening = threading.Event()
+        self._loop = asyncio.new_event_loop()
+
+        async def serve():
+            self._server = ModbusTcpServer(self.table.context, framer=FramerType.SOCKET, address=(self.host, self.port))
+            await self._server.serve_forever(background=True)
+            listening.set()
+            await self._server.serving
+
+        def run():
+            asyncio.set_event_loop(self._loop)
+            try:
+                self._loop.run_until_complete(serve())
+            except Exception as ex:
+                LOGGER.error(f"modbus server @ {self.host}:{self.port} failed: {str(ex)}")
+            finally:
+                listening.set()
+                self._loop.close()
+
+        self._thread = threading.Thread(target=run, name='ModbusServer', daemon=True)
+        self._thread.start()
+        listening.wait(MODBUS_SERVER_START_TIMEOUT)
+        if not self.isRunning():
+            return False
+        LOGGER.info(f"serving {len(self.table.registers)} properties as modbus registers @ {self.host}:{self.port}")
+        return True
+
+    def stop(self)->bool:
+        if not self.isRunning():
+            return True
+        try:
+            asyncio.run_coroutine_threadsafe(self._server.shutdown(), self._loop).result(MODBUS_SERVER_START_TIMEOUT)
+            self._thread.join(MODBUS_SERVER_START_TIMEOUT)
+            return True
+        except Exception as ex:
+            LOGGER.error(f"failed stopping the modbus server: {str(ex)}")
+            return False
+        finally:
+            self._thread = None
+            self._server = None
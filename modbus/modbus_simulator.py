@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+"""
+Simulated modbus devices for development: Modbus TCP, or RTU over a socket
+for serial clients using a socket://host:port url
+Copyright (C) 2024 Universal Devices
+"""
+import asyncio, random, socket, threading, time
+from pymodbus import FramerType
+from pymodbus.server import StartAsyncTcpServer
+from pymodbus.datastore import ModbusSequentialDataBlock, ModbusSlaveContext, ModbusServerContext
+
+MODBUS_SIMULATOR_SIZE=1000
+
+
+class ModbusCountingDataBlock(ModbusSequentialDataBlock):
+    '''
+        Data block that counts the requests it serves in requests, anything
+        with a value attribute and a lock such as multiprocessing.Value.
+        Every read or write request gets or sets values exactly once.
+    '''
+    def __init__(self, address:int, values:list, requests=None):
+        super().__init__(address, values)
+        self.requests = requests
+
+    def count(self):
+        if self.requests != None:
+            with self.requests.get_lock():
+                self.requests.value += 1
+
+    def getValues(self, address, count=1):
+        self.count()
+        return super().getValues(address, count)
+
+    def setValues(self, address, values):
+        self.count()
+        return super().setValues(address, values)
+
+
+#each unit has coils, discrete inputs, input and holding registers. Register values are unit * 1000 + address
+def buildContext(units, size:int=MODBUS_SIMULATOR_SIZE, requests=None)->ModbusServerContext:
+    slaves = {}
+    for unit in units:
+        registers = [(unit * 1000 + address) & 0xffff for address in range(size)]
+        bits = [address % 2 == 0 for address in range(size)]
+        #the slave context adds 1 to the requested address
+        slaves[unit] = ModbusSlaveContext(
+            co=ModbusCountingDataBlock(1, list(bits), requests),
+            di=ModbusCountingDataBlock(1, list(bits), requests),
+            ir=ModbusCountingDataBlock(1, list(registers), requests),
+            hr=ModbusCountingDataBlock(1, list(registers), requests))
+    return ModbusServerContext(slaves=slaves, single=False)
+
+#every interval seconds, changes a fraction of the input and holding registers of each unit a little
+def drift(context:ModbusServerContext, units, size:int=MODBUS_SIMULATOR_SIZE, fraction:float=0.1, interval:float=0.2):
+    while True:
+        time.sleep(interval)
+        for unit in units:
+            for block in (context[unit].store['i'], context[unit].store['h']):
+                for index in random.sample(range(size), max(1, int(size * fraction))):
+                    block.values[index] = (block.values[index] + random.choice((-1, 1))) & 0xffff
+
+#runs the server in its own thread and returns once it accepts connections
+def startServer(context:ModbusServerContext, host:str='localhost', port:int=5020, rtu:bool=False, timeout:float=5)->threading.Thread:
+    framer = FramerType.RTU if rtu else FramerType.SOCKET
+    loop = asyncio.new_event_loop()
+
+    def run():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(StartAsyncTcpServer(context=context, address=(host, port), framer=framer))
+
+    thread = threading.Thread(target=run, name='ModbusSimulator', daemon=True)
+    thread.start()
+    waitForServer(host, port, timeout)
+    return thread
+
+def waitForServer(host:str, port:int, timeout:float=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise Exception(f"modbus simulator did not start on {host}:{port}")
+
+#runs the simulated devices until the process is stopped. Meant as a multiprocessing target
+#so that the simulator does not use the CPU time of the process being measured
+def serve(units, host:str='localhost', port:int=5020, rtu:bool=False, size:int=MODBUS_SIMULATOR_SIZE, requests=None, changing:bool=False):
+    context = buildContext(units, size, requests)
+    thread = startServer(context, host, port, rtu)
+    if changing:
+        threading.Thread(target=drift, args=[context, units, size], name='ModbusSimulatorDrift', daemon=True).start()
+    thread.join()
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Simulated modbus devices')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=5020)
+    parser.add_argument('--rtu', action='store_true', help='RTU framing, for serial clients with port socket://host:port')
+    parser.add_argument('--units', type=int, nargs='+', default=[1])
+    parser.add_argument('--size', type=int, default=MODBUS_SIMULATOR_SIZE, help='registers of each type per unit')
+    parser.add_argument('--changing', action='store_true', help='keep changing register values')
+    args = parser.parse_args()
+    print(f"simulating units {args.units} on {args.host}:{args.port} ({'RTU' if args.rtu else 'TCP'}) ...")
+    serve(args.units, args.host, args.port, args.rtu, args.size, changing=args.changing)
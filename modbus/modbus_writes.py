@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+"""
+Coalesces writes to contiguous registers into single requests
+Copyright (C) 2024 Universal Devices
+"""
+import udi_interface
+LOGGER = udi_interface.LOGGER
+import itertools, threading, time
+
+#writes that arrive within this many milliseconds of the first one are sent together. 0 sends each on its own
+MODBUS_DEFAULT_WRITE_WINDOW_MS=20
+#limits of a single write_registers/write_coils request
+MODBUS_MAX_WRITE_REGISTERS=123
+MODBUS_MAX_WRITE_BITS=1968
+
+
+def maxWriteCount(register_type:str)->int:
+    if register_type == 'coil':
+        return MODBUS_MAX_WRITE_BITS
+    return MODBUS_MAX_WRITE_REGISTERS
+
+
+class ModbusPendingWrite:
+    '''
+        One register waiting to be written and the result the caller waits for.
+        Earlier writes to the same register that were replaced by this one
+        finish with its result.
+    '''
+    def __init__(self, sequence:int, register, payload:list):
+        self.sequence = sequence
+        self.register = register
+        self.payload = payload
+        self.address = register.register_address
+        self.end = register.register_address + len(payload)
+        self.superseded = []
+        self.result = False
+        self.done = threading.Event()
+
+    def finish(self, result:bool):
+        for write in self.superseded:
+            write.finish(result)
+        self.result = result
+        self.done.set()
+
+
+class ModbusWriteQueue:
+    '''
+        Writes are queued by (host, port, unit, register type). The first
+        write to a key waits for the window, then takes everything that was
+        queued for the key in the meantime, merges writes to contiguous
+        addresses into one request, and sends them with
+        writer(host, port, unit, register_type, address, payload). If the same
+        register is written more than once, only the latest value is sent.
+        Each caller gets the result for its own register.
+    '''
+    def __init__(self, writer, window_ms:int=MODBUS_DEFAULT_WRITE_WINDOW_MS):
+        self.writer = writer
+        self.window_ms = window_ms
+        self._pending = {}
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+
+    #queues the write and returns the pending write without waiting for it
+    def submit(self, host:str, port:int, register, payload:list)->ModbusPendingWrite:
+        key = (host, port, register.unit, register.register_type)
+        write = ModbusPendingWrite(next(self._sequence), register, payload)
+        with self._lock:
+            first = not key in self._pending
+            if first:
+                self._pending[key] = []
+            self._pending[key].append(write)
+        if first:
+            threading.Thread(target=self._flush, args=[key], name='ModbusWriteQueue', daemon=True).start()
+        return write
+
+    #waits for the result of the pending write
+    def wait(self, write:ModbusPendingWrite, timeout:float=None)->bool:
+        if not write.done.wait(timeout):
+            LOGGER.error(f"Timed out waiting to write {write.register.register_type} @ {write.address}")
+            return False
+        return write.result
+
+    def write(self, host:str, port:int, register, payload:list, timeout:float=None)->bool:
+        return self.wait(self.submit(host, port, register, payload), timeout)
+
+    def _flush(self, key:tuple):
+        if self.window_ms > 0:
+            time.sleep(self.window_ms / 1000)
+        with self._lock:
+            writes = self._pending.pop(key, [])
+        host, port, unit, register_type = key
+        for run in self.plan(writes, register_type):
+            payload = []
+            for write in run:
+                payload.extend(write.payload)
+            try:
+                response = self.writer(host, port, unit, register_type, run[0].address, payload)
+            except Exception as ex:
+                LOGGER.error(str(ex))
+                response = None
+            if len(run) > 1:
+                LOGGER.debug(f"wrote {len(run)} {register_type} registers @ {run[0].address} in one request")
+            for write in run:
+                write.finish(write.register.written(response))
+
+    #drops superseded writes and groups the rest into runs of contiguous addresses that fit in one request
+    @staticmethod
+    def plan(writes:list, register_type:str)->list:
+        latest = {}
+        for write in sorted(writes, key=lambda write: write.sequence):
+            range = (write.address, write.end)
+            if range in latest:
+                write.superseded.append(latest[range])
+            latest[range] = write
+        runs = []
+        for write in sorted(latest.values(), key=lambda write: (write.address, write.end)):
+            if len(runs) == 0 or write.address != runs[-1][-1].end or write.end - runs[-1][0].address > maxWriteCount(register_type):
+                runs.append([])
+            runs[-1].append(write)
+        return runs
@@ -0,0 +1,4 @@
+import os, sys
+
+#the plugin modules import each other from the plugin directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
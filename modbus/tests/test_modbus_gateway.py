@@ -0,0 +1,50 @@
+import time
+from modbus_gateway import ModbusGatewayHealth, MODBUS_BREAKER_THRESHOLD
+
+
+def tripped(timeout:float=0.5)->ModbusGatewayHealth:
+    health = ModbusGatewayHealth('gateway:502', timeout)
+    for _ in range(MODBUS_BREAKER_THRESHOLD):
+        health.failed()
+    assert health.isOpen()
+    assert not health.allowRequest()
+    #the window is over
+    health.open_until = time.monotonic() - 1
+    return health
+
+
+def test_closed_breaker_lets_every_request_through():
+    health = ModbusGatewayHealth('gateway:502', 0.5)
+    assert all([health.allowRequest() for _ in range(10)])
+
+
+def test_half_open_breaker_lets_one_probe_through():
+    health = tripped()
+    assert health.allowRequest()
+    assert not any([health.allowRequest() for _ in range(10)])
+
+
+def test_probe_success_closes_the_breaker():
+    health = tripped()
+    assert health.allowRequest()
+    health.succeeded(0.01)
+    assert not health.isOpen()
+    assert all([health.allowRequest() for _ in range(10)])
+
+
+def test_probe_failure_opens_the_breaker_again():
+    health = tripped()
+    assert health.allowRequest()
+    health.failed()
+    assert health.isOpen()
+    assert not health.allowRequest()
+    assert health.trips == 2
+
+
+def test_probe_that_never_returns_is_replaced():
+    health = tripped(0.05)
+    assert health.allowRequest()
+    assert not health.allowRequest()
+    time.sleep(0.11)
+    assert health.allowRequest()
+    assert not health.allowRequest()
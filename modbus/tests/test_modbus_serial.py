@@ -0,0 +1,192 @@
+"""
+A serial line shared by the units of a node, simulated by modbus_simulator over
+a pyserial socket:// url. A proxy between the client and the simulator records
+the frames on the line
+"""
+import json, os, socket, threading, time
+import pytest
+from ioxplugin import Plugin
+from modbus_simulator import buildContext, startServer
+from modbus_serial import ModbusSerialBus, parseSerialParams
+from iox_to_modbus import ModbusIoX
+from pymodbus.pdu.register_message import ReadHoldingRegistersRequest
+
+PLUGIN = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'modbus.iox_plugin.json')
+BAUDRATE = 9600
+UNITS = (10, 11)
+THREADS = 4
+READS = 3
+
+
+def freePort()->int:
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+#the length of the RTU frame at the start of data, None until its length is known
+def frameLength(data:bytes, request:bool):
+    if len(data) < 3:
+        return None
+    function = data[1]
+    if function & 0x80:
+        return 5
+    assert function in (1, 2, 3, 4, 5, 6, 15, 16), f"unexpected function {function}"
+    if request:
+        if function in (15, 16):
+            return 9 + data[6] if len(data) >= 7 else None
+        return 8
+    if function in (1, 2, 3, 4):
+        return 5 + data[2]
+    return 8
+
+
+class LineRecorder:
+    '''
+        Forwards the bytes between the client and the server and records when
+        the first and the last byte of each frame went through
+    '''
+    def __init__(self, server_port:int):
+        self.server_port = server_port
+        self.port = freePort()
+        self.chunks = []
+        self._lock = threading.Lock()
+        self._listener = socket.create_server(('localhost', self.port))
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def accept(self):
+        while True:
+            client, _ = self._listener.accept()
+            server = socket.create_connection(('localhost', self.server_port))
+            #a frame goes through as soon as it's received, like on a wire
+            for connection in (client, server):
+                connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=self.forward, args=[client, server, True], daemon=True).start()
+            threading.Thread(target=self.forward, args=[server, client, False], daemon=True).start()
+
+    def forward(self, source:socket.socket, destination:socket.socket, request:bool):
+        while True:
+            try:
+                data = source.recv(1024)
+            except OSError:
+                data = b''
+            if not data:
+                destination.close()
+                return
+            #recorded before it's passed on, so a response is always recorded before the next request
+            with self._lock:
+                self.chunks.append((time.perf_counter(), request, data))
+            destination.sendall(data)
+
+    #[(request, first byte time, last byte time)] in the order they went through
+    def getFrames(self):
+        frames = []
+        pending = {True: b'', False: b''}
+        starts = {}
+        with self._lock:
+            chunks = list(self.chunks)
+        for at, request, data in chunks:
+            if len(pending[request]) == 0:
+                starts[request] = at
+            pending[request] += data
+            while True:
+                length = frameLength(pending[request], request)
+                if length == None or len(pending[request]) < length:
+                    break
+                frames.append((request, starts[request], at))
+                pending[request] = pending[request][length:]
+                starts[request] = at
+        assert pending[True] == b'' and pending[False] == b''
+        return frames
+
+
+@pytest.fixture(scope='module')
+def line():
+    server_port = freePort()
+    startServer(buildContext(UNITS), 'localhost', server_port, rtu=True)
+    return LineRecorder(server_port)
+
+
+@pytest.fixture
+def modbus(line, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with open(PLUGIN) as file:
+        plugin = json.load(file)
+    plugin['protocol']['config'] = {'transport': {'mode': 'Serial', 'port': f'socket://localhost:{line.port}', 'baudrate': BAUDRATE, 'parity': 'none'}}
+    #half of the registers of the node are on a second unit of the same line
+    for index, property in enumerate(plugin['nodedefs'][0]['properties']):
+        if 'protocol' in property and index % 2:
+            property['protocol']['unit'] = UNITS[1]
+    path = os.path.join(tmp_path, 'serial.iox_plugin.json')
+    with open(path, 'w') as file:
+        json.dump(plugin, file)
+    modbus = ModbusIoX(Plugin(path))
+    assert modbus.serial_bus != None
+    assert modbus.connect(None, None)
+    yield modbus
+    modbus.disconnect()
+
+
+def queryConcurrently(modbus:ModbusIoX):
+    node_id = list(modbus.nodes.keys())[0]
+    property_ids = list(modbus.nodes[node_id].registers.keys())
+    results = []
+
+    def query(index:int):
+        for _ in range(READS):
+            results.append(modbus.readNode(node_id))
+            results.append(modbus.queryProperties(node_id, property_ids[index::THREADS]))
+
+    threads = [threading.Thread(target=query, args=[index]) for index in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_concurrent_queries_read_every_unit_of_the_line(modbus):
+    results = queryConcurrently(modbus)
+    assert len(results) == 2 * THREADS * READS
+    for result in results:
+        assert result == True or (isinstance(result, dict) and not None in result.values())
+    assert {register.unit for register in modbus.nodes[list(modbus.nodes.keys())[0]].registers.values()} == set(UNITS)
+
+
+def test_requests_never_overlap_on_the_line(modbus, line):
+    line.chunks.clear()
+    queryConcurrently(modbus)
+    frames = line.getFrames()
+    assert len(frames) >= 2 * THREADS * READS
+    #each request is answered before the next one starts
+    for index, (request, _, _) in enumerate(frames):
+        assert request == (index % 2 == 0), f"frame {index} overlaps"
+
+
+def test_frames_are_apart_by_the_silent_interval(modbus, line):
+    silent_interval = modbus.serial_bus.client.silent_interval
+    assert silent_interval == pytest.approx(3.5 * 10 / BAUDRATE, abs=1e-6)
+    line.chunks.clear()
+    queryConcurrently(modbus)
+    frames = line.getFrames()
+    gaps = [start - frames[index - 1][2] for index, (request, start, _) in enumerate(frames) if request and index > 0]
+    assert len(gaps) > 0
+    assert min(gaps) >= silent_interval
+
+
+#frames sent back to back still leave the line silent for 3.5 characters after the end of the previous one
+def test_send_keeps_the_line_silent_between_frames(line):
+    bus = ModbusSerialBus(parseSerialParams({'port': f'socket://localhost:{line.port}', 'baudrate': BAUDRATE}))
+    assert bus.client.connect()
+    line.chunks.clear()
+    try:
+        for address in range(10):
+            bus.client.send(bus.client.framer.buildFrame(ReadHoldingRegistersRequest(address=address, count=2, dev_id=UNITS[0])))
+        time.sleep(0.1)
+    finally:
+        bus.client.close()
+    frames = line.getFrames()
+    requests = [frame for frame in frames if frame[0]]
+    assert len(requests) == 10
+    gaps = [start - frames[index - 1][2] for index, (request, start, _) in enumerate(frames) if request and index > 0]
+    assert min(gaps) >= bus.client.silent_interval
@@ -279,8 +279,31 @@ class ShellyControllerNode(udi_interface.Node):
             else:
                 node.query()
 
+    def sceneOn(self, command):
+        try:
+            query = str(command['query']).replace("'", '"')
+            jparam = json.loads(query)
+            scene = int(jparam['scene.uom56'])
+            onlevel = int(jparam['onlevel.uom51']) if 'onlevel.uom51' in jparam else None
+            ramprate = int(jparam['ramprate.uom57']) if 'ramprate.uom57' in jparam else None
+            return self.protocolHandler.sceneCommand(scene, 'On', Level=onlevel, RampRate=ramprate)
+        except Exception as ex:
+            LOGGER.error(f'failed parsing parameters ... ')
+            return False
+
+    def sceneOff(self, command):
+        try:
+            query = str(command['query']).replace("'", '"')
+            jparam = json.loads(query)
+            scene = int(jparam['scene.uom56'])
+            ramprate = int(jparam['ramprate.uom57']) if 'ramprate.uom57' in jparam else None
+            return self.protocolHandler.sceneCommand(scene, 'Off', RampRate=ramprate)
+        except Exception as ex:
+            LOGGER.error(f'failed parsing parameters ... ')
+            return False
+
     ###
     # This is a list of commands that were defined in the nodedef
     ###
-    commands = {'discover': discover, 'x_query': query}
+    commands = {'discover': discover, 'x_query': query, 'scene_on': sceneOn, 'scene_off': sceneOff}
 
@@ -2,94 +2,15 @@
 import udi_interface, os, sys, json, time, ipaddress
 LOGGER = udi_interface.LOGGER
 Custom = udi_interface.Custom
-
-
-ShellyTypeToNodeDef={
-    'ShellyPlusWDUS':'sdimmer',
-    'shelly1pmminig3':'sswitch'
-}
-
-class ShellyDeviceInfo(dict):
-    '''
-        Holds type/ip/port/host information for a Shelly device
-        endpoint
-                    dev_info={
-                        'dev_address': dev_address,
-                        'dev_type':dev_type,
-                        'nodedef_id':nodedef_id, 
-                        'ip':ip,
-                        'port':result['port'],
-                        'host':result['host'],
-                    }
-
-    '''
-
-    def getDeviceAddress(self):
-        try:
-            return self['dev_address']
-        except:
-            return None
-
-    def setDeviceAddress(self, address:str):
-        try:
-            self['dev_address']=address
-        except:
-            return None
-
-
-    def getDeviceType(self):
-        try:
-            return self['dev_type']
-        except:
-            return None
-
-    def setDeviceType(self, type:str):
-        try:
-            self['dev_type']=type
-        except:
-            return None
-
-    def setNodeDefId(self, nodedef_id):
-        try:
-            self['nodedef_id']=nodedef_id
-        except:
-            return None
-
-    def getIp(self):
-        try:
-            return self['ip']
-        except:
-            return None
-
-    def setIp(self, ip:str):
-        try:
-            self['ip']=ip
-        except:
-            return None
-
-    def getPort(self):
-        try:
-            return self['port']
-        except:
-            return None
-
-    def setPort(self, port:int):
-        try:
-            self['port']=port
-        except:
-            return None
-
-    def getHost(self):
-        try:
-            return self['host']
-        except:
-            return None
-
-    def setHost(self, host):
-        try:
-            self['host']=host
-        except:
-            return None
+from shelly_rpc import ShellyRpcPool, ShellyRpcClient, statusToLevel, SHELLY_NODEDEF_COMPONENTS
+from shelly_ws import ShellyWebSocketHub
+from shelly_registry import ShellyDeviceRegistry, ShellyDevice, ShellyTypeToNodeDef, parseServiceName, SHELLY_REGISTRY_SAVE_DELAY
+from shelly_mdns import ShellyBrowser
+from shelly_sweep import ShellyFleetSweeper, ShellySweepResult
+from shelly_coiot import ShellyCoiotListener, ShellyCoiotStatus
+from shelly_coalesce import ShellyCommandCoalescer, SHELLY_COMMAND_SUPERSEDED
+from shelly_scene import ShellySceneDispatcher, ShellySceneResult, parseSceneParams
+import threading
 
 
 class ShellyProtocolHandler:
@@ -104,16 +25,98 @@ class ShellyProtocolHandler:
 
     def __init__(self, plugin):
         self.plugin = plugin
+        #where the registry is saved, see ShellyDeviceRegistry
         self.deviceMap = None
-        ### In case you want to have a mapping of nodes, you can use something like this
-        #self.nodes = {}
-        ### See nodeAdded and nodeRemoved
-        ###
+        self.registry = ShellyDeviceRegistry()
+        self.saveTimer:threading.Timer = None
+        #devices are discovered, and their new IPs picked up, for as long as the plugin runs
+        self.browser = ShellyBrowser(self.deviceDiscovered, self.deviceLost)
+        self.nodes = {}
+        #a keep-alive RPC client per device, see ShellyRpcClient
+        self.rpc = ShellyRpcPool()
+        #commands to a device that is busy only keep the latest, see ShellyCommandCoalescer
+        self.commands = ShellyCommandCoalescer()
+        #commands to many devices at once, see runScene. The nodes of each scene come from the custom parameters
+        self.scenes = ShellySceneDispatcher()
+        self.sceneMembers = {}
+        #devices push their status over a websocket. Only the ones that are not connected are polled
+        self.hub = ShellyWebSocketHub(self.statusPushed)
+        #devices that are not pushing their status are read concurrently at each short poll
+        self.sweeper = ShellyFleetSweeper()
+        self.lastSweep:ShellySweepResult = None
+        #Gen1 devices multicast their status, they are found and updated from it
+        self.coiot = ShellyCoiotListener(self.coiotStatus)
 
     def setController(self, controller):
         self.controller = controller
         self.deviceMap = self.createCustomParam('dev_map') 
 
+    def getDeviceInfo(self, address:str)->ShellyDevice:
+        return self.registry.get(address)
+
+    ###
+    # The RPC client of the device of the node and the component the node controls
+    ###
+    def getClient(self, node)->ShellyRpcClient:
+        dev_info = self.getDeviceInfo(node.address)
+        if dev_info == None or dev_info.ip == None:
+            LOGGER.error(f"Couldn't find device info for {node.address}")
+            return None
+        return self.rpc.getClient(node.address, dev_info.ip, dev_info.port)
+
+    def getComponent(self, node)->str:
+        return SHELLY_NODEDEF_COMPONENTS[node.id] if node.id in SHELLY_NODEDEF_COMPONENTS else None
+
+    #the status of the device: as pushed if its websocket is connected or it's a Gen1, otherwise read from the device
+    def getStatus(self, node, client:ShellyRpcClient):
+        if self.isGen1(node.address):
+            return client.status
+        if self.hub.isConnected(node.address) and client.status != None:
+            return client.status
+        return client.getStatus()
+
+    def isGen1(self, address:str)->bool:
+        dev_info = self.getDeviceInfo(address)
+        return dev_info != None and dev_info.isGen1()
+
+    ###
+    # Called by the websocket hub with the status a device pushed: all of it or only what changed
+    ###
+    def statusPushed(self, address:str, status:dict, full:bool):
+        try:
+            node = self.nodes[address] if address in self.nodes else None
+            if node == None:
+                return False
+            client = self.getClient(node)
+            if client == None:
+                return False
+            client.mergeStatus(status, full)
+            level = statusToLevel(client.status, self.getComponent(node))
+            if level != None:
+                node.setDriver('ST', level)
+            return True
+        except Exception as ex:
+            LOGGER.error(str(ex))
+            return False
+
+    ###
+    # Called by the CoIoT listener with the status a Gen1 device multicast. A device that's not
+    # known is added and one that got a new IP is updated. Returns False if no node took it
+    ###
+    def coiotStatus(self, packet:ShellyCoiotStatus, ip:str)->bool:
+        device = self.registry.getByMac(packet.mac)
+        if device == None or device.ip != ip:
+            if not self.deviceDiscovered(ShellyDevice(packet.mac, packet.dev_type, None, ip, 80, None, packet.mac)):
+                return False
+            device = self.registry.getByMac(packet.mac)
+        if device == None or not device.address in self.nodes:
+            return False
+        device.online = True
+        component = self.getComponent(self.nodes[device.address])
+        if component == None:
+            return False
+        return self.statusPushed(device.address, packet.toStatus(component), False)
+
     ####
     #  You need to implement these methods!
     ####
@@ -125,7 +128,8 @@ class ShellyProtocolHandler:
     ####
     def setProperty(self, node, property_id, value):
         try:
-            return True
+            #ramp rate and on level are kept in the node and used by the commands that don't have them
+            return property_id in ('RAMP_RATE', 'ON_LEVEL')
         except Exception as ex:
             LOGGER.error(f'setProperty {property_id} failed .... ')
             return False
@@ -138,7 +142,12 @@ class ShellyProtocolHandler:
     ####
     def queryProperty(self, node, property_id):
         try:
-            return True
+            if property_id != 'ST':
+                return node.getDriver(property_id)
+            client = self.getClient(node)
+            if client == None:
+                return None
+            return statusToLevel(self.getStatus(node, client), self.getComponent(node))
         except Exception as ex:
             LOGGER.error(f'queryProperty {property_id} failed .... ')
             return False
@@ -149,23 +158,120 @@ class ShellyProtocolHandler:
     # to the node/device or service
     ####
     def processCommand(self, node, command_name, **kwargs):
+        result = self.sendCommand(node, command_name, **kwargs)
+        #a newer command to the device was sent instead
+        return True if result == SHELLY_COMMAND_SUPERSEDED else result
+
+    ###
+    # Sends the command to the device of the node. Returns True if the device acknowledged it and
+    # SHELLY_COMMAND_SUPERSEDED if it was dropped for a newer command to the same device
+    ###
+    def sendCommand(self, node, command_name, **kwargs):
         try:
-            #michel
-            address=node.address
-            dev_info = self.deviceMap[address]
-            if not dev_info:
-                LOGGER.error(f"Couldn't find device info for {address}") 
+            client = self.getClient(node)
+            component = self.getComponent(node)
+            if client == None or component == None:
                 return False
 
             LOGGER.info(f"Processing command {command_name}") 
-            if kwargs != None:
-                for key, value in kwargs.items():
-                    LOGGER.info(f"-param: {key}: {value}")
-            return True
+            params, level = self.getCommandParams(node, component, command_name, kwargs)
+            if params == None:
+                LOGGER.error(f"{command_name} is not supported by {node.address}")
+                return False
+            gen1 = self.isGen1(node.address)
+
+            def send()->bool:
+                if (client.setGen1Component(component, params) if gen1 else client.setComponent(component, params)) == None:
+                    return False
+                #Gen1 devices multicast their new status
+                current = level
+                if current == None and not gen1:
+                    current = statusToLevel(client.getStatus(), component)
+                if current != None:
+                    node.setDriver('ST', current, force=True)
+                return True
+
+            return self.commands.submit(node.address, send)
+        except Exception as ex:
+            LOGGER.error(str(ex))
+            return False
+
+    ###
+    # Called by the scene commands of the controller: sends the command to all the nodes of the scene
+    # at once. Returns True if every device acknowledged it
+    ###
+    def sceneCommand(self, scene:int, command_name:str, **kwargs)->bool:
+        try:
+            if not scene in self.sceneMembers:
+                LOGGER.error(f"scene {scene} has no nodes, add them to the scene_{scene} parameter ...")
+                return False
+            result = self.runScene(self.getSceneAddresses(scene), command_name, **kwargs)
+            if len(result.superseded) > 0:
+                LOGGER.info(f"scene {scene}: newer commands were sent to {', '.join(result.superseded)}")
+            return result.isAcked()
         except Exception as ex:
             LOGGER.error(str(ex))
             return False
 
+    #the addresses of the nodes of a scene, which lists them by address or by name
+    def getSceneAddresses(self, scene:int)->list:
+        addresses = []
+        for member in self.sceneMembers[scene]:
+            if not member in self.nodes:
+                for address, node in list(self.nodes.items()):
+                    if node.name != None and node.name.lower() == member.lower():
+                        member = address
+                        break
+            addresses.append(member)
+        return addresses
+
+    ###
+    # Sends the same command, e.g. 'On' with Level and RampRate, to the nodes at addresses in
+    # parallel and returns once they all acknowledged or failed. Gen2 devices have no groups
+    # of their own, so each device gets its command over its keep-alive client
+    ###
+    def runScene(self, addresses:list, command_name:str, **kwargs)->ShellySceneResult:
+        commands = {}
+        for address in addresses:
+            node = self.nodes[address] if address in self.nodes else None
+            if node == None:
+                LOGGER.error(f"{address} is not a shelly node ...")
+                commands[address] = lambda: False
+                continue
+            commands[address] = lambda node=node: self.sendCommand(node, command_name, **kwargs)
+        return self.scenes.dispatch(commands)
+
+    ###
+    # The parameters of Light.Set/Switch.Set for the command and the level the node
+    # will be at, None if it's not known until the device is read
+    ###
+    def getCommandParams(self, node, component:str, command_name:str, kwargs):
+        if component == 'switch':
+            if command_name in ('On', 'FastOn'):
+                return {'on': True}, 100
+            if command_name in ('Off', 'FastOff'):
+                return {'on': False}, 0
+            return None, None
+        if command_name == 'FastOn':
+            return {'on': True, 'brightness': 100}, 100
+        if command_name == 'FastOff':
+            return {'on': False}, 0
+        #drivers loaded from the database can be strings
+        ramp_rate = float(kwargs['RampRate'] if 'RampRate' in kwargs and kwargs['RampRate'] else node.getDriver('RAMP_RATE') or 0)
+        params = {'on': command_name == 'On'}
+        if ramp_rate > 0:
+            params['transition_duration'] = ramp_rate
+        if command_name == 'Off':
+            return params, 0
+        if command_name != 'On':
+            return None, None
+        level = int(float(kwargs['Level'] if 'Level' in kwargs and kwargs['Level'] else node.getDriver('ON_LEVEL') or 0))
+        if level <= 0:
+            #on at the brightness it had
+            return params, None
+        params['brightness'] = level
+        return params, level
+
     ####
     # MANDATORY if and only if you have commands
     # This method is called at start so that you can do whatever initialization
@@ -174,6 +280,11 @@ class ShellyProtocolHandler:
     ####
     def start(self)->bool:
         try:
+            if not self.hub.start():
+                LOGGER.warning('the websocket hub did not start, all devices are polled ...')
+            self.browser.start()
+            if not self.coiot.start():
+                LOGGER.warning('the CoIoT listener did not start, Gen1 devices are not updated ...')
             return True
         except Exception as ex:
             LOGGER.error(f'start failed .... ')
@@ -210,6 +321,15 @@ class ShellyProtocolHandler:
     ####
     def stop(self)->bool:
         try:
+            self.browser.stop()
+            self.coiot.stop()
+            self.hub.stop()
+            self.sweeper.stop()
+            self.scenes.stop()
+            self.rpc.close()
+            if self.saveTimer != None:
+                self.saveTimer.cancel()
+            self.registry.save(self.deviceMap)
             return True
         except Exception as ex:
             LOGGER.error(f'discover failed .... ')
@@ -222,6 +342,9 @@ class ShellyProtocolHandler:
     ####
     def discover(self)->bool:
         try:
+            #the browser runs all the time, this only makes it ask again now
+            if self.browser.refresh():
+                return True
             self.searchForDevicesUsingMDNS("http", None, "tcp")
             return True
         except Exception as ex:
@@ -238,11 +361,10 @@ class ShellyProtocolHandler:
     ####
     def nodeAdded(self, node):
         try:
-            ###You can store your nodes in a dictionary for mapping or otherwise such as
-            #if node == None:
-            #   return False
-            #self.nodes[node.address] = node
-            ###
+            if node == None:
+               return False
+            self.nodes[node.address] = node
+            self.connectDevice(node.address)
             return True
         except Exception as ex:
             LOGGER.error(str(ex))
@@ -253,11 +375,15 @@ class ShellyProtocolHandler:
     ####
     def nodeRemoved(self, node)->bool:
         try:
-            ###if you stored your nodes a dictionary, delete them 
-            #if node == None:
-            #   return False
-            #del self.nodes[node.address]
-            ###
+            if node == None:
+               return False
+            self.nodes.pop(node.address, None)
+            self.hub.remove(node.address)
+            self.commands.remove(node.address)
+            self.rpc.remove(node.address)
+            #so that discovery adds it again
+            self.registry.remove(node.address)
+            self.registry.save(self.deviceMap)
             return True
         except Exception as ex:
             LOGGER.error(str(ex))
@@ -329,16 +455,49 @@ class ShellyProtocolHandler:
     ####
     def shortPoll(self)->bool:
         try:
+            #devices with a websocket push their status. The others are read together
+            devices = {}
+            for address in list(self.nodes.keys()):
+                device = self.registry.get(address)
+                #devices that went away would only time out. Gen1 devices multicast their status
+                if device == None or device.ip == None or not device.online or device.isGen1():
+                    continue
+                if not self.hub.isConnected(address):
+                    devices[address] = (device.ip, device.port)
+            result = self.sweeper.sweep(devices)
+            if result == None:
+                for address in devices.keys():
+                    self.nodes[address].queryAll()
+                return False
+            self.lastSweep = result
+            self.applyStatuses(result.statuses)
             return True
         except Exception as ex:
             LOGGER.error(str(ex))
             return False
 
+    ###
+    # Updates the nodes from the statuses of a sweep in one pass. The statuses also
+    # serve the queries that come right after, see ShellyRpcClient.getStatus
+    ###
+    def applyStatuses(self, statuses:dict):
+        for address, status in statuses.items():
+            node = self.nodes[address] if address in self.nodes else None
+            if node == None:
+                continue
+            client = self.getClient(node)
+            if client != None:
+                client.setStatus(status)
+            level = statusToLevel(status, self.getComponent(node))
+            if level != None:
+                node.setDriver('ST', level)
+
     ####
     # This method is called at every long poll interval. The result is not checked
     ####
     def longPoll(self)->bool:
         try:
+            self.registry.save(self.deviceMap)
             return True
         except Exception as ex:
             LOGGER.error(str(ex))
@@ -351,6 +510,9 @@ class ShellyProtocolHandler:
     ####
     def processParams(self, params:Custom)->bool:
         try:
+            self.sceneMembers = parseSceneParams(params)
+            for scene, members in sorted(self.sceneMembers.items()):
+                LOGGER.info(f"scene {scene}: {', '.join(members)}")
             return True
         except Exception as ex:
             LOGGER.error(f'process param failed .... ')
@@ -389,8 +551,11 @@ class ShellyProtocolHandler:
     #michel
     def customParamHandler(self, key, value):
         try:
-            if key == 'dev_map':
-                self.deviceMap=value
+            #the registry is loaded once, what comes after is what it saved
+            if key == 'dev_map' and not self.registry.loaded:
+                LOGGER.info(f'loaded {self.registry.load(value)} devices ...')
+                for address in list(self.nodes.keys()):
+                    self.connectDevice(address)
             return True
         except Exception as ex:
             LOGGER.error(f'process custom param failed .... ')
@@ -481,42 +646,71 @@ class ShellyProtocolHandler:
                         continue
                 except:
                     continue
+                dev_type, mac = parseServiceName(result['fqdn'])
+                if dev_type == None:
+                    continue
                 ip:str=None
-                dev_type:str=None
-                dev_address:str=None
-                fqdn:str = result['fqdn']
-                if "shelly" in fqdn.lower():
-                    addresses = result['addresses']
-                    for address in addresses:
-                        try:
-                            if ipaddress.IPv4Address(address):
-                                ip=address
-                                break
-                        except ipaddress.AddressValueError:
-                            continue 
+                for address in result['addresses']:
                     try:
-                        dev_details=fqdn.split('-')
-                        if len(dev_details) < 2:
-                            continue
-                        dev_type=dev_details[0]
-                        dev_address=dev_details[1].split('.')[0].lower()
-                    except:
-                        continue
-                    dev_info = ShellyDeviceInfo()
-                    dev_info['dev_type']=dev_type
-                    dev_info['dev_address']= dev_address
-                    dev_info['nodedef_id']= ShellyTypeToNodeDef[dev_type]
-                    dev_info['ip']=ip
-                    dev_info['port']=result['port']
-                    dev_info['host']=result['host']
-                    if self.addNode(dev_address, dev_info['nodedef_id'], dev_type):
-                        curr=self.deviceMap[dev_address]
-                        if curr == None:
-                            self.deviceMap[dev_address]=json.dumps(dev_info)
-                        
-            # Fill out this method based on the results
+                        if ipaddress.IPv4Address(address):
+                            ip=address
+                            break
+                    except ipaddress.AddressValueError:
+                        continue 
+                self.deviceDiscovered(ShellyDevice(mac, dev_type, None, ip, result['port'], result['host'], mac))
+            #one write for all the devices found
+            self.registry.save(self.deviceMap)
             return
         except Exception as ex:
             LOGGER.error(str(ex))
 
-    
\ No newline at end of file
+    ###
+    # Adds the node of a device that's not known yet. For a known device, only its address
+    # is updated if it changed. Returns False if the device is not supported
+    ###
+    def deviceDiscovered(self, device:ShellyDevice)->bool:
+        if not device.dev_type in ShellyTypeToNodeDef:
+            LOGGER.debug(f"{device.dev_type} is not supported ...")
+            return False
+        device.nodedef_id = ShellyTypeToNodeDef[device.dev_type]
+        current = self.registry.getByMac(device.mac)
+        if current != None:
+            current.online = True
+            device.address = current.address
+            if self.registry.update(device):
+                LOGGER.info(f"{device.address} is now at {device.ip}")
+                self.connectDevice(device.address)
+                self.scheduleSave()
+            return True
+        if not self.addNode(device.address, device.nodedef_id, device.dev_type):
+            return False
+        self.registry.update(device)
+        self.connectDevice(device.address)
+        self.scheduleSave()
+        return True
+
+    ###
+    # Called by the browser when the mDNS service of a device goes away. The node stays and
+    # the websocket keeps trying, but the device is not polled until it's back
+    ###
+    def deviceLost(self, mac:str):
+        device = self.registry.getByMac(mac)
+        if device == None or not device.online:
+            return
+        LOGGER.info(f"{device.address} @ {device.ip} went away ...")
+        device.online = False
+
+    #devices found together are saved together
+    def scheduleSave(self):
+        if self.saveTimer != None and self.saveTimer.is_alive():
+            return
+        self.saveTimer = threading.Timer(SHELLY_REGISTRY_SAVE_DELAY, self.registry.save, args=[self.deviceMap])
+        self.saveTimer.daemon = True
+        self.saveTimer.start()
+
+    #connects the websocket of the node's device, or connects it again at its new address
+    def connectDevice(self, address:str):
+        device = self.registry.get(address)
+        if device == None or device.ip == None or not address in self.nodes or device.isGen1():
+            return
+        self.hub.add(address, device.ip, device.port)
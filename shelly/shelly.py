@@ -7,6 +7,7 @@ import udi_interface, os, sys, json, time,shutil
 import version
 from ioxplugin import Plugin
 from ShellyProtocolHandler import ShellyProtocolHandler
+from shelly_scene import addSceneCommands
 
 PLUGIN_FILE_NAME = 'shelly.iox_plugin.json'
 PLUGIN_FILE_NAME_DEST = f"{os.getcwd()}/{PLUGIN_FILE_NAME}"
@@ -38,6 +39,8 @@ if __name__ == '__main__':
         else:
             polyglot.Notices.clear()
             plugin = Plugin(PLUGIN_FILE_NAME)
+            #before the profile is generated so that IoX has the scene commands of the controller
+            addSceneCommands(plugin)
             plugin.toIoX()
             #plugin.generateCode(path='./')
             from ShellyControllerNode import ShellyControllerNode
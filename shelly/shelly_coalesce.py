@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+"""
+Drops commands to a Shelly device that newer ones made stale
+Copyright (C) 2024 Universal Devices
+"""
+import udi_interface
+LOGGER = udi_interface.LOGGER
+import threading
+
+#what submit returns for a command that a newer one replaced before it was sent
+SHELLY_COMMAND_SUPERSEDED='superseded'
+
+
+class ShellyCommand:
+    def __init__(self, send):
+        self.send = send
+        self.result = None
+        self.done = threading.Event()
+        self.turn = False
+
+
+class ShellyCommandCoalescer:
+    '''
+        Sends at most one command per device at a time. Commands that come
+        in while one is being sent wait, and only the latest of them is sent
+        next: the ones it replaced return SHELLY_COMMAND_SUPERSEDED right
+        away. A burst of level changes from a scene costs two requests
+        instead of one per change, and the device ends up at the last level.
+        Each command is sent by the thread that submitted it, in order.
+    '''
+    def __init__(self):
+        #address -> the command being sent and the one waiting for it
+        self.sending = {}
+        self.waiting = {}
+        self.superseded = 0
+        self._lock = threading.Lock()
+
+    #send() does the request and returns its result, which submit returns
+    def submit(self, address:str, send):
+        command = ShellyCommand(send)
+        with self._lock:
+            if address in self.sending:
+                previous = self.waiting.pop(address, None)
+                if previous != None:
+                    self.superseded += 1
+                    previous.result = SHELLY_COMMAND_SUPERSEDED
+                    previous.done.set()
+                self.waiting[address] = command
+            else:
+                self.sending[address] = command
+                command.turn = True
+        if not command.turn:
+            command.done.wait()
+            if not command.turn:
+                LOGGER.debug(f"dropped a command to {address}, a newer one replaced it")
+                return command.result
+        try:
+            command.result = command.send()
+        finally:
+            self.next(address)
+        return command.result
+
+    #lets the command waiting for the device go
+    def next(self, address:str):
+        with self._lock:
+            command = self.waiting.pop(address, None)
+            if command == None:
+                self.sending.pop(address, None)
+                return
+            self.sending[address] = command
+            command.turn = True
+            command.done.set()
+
+    def remove(self, address:str):
+        with self._lock:
+            command = self.waiting.pop(address, None)
+            if command != None:
+                command.result = SHELLY_COMMAND_SUPERSEDED
+                command.done.set()
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+"""
+Status multicast by Shelly Gen1 devices over CoIoT (CoAP over UDP)
+Copyright (C) 2024 Universal Devices
+"""
+import udi_interface
+LOGGER = udi_interface.LOGGER
+import json, socket, struct, threading
+
+SHELLY_COIOT_GROUP='224.0.1.187'
+SHELLY_COIOT_PORT=5683
+#the non standard CoAP code of the status packets sent to /cit/s
+SHELLY_COIOT_STATUS_CODE=30
+#CoAP options of CoIoT: the device (type#mac#version), the seconds the status is valid, and its serial
+SHELLY_COIOT_OPTION_DEVICE=3332
+SHELLY_COIOT_OPTION_VALIDITY=3412
+SHELLY_COIOT_OPTION_SERIAL=3420
+#the sensors of channel n in CoIoT v2 are these plus 100 * n
+SHELLY_COIOT_OUTPUT=1101
+SHELLY_COIOT_BRIGHTNESS=5101
+#seconds the socket waits for a packet before checking whether it should stop
+SHELLY_COIOT_POLL_INTERVAL=1
+
+
+#the code, the options as {number: [bytes]}, and the payload of a CoAP message. Raises if it's malformed
+def decodeCoap(data:bytes):
+    if len(data) < 4 or data[0] >> 6 != 1:
+        raise ValueError('not a CoAP message')
+    token_length = data[0] & 0x0f
+    code = data[1]
+    position = 4 + token_length
+    options = {}
+    number = 0
+    while position < len(data):
+        if data[position] == 0xff:
+            return code, options, data[position + 1:]
+        delta = data[position] >> 4
+        length = data[position] & 0x0f
+        position += 1
+        #extended deltas and lengths follow the byte that has both
+        extended = []
+        for value in (delta, length):
+            if value == 13:
+                value = data[position] + 13
+                position += 1
+            elif value == 14:
+                value = struct.unpack('>H', data[position:position + 2])[0] + 269
+                position += 2
+            elif value == 15:
+                raise ValueError('bad CoAP option')
+            extended.append(value)
+        number += extended[0]
+        if position + extended[1] > len(data):
+            raise ValueError('truncated CoAP option')
+        options.setdefault(number, []).append(data[position:position + extended[1]])
+        position += extended[1]
+    return code, options, b''
+
+
+class ShellyCoiotStatus:
+    '''
+        One status packet: the type and the MAC of the device that sent it,
+        its serial, which changes when the status does, and the values of its
+        sensors keyed by sensor id.
+    '''
+    def __init__(self, dev_type:str, mac:str, serial:int, validity:int, values:dict):
+        self.dev_type = dev_type
+        self.mac = mac
+        self.serial = serial
+        self.validity = validity
+        self.values = values
+
+    #the status in the shape of Shelly.GetStatus of Gen2 devices, e.g. {'light:0': {'output': True, 'brightness': 40}}
+    def toStatus(self, component:str)->dict:
+        status = {}
+        for sensor, value in self.values.items():
+            channel = (sensor % 1000) // 100 - 1
+            if sensor - 100 * channel == SHELLY_COIOT_OUTPUT:
+                status.setdefault(f"{component}:{channel}", {'id': channel})['output'] = bool(value)
+            elif sensor - 100 * channel == SHELLY_COIOT_BRIGHTNESS:
+                status.setdefault(f"{component}:{channel}", {'id': channel})['brightness'] = value
+        return status
+
+    #None if the packet is not a CoIoT v2 status
+    @staticmethod
+    def fromPacket(data:bytes):
+        code, options, payload = decodeCoap(data)
+        if code != SHELLY_COIOT_STATUS_CODE or not SHELLY_COIOT_OPTION_DEVICE in options:
+            return None
+        device = options[SHELLY_COIOT_OPTION_DEVICE][0].decode().split('#')
+        if len(device) < 3:
+            return None
+        if device[2] != '2':
+            LOGGER.debug(f"CoIoT v{device[2]} of {device[1]} is not supported, its firmware needs to be updated")
+            return None
+        serial = int.from_bytes(options[SHELLY_COIOT_OPTION_SERIAL][0], 'big') if SHELLY_COIOT_OPTION_SERIAL in options else None
+        validity = int.from_bytes(options[SHELLY_COIOT_OPTION_VALIDITY][0], 'big') if SHELLY_COIOT_OPTION_VALIDITY in options else None
+        values = {}
+        for value in json.loads(payload)['G']:
+            values[value[1]] = value[2]
+        return ShellyCoiotStatus(device[0], device[1].lower(), serial, validity, values)
+
+
+class ShellyCoiotListener:
+    '''
+        Joins the CoIoT multicast group and passes the status packets of Gen1
+        devices to onStatus(ShellyCoiotStatus, ip) from its own thread. The
+        devices send their status when it changes and then periodically, so
+        packets whose serial was already taken are dropped.
+    '''
+    def __init__(self, onStatus, group:str=SHELLY_COIOT_GROUP, port:int=SHELLY_COIOT_PORT):
+        self.onStatus = onStatus
+        self.group = group
+        self.port = port
+        #mac -> serial of the last status taken
+        self.serials = {}
+        self._socket:socket.socket = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    def isRunning(self)->bool:
+        return self._thread != None and self._thread.is_alive()
+
+    def start(self)->bool:
+        if self.isRunning():
+            return True
+        try:
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+            self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if hasattr(socket, 'SO_REUSEPORT'):
+                self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            self._socket.bind(('', self.port))
+            membership = struct.pack('4s4s', socket.inet_aton(self.group), socket.inet_aton('0.0.0.0'))
+            self._socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+            self._socket.settimeout(SHELLY_COIOT_POLL_INTERVAL)
+        except Exception as ex:
+            LOGGER.error(f"failed listening to CoIoT on {self.group}:{self.port}: {str(ex)}")
+            self.close()
+            return False
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name='ShellyCoiotListener', daemon=True)
+        self._thread.start()
+        return True
+
+    def stop(self):
+        self._stop.set()
+        if self._thread != None:
+            self._thread.join(SHELLY_COIOT_POLL_INTERVAL * 2)
+        self._thread = None
+        self.close()
+
+    def close(self):
+        try:
+            if self._socket != None:
+                self._socket.close()
+        except Exception as ex:
+            pass
+        self._socket = None
+
+    def run(self):
+        while not self._stop.is_set():
+            try:
+                data, sender = self._socket.recvfrom(2048)
+            except socket.timeout:
+                continue
+            except Exception as ex:
+                if not self._stop.is_set():
+                    LOGGER.error(f"CoIoT listener failed: {str(ex)}")
+                return
+            self.process(data, sender[0])
+
+    #returns True if the status was taken
+    def process(self, data:bytes, ip:str)->bool:
+        try:
+            status = ShellyCoiotStatus.fromPacket(data)
+        except Exception as ex:
+            LOGGER.debug(f"ignoring CoIoT packet from {ip}: {str(ex)}")
+            return False
+        if status == None:
+            return False
+        if status.serial != None and self.serials.get(status.mac) == status.serial:
+            return False
+        try:
+            #a status that could not be used is taken again when it's repeated
+            if not self.onStatus(status, ip):
+                return False
+        except Exception as ex:
+            LOGGER.error(str(ex))
+            return False
+        self.serials[status.mac] = status.serial
+        return True
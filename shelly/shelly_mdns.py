@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+"""
+Continuous mDNS browsing for Shelly devices
+Copyright (C) 2024 Universal Devices
+"""
+import udi_interface
+LOGGER = udi_interface.LOGGER
+import threading
+from zeroconf import Zeroconf, ServiceBrowser, ServiceListener, IPVersion
+from shelly_registry import ShellyDevice, parseServiceName
+
+#Gen2 devices announce _shelly, all of them announce _http
+SHELLY_MDNS_TYPES=['_shelly._tcp.local.', '_http._tcp.local.']
+#milliseconds to wait for the address of a service that was announced
+SHELLY_MDNS_INFO_TIMEOUT=3000
+
+
+class ShellyBrowser(ServiceListener):
+    '''
+        Browses for Shelly services for as long as the plugin runs. Services
+        that are announced or updated, for instance when DHCP gives a device
+        a new IP, are passed to onDevice(ShellyDevice) and services that go
+        away to onRemoved(mac). A device is announced under several types, so
+        onDevice gets the same device more than once. All the callbacks come
+        from the one thread of the browser.
+    '''
+    def __init__(self, onDevice, onRemoved=None, types=SHELLY_MDNS_TYPES):
+        self.onDevice = onDevice
+        self.onRemoved = onRemoved
+        self.types = types
+        self.zeroconf:Zeroconf = None
+        self.browser:ServiceBrowser = None
+        self._lock = threading.Lock()
+
+    def isRunning(self)->bool:
+        return self.browser != None
+
+    def start(self)->bool:
+        with self._lock:
+            try:
+                if self.zeroconf == None:
+                    self.zeroconf = Zeroconf()
+                if self.browser == None:
+                    self.browser = ServiceBrowser(self.zeroconf, self.types, self)
+                return True
+            except Exception as ex:
+                LOGGER.error(f"failed browsing for shelly devices: {str(ex)}")
+                return False
+
+    #asks the network again right away instead of waiting for the next query of the browser
+    def refresh(self)->bool:
+        with self._lock:
+            if self.browser != None:
+                self.browser.cancel()
+                self.browser = None
+        return self.start()
+
+    def stop(self):
+        with self._lock:
+            try:
+                if self.browser != None:
+                    self.browser.cancel()
+                if self.zeroconf != None:
+                    self.zeroconf.close()
+            except Exception as ex:
+                LOGGER.error(f"failed stopping the shelly browser: {str(ex)}")
+            self.browser = None
+            self.zeroconf = None
+
+    def add_service(self, zc:Zeroconf, type_:str, name:str):
+        self.resolve(zc, type_, name)
+
+    def update_service(self, zc:Zeroconf, type_:str, name:str):
+        self.resolve(zc, type_, name)
+
+    def remove_service(self, zc:Zeroconf, type_:str, name:str):
+        dev_type, mac = parseServiceName(name)
+        if dev_type == None or self.onRemoved == None:
+            return
+        try:
+            self.onRemoved(mac)
+        except Exception as ex:
+            LOGGER.error(str(ex))
+
+    def resolve(self, zc:Zeroconf, type_:str, name:str):
+        dev_type, mac = parseServiceName(name)
+        if dev_type == None:
+            return
+        try:
+            info = zc.get_service_info(type_, name, timeout=SHELLY_MDNS_INFO_TIMEOUT)
+            if info == None:
+                return
+            addresses = info.parsed_addresses(IPVersion.V4Only)
+            if len(addresses) == 0:
+                return
+            self.onDevice(ShellyDevice(mac, dev_type, None, addresses[0], info.port, info.server, mac))
+        except Exception as ex:
+            LOGGER.error(f"failed resolving {name}: {str(ex)}")
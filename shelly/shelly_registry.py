@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+"""
+Shelly devices indexed by node address, MAC, and IP
+Copyright (C) 2024 Universal Devices
+"""
+import udi_interface
+LOGGER = udi_interface.LOGGER
+import json, threading
+
+#seconds changes wait for more before the registry is saved, see ShellyDeviceRegistry.save
+SHELLY_REGISTRY_SAVE_DELAY=5
+
+ShellyTypeToNodeDef={
+    'ShellyPlusWDUS':'sdimmer',
+    'shelly1pmminig3':'sswitch',
+    #Gen1 devices, as they name themselves in CoIoT
+    'SHSW-1':'sswitch',
+    'SHSW-PM':'sswitch',
+    'SHPLG-S':'sswitch',
+    'SHPLG-US':'sswitch',
+    'SHDM-1':'sdimmer',
+    'SHDM-2':'sdimmer'
+}
+#Gen1 devices have no RPC: they multicast their status over CoIoT and take commands over plain HTTP
+SHELLY_GEN1_TYPES=('SHSW-1', 'SHSW-PM', 'SHPLG-S', 'SHPLG-US', 'SHDM-1', 'SHDM-2')
+
+
+#the type and the MAC of a device from its mDNS name such as ShellyPlusWDUS-A0DD6C9E1234.local.
+#Returns None, None if it's not the name of a Shelly
+def parseServiceName(name:str):
+    if name == None or not 'shelly' in name.lower():
+        return None, None
+    details = name.split('-')
+    if len(details) < 2:
+        return None, None
+    return details[0], details[-1].split('.')[0].lower()
+
+
+class ShellyDevice:
+    '''
+        Type, node definition, and endpoint of a Shelly device. The address
+        of its node is the MAC of the device. online is False while mDNS
+        says the device went away and is not saved.
+    '''
+    def __init__(self, address:str, dev_type:str=None, nodedef_id:str=None, ip:str=None, port:int=80, host:str=None, mac:str=None):
+        self.address = address
+        self.dev_type = dev_type
+        self.nodedef_id = nodedef_id
+        self.ip = ip
+        self.port = port if port else 80
+        self.host = host
+        self.mac = mac if mac else address
+        self.online = True
+
+    #also takes the JSON strings that dev_map used to hold
+    @staticmethod
+    def fromDict(data):
+        if isinstance(data, str):
+            data = json.loads(data)
+        return ShellyDevice(data['dev_address'], data.get('dev_type'), data.get('nodedef_id'), data.get('ip'),
+            data.get('port'), data.get('host'), data.get('mac'))
+
+    def isGen1(self)->bool:
+        return self.dev_type in SHELLY_GEN1_TYPES
+
+    def toDict(self)->dict:
+        return {
+            'dev_address': self.address,
+            'dev_type': self.dev_type,
+            'nodedef_id': self.nodedef_id,
+            'ip': self.ip,
+            'port': self.port,
+            'host': self.host,
+            'mac': self.mac
+        }
+
+    def __eq__(self, other):
+        return isinstance(other, ShellyDevice) and self.toDict() == other.toDict()
+
+
+class ShellyDeviceRegistry:
+    '''
+        The devices of the plugin in memory, indexed by the address of their
+        node, their MAC, and their IP. It's loaded once from the dev_map
+        custom data. Changes only mark it dirty and save writes the whole map
+        in one go, so discovering many devices costs a single write.
+    '''
+    def __init__(self):
+        self.devices = {}
+        self.by_mac = {}
+        self.by_ip = {}
+        self.loaded = False
+        self.dirty = False
+        self._lock = threading.RLock()
+
+    #returns the number of devices loaded
+    def load(self, data)->int:
+        with self._lock:
+            self.loaded = True
+            if data == None:
+                return 0
+            for address, value in data.items():
+                try:
+                    self._index(ShellyDevice.fromDict(value))
+                except Exception as ex:
+                    LOGGER.error(f"ignoring device {address}: {str(ex)}")
+            return len(self.devices)
+
+    def get(self, address:str)->ShellyDevice:
+        return self.devices[address] if address in self.devices else None
+
+    def getByMac(self, mac:str)->ShellyDevice:
+        mac = mac.lower() if mac else mac
+        return self.by_mac[mac] if mac in self.by_mac else None
+
+    def getByIp(self, ip:str)->ShellyDevice:
+        return self.by_ip[ip] if ip in self.by_ip else None
+
+    #adds the device or replaces the one at its address. Returns False if nothing changed
+    def update(self, device:ShellyDevice)->bool:
+        with self._lock:
+            current = self.get(device.address)
+            if current == device:
+                return False
+            if current != None:
+                self._unindex(current)
+            self._index(device)
+            self.dirty = True
+            return True
+
+    def remove(self, address:str)->bool:
+        with self._lock:
+            device = self.get(address)
+            if device == None:
+                return False
+            self._unindex(device)
+            self.dirty = True
+            return True
+
+    def _index(self, device:ShellyDevice):
+        self.devices[device.address] = device
+        if device.mac:
+            self.by_mac[device.mac.lower()] = device
+        if device.ip:
+            #a DHCP lease given to another device
+            previous = self.by_ip[device.ip] if device.ip in self.by_ip else None
+            if previous != None and previous.address != device.address:
+                previous.ip = None
+            self.by_ip[device.ip] = device
+
+    def _unindex(self, device:ShellyDevice):
+        self.devices.pop(device.address, None)
+        if device.mac and self.by_mac.get(device.mac.lower()) is device:
+            del self.by_mac[device.mac.lower()]
+        if device.ip and self.by_ip.get(device.ip) is device:
+            del self.by_ip[device.ip]
+
+    def toDict(self)->dict:
+        with self._lock:
+            return {address: device.toDict() for address, device in self.devices.items()}
+
+    #writes all the devices to the custom data in one go if anything changed
+    def save(self, custom)->bool:
+        with self._lock:
+            if not self.dirty or custom == None:
+                return True
+            try:
+                custom.load(self.toDict(), True)
+                self.dirty = False
+                return True
+            except Exception as ex:
+                LOGGER.error(f"failed saving the shelly devices: {str(ex)}")
+                return False
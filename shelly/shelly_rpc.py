@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+
+"""
+Shelly Gen2 JSON-RPC over HTTP with a keep-alive session per device
+Copyright (C) 2024 Universal Devices
+"""
+import udi_interface
+LOGGER = udi_interface.LOGGER
+import threading, time
+import requests
+from requests.adapters import HTTPAdapter
+
+#seconds to wait for a device to connect and to respond
+SHELLY_RPC_TIMEOUT=5
+#requests in flight to one device at a time. Gen2 devices only serve a few connections
+SHELLY_MAX_CONCURRENCY=2
+#seconds a Shelly.GetStatus response serves the queries of all the properties of a node
+SHELLY_STATUS_MAX_AGE=1
+#the component a node definition controls, see statusToLevel
+SHELLY_NODEDEF_COMPONENTS={
+    'sdimmer': 'light',
+    'sswitch': 'switch'
+}
+SHELLY_COMPONENT_METHODS={
+    'light': 'Light.Set',
+    'switch': 'Switch.Set'
+}
+#the HTTP endpoints of Gen1 devices for the same components
+SHELLY_GEN1_COMPONENT_PATHS={
+    'light': 'light',
+    'switch': 'relay'
+}
+
+
+#the status (0-100) of a component from the response of Shelly.GetStatus. None if it's not there
+def statusToLevel(status:dict, component:str, component_id:int=0):
+    key = f"{component}:{component_id}"
+    if status == None or not key in status:
+        return None
+    state = status[key]
+    if not 'output' in state:
+        return None
+    if not state['output']:
+        return 0
+    if 'brightness' in state:
+        return int(round(state['brightness']))
+    return 100
+
+
+class ShellyRpcClient:
+    '''
+        JSON-RPC client of one Gen2 device. Requests go through one
+        requests.Session so the TCP connection is kept alive between calls,
+        and at most max_concurrency of them are in flight at a time. All the
+        components of the device are read with a single Shelly.GetStatus
+        whose response is kept for SHELLY_STATUS_MAX_AGE seconds, so querying
+        every property of a node costs one request.
+    '''
+    def __init__(self, ip:str, port:int=80, max_concurrency:int=SHELLY_MAX_CONCURRENCY, timeout:float=SHELLY_RPC_TIMEOUT):
+        self.ip = ip
+        self.port = port if port else 80
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self.session:requests.Session = None
+        self.status = None
+        self.status_time = 0
+        self._id = 0
+        self._id_lock = threading.Lock()
+        self._status_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self.open()
+
+    def open(self):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_concurrency, max_retries=0)
+        self.session.mount('http://', adapter)
+
+    def close(self):
+        try:
+            if self.session != None:
+                self.session.close()
+        except Exception as ex:
+            pass
+
+    #the device got a new address: connections to the old one are of no use
+    def setAddress(self, ip:str, port:int=80):
+        port = port if port else 80
+        if ip == self.ip and port == self.port:
+            return
+        self.close()
+        self.ip = ip
+        self.port = port
+        self.invalidate()
+        self.open()
+
+    def getUrl(self)->str:
+        return f"http://{self.ip}:{self.port}/rpc"
+
+    def nextId(self)->int:
+        with self._id_lock:
+            self._id += 1
+            return self._id
+
+    #returns the result of the call or None if it failed
+    def call(self, method:str, params:dict=None):
+        request = {'id': self.nextId(), 'method': method}
+        if params != None:
+            request['params'] = params
+        try:
+            with self._slots:
+                response = self.session.post(self.getUrl(), json=request, timeout=self.timeout)
+            response.raise_for_status()
+            reply = response.json()
+            if 'error' in reply:
+                LOGGER.error(f"{method} @ {self.ip} failed: {reply['error']}")
+                return None
+            return reply['result'] if 'result' in reply else {}
+        except Exception as ex:
+            LOGGER.error(f"{method} @ {self.ip} failed: {str(ex)}")
+            return None
+
+    #the status of all components. Callers at the same time share one request
+    def getStatus(self, max_age:float=SHELLY_STATUS_MAX_AGE):
+        with self._status_lock:
+            if self.status != None and time.monotonic() - self.status_time < max_age:
+                return self.status
+            status = self.call('Shelly.GetStatus')
+            if status != None:
+                self.setStatus(status)
+            return status
+
+    def setStatus(self, status:dict):
+        self.status = status
+        self.status_time = time.monotonic()
+
+    #applies a status pushed by the device: the whole status or only the components that changed
+    def mergeStatus(self, status:dict, full:bool=False):
+        with self._status_lock:
+            if full or self.status == None:
+                self.status = {}
+            for component, state in status.items():
+                if not isinstance(state, dict):
+                    continue
+                if not component in self.status:
+                    self.status[component] = {}
+                self.status[component].update(state)
+            self.status_time = time.monotonic()
+
+    #the next getStatus reads the device, for instance after a command changed it
+    def invalidate(self):
+        self.status_time = 0
+
+    def setComponent(self, component:str, params:dict, component_id:int=0):
+        if not component in SHELLY_COMPONENT_METHODS:
+            LOGGER.error(f"{component} cannot be set ...")
+            return None
+        result = self.call(SHELLY_COMPONENT_METHODS[component], dict(params, id=component_id))
+        if result != None:
+            self.invalidate()
+        return result
+
+    #setComponent for Gen1 devices: the same parameters sent as /light/0?turn=on&brightness=50&transition=2000
+    def setGen1Component(self, component:str, params:dict, component_id:int=0):
+        if not component in SHELLY_GEN1_COMPONENT_PATHS:
+            LOGGER.error(f"{component} cannot be set ...")
+            return None
+        query = {'turn': 'on' if params['on'] else 'off'}
+        if 'brightness' in params:
+            query['brightness'] = params['brightness']
+        if 'transition_duration' in params:
+            query['transition'] = int(params['transition_duration'] * 1000)
+        try:
+            with self._slots:
+                response = self.session.get(f"http://{self.ip}:{self.port}/{SHELLY_GEN1_COMPONENT_PATHS[component]}/{component_id}", params=query, timeout=self.timeout)
+            response.raise_for_status()
+            return response.json()
+        except Exception as ex:
+            LOGGER.error(f"{component} @ {self.ip} failed: {str(ex)}")
+            return None
+
+
+class ShellyRpcPool:
+    '''
+        A client per device keyed by the address of its node.
+    '''
+    def __init__(self, max_concurrency:int=SHELLY_MAX_CONCURRENCY, timeout:float=SHELLY_RPC_TIMEOUT):
+        self.clients = {}
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self._lock = threading.Lock()
+
+    def getClient(self, address:str, ip:str, port:int=80)->ShellyRpcClient:
+        with self._lock:
+            if not address in self.clients:
+                self.clients[address] = ShellyRpcClient(ip, port, self.max_concurrency, self.timeout)
+            else:
+                self.clients[address].setAddress(ip, port)
+            return self.clients[address]
+
+    def remove(self, address:str):
+        with self._lock:
+            if address in self.clients:
+                self.clients.pop(address).close()
+
+    def close(self):
+        with self._lock:
+            for client in self.clients.values():
+                client.close()
+            self.clients = {}
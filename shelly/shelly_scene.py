@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+"""
+Sends one command to many Shelly devices at once
+Copyright (C) 2024 Universal Devices
+"""
+import udi_interface
+LOGGER = udi_interface.LOGGER
+import threading, time
+from concurrent.futures import ThreadPoolExecutor, wait
+from ioxplugin.commands import CommandDetails
+from shelly_coalesce import SHELLY_COMMAND_SUPERSEDED
+
+#devices sent a command at the same time
+SHELLY_SCENE_CONCURRENCY=32
+#devices slower than this many milliseconds are named in the log
+SHELLY_SCENE_SLOW_MS=1000
+SHELLY_SCENE_LOG_SLOW=5
+#scenes are custom parameters scene_1 to scene_16 with the nodes of each, by address or name, separated by commas
+SHELLY_SCENE_PARAM_PREFIX='scene_'
+SHELLY_SCENE_MAX=16
+SHELLY_SCENE_EDITOR={'id': 'shelly_scene', 'min': 1, 'max': SHELLY_SCENE_MAX, 'uom': 'Raw Value | 56', 'precision': 0}
+#commands of the controller that IoX programs and scenes use to control all the nodes of a scene at once
+SHELLY_SCENE_COMMANDS=[
+    {'id': 'scene_on', 'name': 'Scene On', 'params': [
+        {'id': 'scene', 'name': 'Scene', 'editor': {'idref': SHELLY_SCENE_EDITOR['id']}},
+        {'id': 'onlevel', 'name': 'Level', 'editor': {'idref': 'onlevel'}},
+        {'id': 'ramprate', 'name': 'Ramp Rate', 'editor': {'idref': 'ramprate'}}]},
+    {'id': 'scene_off', 'name': 'Scene Off', 'params': [
+        {'id': 'scene', 'name': 'Scene', 'editor': {'idref': SHELLY_SCENE_EDITOR['id']}},
+        {'id': 'ramprate', 'name': 'Ramp Rate', 'editor': {'idref': 'ramprate'}}]}
+]
+
+
+#adds the scene commands to the controller node definition of the plugin so that
+#the profile sent to IoX has them. Call it before plugin.toIoX()
+def addSceneCommands(plugin)->bool:
+    try:
+        controller = plugin.nodedefs.getControllerNodeDef() if plugin.nodedefs != None else None
+        if controller == None:
+            LOGGER.error('the plugin has no controller node definition for the scenes ...')
+            return False
+        if not SHELLY_SCENE_EDITOR['id'] in plugin.editors.editors:
+            plugin.editors.addEditor(SHELLY_SCENE_EDITOR)
+        for command in SHELLY_SCENE_COMMANDS:
+            if not command['id'] in controller.commands.acceptCommands:
+                controller.commands.acceptCommands[command['id']] = CommandDetails(command)
+        return True
+    except Exception as ex:
+        LOGGER.error(f"adding the scenes to the controller failed: {str(ex)}")
+        return False
+
+#{scene number: [address or name of each node]} from the custom parameters
+def parseSceneParams(params)->dict:
+    scenes = {}
+    for key, value in params.items():
+        if not key.lower().startswith(SHELLY_SCENE_PARAM_PREFIX) or value == None:
+            continue
+        try:
+            scene = int(key[len(SHELLY_SCENE_PARAM_PREFIX):])
+        except ValueError:
+            LOGGER.error(f"{key} is not a scene, use {SHELLY_SCENE_PARAM_PREFIX}1 to {SHELLY_SCENE_PARAM_PREFIX}{SHELLY_SCENE_MAX} ...")
+            continue
+        if scene < 1 or scene > SHELLY_SCENE_MAX:
+            LOGGER.error(f"{key} is not a scene, use {SHELLY_SCENE_PARAM_PREFIX}1 to {SHELLY_SCENE_PARAM_PREFIX}{SHELLY_SCENE_MAX} ...")
+            continue
+        scenes[scene] = [member.strip() for member in str(value).split(',') if member.strip()]
+    return scenes
+
+
+class ShellySceneResult:
+    '''
+        What one scene got: the devices that acknowledged the command, the
+        ones that did not, how long each took, and how long the scene took.
+        Devices whose command was dropped for a newer one, e.g. from the next
+        scene, are superseded: they end up where that command takes them.
+    '''
+    def __init__(self):
+        self.acked = []
+        self.failed = []
+        self.superseded = []
+        self.latencies_ms = {}
+        self.duration_ms = 0
+
+    #whether every device acknowledged the command of the scene
+    def isAcked(self)->bool:
+        return len(self.failed) == 0 and len(self.superseded) == 0
+
+    #the slowest devices first
+    def getSlowest(self, slow_ms:float=SHELLY_SCENE_SLOW_MS):
+        slow = [address for address, ms in self.latencies_ms.items() if ms >= slow_ms]
+        return sorted(slow, key=lambda address: self.latencies_ms[address], reverse=True)
+
+    def toDict(self)->dict:
+        return {
+            'acked': len(self.acked),
+            'failed': self.failed,
+            'superseded': self.superseded,
+            'duration_ms': round(self.duration_ms, 1),
+            'latencies_ms': {address: round(ms, 1) for address, ms in self.latencies_ms.items()}
+        }
+
+
+class ShellySceneDispatcher:
+    '''
+        Runs the command of each device of a scene on a pool of threads and
+        returns once every device answered or failed. The requests go through
+        the keep-alive client of each device, so a scene of N devices takes
+        about as long as its slowest device instead of the sum of all of them.
+    '''
+    def __init__(self, max_concurrency:int=SHELLY_SCENE_CONCURRENCY, slow_ms:float=SHELLY_SCENE_SLOW_MS):
+        self.max_concurrency = max_concurrency
+        self.slow_ms = slow_ms
+        self._executor:ThreadPoolExecutor = None
+        self._lock = threading.Lock()
+
+    def getExecutor(self)->ThreadPoolExecutor:
+        with self._lock:
+            if self._executor == None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix='ShellyScene')
+            return self._executor
+
+    def stop(self):
+        with self._lock:
+            if self._executor != None:
+                self._executor.shutdown(wait=False)
+            self._executor = None
+
+    #commands is {address: send} where send() returns True if the device acknowledged
+    #and SHELLY_COMMAND_SUPERSEDED if a newer command to the device was sent instead
+    def dispatch(self, commands:dict)->ShellySceneResult:
+        result = ShellySceneResult()
+        if len(commands) == 0:
+            return result
+        start = time.perf_counter()
+        executor = self.getExecutor()
+        wait([executor.submit(self._send, address, send, result) for address, send in commands.items()])
+        result.duration_ms = (time.perf_counter() - start) * 1000
+        slowest = result.getSlowest(self.slow_ms)
+        LOGGER.info(f"scene of {len(commands)} devices took {round(result.duration_ms)} ms, {len(result.failed)} failed, {len(result.superseded)} superseded")
+        if len(slowest) > 0:
+            LOGGER.warning("slowest: " + ', '.join([f"{address} {round(result.latencies_ms[address])} ms" for address in slowest[:SHELLY_SCENE_LOG_SLOW]]))
+        return result
+
+    def _send(self, address:str, send, result:ShellySceneResult):
+        start = time.perf_counter()
+        try:
+            acked = send()
+        except Exception as ex:
+            LOGGER.error(f"scene command to {address} failed: {str(ex)}")
+            acked = False
+        if acked == SHELLY_COMMAND_SUPERSEDED:
+            #it was only waiting for the device until it was dropped
+            result.superseded.append(address)
+            return
+        result.latencies_ms[address] = (time.perf_counter() - start) * 1000
+        (result.acked if acked else result.failed).append(address)
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+"""
+Simulated Shelly Gen2 devices for development: JSON-RPC over HTTP and
+WebSocket with NotifyStatus, one port per device
+Copyright (C) 2024 Universal Devices
+"""
+import asyncio, json, random, threading
+from aiohttp import web
+
+SHELLY_SIMULATOR_TYPES={'light': 'ShellyPlusWDUS', 'switch': 'shelly1pmminig3'}
+
+
+class ShellySimulatedDevice:
+    '''
+        One device with one light or switch component. Every request waits
+        latency_ms plus up to jitter_ms. Light.Set and Switch.Set change the
+        state and push NotifyStatus to the WebSockets that called the device.
+    '''
+    def __init__(self, index:int, kind:str='light', latency_ms:float=0, jitter_ms:float=0):
+        self.mac = f"a0dd6c{index:06x}"
+        self.kind = kind
+        self.component = f"{kind}:0"
+        self.state = {'id': 0, 'output': False, 'brightness': 50} if kind == 'light' else {'id': 0, 'output': False}
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.requests = 0
+        self.ip = None
+        self.port = None
+        self.peers = {}
+        self.runner = None
+        self.loop = None
+
+    def getStatus(self)->dict:
+        return {self.component: dict(self.state), 'sys': {'mac': self.mac.upper()}}
+
+    async def handle(self, request:dict):
+        self.requests += 1
+        delay = self.latency_ms + random.uniform(0, self.jitter_ms)
+        if delay > 0:
+            await asyncio.sleep(delay / 1000)
+        method = request['method'] if 'method' in request else None
+        params = request['params'] if 'params' in request else {}
+        reply = {'id': request['id'] if 'id' in request else None, 'src': f"{SHELLY_SIMULATOR_TYPES[self.kind].lower()}-{self.mac}"}
+        if method == 'Shelly.GetStatus':
+            reply['result'] = self.getStatus()
+        elif method == f"{self.kind.capitalize()}.Set":
+            was_on = self.state['output']
+            delta = {'output': bool(params['on'])} if 'on' in params else {}
+            if 'brightness' in params and self.kind == 'light':
+                delta['brightness'] = params['brightness']
+            self.state.update(delta)
+            reply['result'] = {'was_on': was_on}
+            await self.notify(delta)
+        else:
+            reply['error'] = {'code': 404, 'message': f"No handler for {method}"}
+        return reply
+
+    async def notify(self, delta:dict):
+        for src, ws in list(self.peers.items()):
+            try:
+                await ws.send_json({'src': self.mac, 'dst': src, 'method': 'NotifyStatus', 'params': {'ts': 0, self.component: delta}})
+            except Exception:
+                self.peers.pop(src, None)
+
+    async def post(self, request):
+        return web.json_response(await self.handle(await request.json()))
+
+    async def websocket(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        src = None
+        async for message in ws:
+            rpc = json.loads(message.data)
+            if 'src' in rpc:
+                src = rpc['src']
+                self.peers[src] = ws
+            await ws.send_json(await self.handle(rpc))
+        if src != None:
+            self.peers.pop(src, None)
+        return ws
+
+    async def start(self, host:str, port:int=0):
+        app = web.Application()
+        app.router.add_post('/rpc', self.post)
+        app.router.add_get('/rpc', self.websocket)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        self.ip, self.port = self.runner.addresses[0][:2]
+        self.loop = asyncio.get_running_loop()
+
+    #closes the port of a device started by startDevices, like a device that went off the network
+    def stop(self, timeout:float=5):
+        if self.runner != None:
+            asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result(timeout)
+        self.runner = None
+
+
+#the plugin expects one device per IP, like on a real network. On Linux the whole of 127.0.0.0/8 is
+#the loopback, so each device can have its own address there
+def loopbackAddress(index:int)->str:
+    return f"127.0.{1 + index // 250}.{1 + index % 250}"
+
+#starts count devices in their own thread and returns them once they all listen. With base_port 0, each gets
+#any free port. With host None, each gets its own loopback address
+def startDevices(count:int, host:str=None, base_port:int=0, kind:str='light', latency_ms:float=0, jitter_ms:float=0, slow:float=0, slow_ms:float=0):
+    devices = [ShellySimulatedDevice(index, kind, latency_ms + (slow_ms if random.random() < slow else 0), jitter_ms) for index in range(count)]
+    loop = asyncio.new_event_loop()
+    started = threading.Event()
+
+    async def run():
+        for index, device in enumerate(devices):
+            await device.start(host if host else loopbackAddress(index), base_port + index if base_port else 0)
+        started.set()
+
+    def serve():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(run())
+        loop.run_forever()
+
+    threading.Thread(target=serve, name='ShellySimulator', daemon=True).start()
+    if not started.wait(30):
+        raise Exception("shelly simulator did not start")
+    return devices
+
+#the content of the dev_map custom data for the devices
+def deviceMap(devices)->dict:
+    return {device.mac: {'dev_address': device.mac, 'dev_type': SHELLY_SIMULATOR_TYPES[device.kind], 'nodedef_id': 'sdimmer' if device.kind == 'light' else 'sswitch',
+        'ip': device.ip, 'port': device.port, 'host': f"{SHELLY_SIMULATOR_TYPES[device.kind]}-{device.mac}.local", 'mac': device.mac} for device in devices}
+
+
+if __name__ == '__main__':
+    import argparse, time
+    parser = argparse.ArgumentParser(description='Simulated Shelly Gen2 devices')
+    parser.add_argument('--host', default=None, help='address all the devices listen on. By default each device has its own loopback address')
+    parser.add_argument('--base-port', type=int, default=0, help='port of the first device, the others follow. 0 uses any free port')
+    parser.add_argument('--count', type=int, default=10)
+    parser.add_argument('--kind', choices=list(SHELLY_SIMULATOR_TYPES.keys()), default='light')
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--jitter-ms', type=float, default=0)
+    parser.add_argument('--slow', type=float, default=0, help='fraction of the devices that are slow')
+    parser.add_argument('--slow-ms', type=float, default=2000, help='extra latency of the slow devices')
+    args = parser.parse_args()
+    devices = startDevices(args.count, args.host, args.base_port, args.kind, args.latency_ms, args.jitter_ms, args.slow, args.slow_ms)
+    print(json.dumps(deviceMap(devices), indent=2))
+    while True:
+        time.sleep(60)
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+
+"""
+Reads the status of a fleet of Shelly devices concurrently
+Copyright (C) 2024 Universal Devices
+"""
+import udi_interface
+LOGGER = udi_interface.LOGGER
+import asyncio, threading, time
+import aiohttp
+from shelly_rpc import SHELLY_RPC_TIMEOUT, SHELLY_MAX_CONCURRENCY
+
+#devices read at the same time across the fleet
+SHELLY_SWEEP_CONCURRENCY=32
+#devices slower than this many milliseconds are reported as stragglers
+SHELLY_SWEEP_STRAGGLER_MS=1000
+#stragglers named in the log after each sweep
+SHELLY_SWEEP_LOG_STRAGGLERS=5
+
+
+class ShellySweepResult:
+    '''
+        What one sweep got: the status of each device that answered, the
+        devices that did not, how long each took, and the sweep duration.
+    '''
+    def __init__(self):
+        self.statuses = {}
+        self.failed = []
+        self.latencies_ms = {}
+        self.duration_ms = 0
+
+    #the slowest devices first, failed ones included
+    def getStragglers(self, straggler_ms:float=SHELLY_SWEEP_STRAGGLER_MS):
+        slow = [address for address, ms in self.latencies_ms.items() if ms >= straggler_ms or address in self.failed]
+        return sorted(slow, key=lambda address: self.latencies_ms[address], reverse=True)
+
+    def toDict(self)->dict:
+        return {
+            'devices': len(self.latencies_ms),
+            'failed': len(self.failed),
+            'duration_ms': round(self.duration_ms, 1),
+            'stragglers': {address: round(self.latencies_ms[address], 1) for address in self.getStragglers()}
+        }
+
+
+class ShellyFleetSweeper:
+    '''
+        Sends Shelly.GetStatus to many devices at once from one asyncio loop
+        in its own thread. A semaphore keeps at most max_concurrency requests
+        in flight across the fleet, and the connector keeps the connections
+        alive between sweeps with at most SHELLY_MAX_CONCURRENCY per device.
+        A sweep of N devices takes about N / max_concurrency round trips
+        instead of N.
+    '''
+    def __init__(self, max_concurrency:int=SHELLY_SWEEP_CONCURRENCY, timeout:float=SHELLY_RPC_TIMEOUT, straggler_ms:float=SHELLY_SWEEP_STRAGGLER_MS):
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.straggler_ms = straggler_ms
+        self._loop = None
+        self._session:aiohttp.ClientSession = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def isRunning(self)->bool:
+        return self._thread != None and self._thread.is_alive()
+
+    def start(self)->bool:
+        with self._lock:
+            if self.isRunning():
+                return True
+            started = threading.Event()
+            self._loop = asyncio.new_event_loop()
+
+            async def openSession():
+                connector = aiohttp.TCPConnector(limit=self.max_concurrency, limit_per_host=SHELLY_MAX_CONCURRENCY)
+                self._session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout))
+                started.set()
+
+            def run():
+                asyncio.set_event_loop(self._loop)
+                try:
+                    self._loop.run_until_complete(openSession())
+                    self._loop.run_forever()
+                except Exception as ex:
+                    LOGGER.error(f"shelly sweeper failed: {str(ex)}")
+                finally:
+                    started.set()
+                    self._loop.close()
+
+            self._thread = threading.Thread(target=run, name='ShellyFleetSweeper', daemon=True)
+            self._thread.start()
+            started.wait(self.timeout)
+            return self.isRunning()
+
+    def stop(self):
+        with self._lock:
+            if not self.isRunning():
+                return
+
+            async def close():
+                await self._session.close()
+                self._loop.stop()
+
+            try:
+                asyncio.run_coroutine_threadsafe(close(), self._loop)
+                self._thread.join(self.timeout)
+            except Exception as ex:
+                LOGGER.error(f"failed stopping the shelly sweeper: {str(ex)}")
+            self._thread = None
+
+    #devices is {address: (ip, port)}. Returns None if the sweep could not run
+    def sweep(self, devices:dict)->ShellySweepResult:
+        if len(devices) == 0:
+            return ShellySweepResult()
+        if not self.start():
+            return None
+        try:
+            #every request has its own timeout, the sweep is only waited on in case the loop is stuck
+            waves = len(devices) / self.max_concurrency + 1
+            result = asyncio.run_coroutine_threadsafe(self._sweep(devices), self._loop).result(self.timeout * waves)
+        except Exception as ex:
+            LOGGER.error(f"shelly sweep failed: {str(ex)}")
+            return None
+        stragglers = result.getStragglers(self.straggler_ms)
+        LOGGER.info(f"swept {len(devices)} devices in {round(result.duration_ms)} ms, {len(result.failed)} failed, {len(stragglers)} stragglers")
+        if len(stragglers) > 0:
+            LOGGER.warning("slowest: " + ', '.join([f"{address} {round(result.latencies_ms[address])} ms" for address in stragglers[:SHELLY_SWEEP_LOG_STRAGGLERS]]))
+        return result
+
+    async def _sweep(self, devices:dict)->ShellySweepResult:
+        result = ShellySweepResult()
+        slots = asyncio.Semaphore(self.max_concurrency)
+        start = time.perf_counter()
+        await asyncio.gather(*[self._getStatus(address, ip, port, slots, result) for address, (ip, port) in devices.items()])
+        result.duration_ms = (time.perf_counter() - start) * 1000
+        return result
+
+    async def _getStatus(self, address:str, ip:str, port:int, slots:asyncio.Semaphore, result:ShellySweepResult):
+        async with slots:
+            start = time.perf_counter()
+            try:
+                async with self._session.post(f"http://{ip}:{port if port else 80}/rpc", json={'id': 1, 'method': 'Shelly.GetStatus'}) as response:
+                    response.raise_for_status()
+                    reply = await response.json()
+                if 'error' in reply or not 'result' in reply:
+                    raise Exception(reply['error'] if 'error' in reply else 'no result')
+                result.statuses[address] = reply['result']
+            except Exception as ex:
+                LOGGER.debug(f"Shelly.GetStatus of {address} @ {ip} failed: {str(ex) or type(ex).__name__}")
+                result.failed.append(address)
+            result.latencies_ms[address] = (time.perf_counter() - start) * 1000
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+"""
+Status pushed by Shelly Gen2 devices over their RPC WebSocket
+Copyright (C) 2024 Universal Devices
+"""
+import udi_interface
+LOGGER = udi_interface.LOGGER
+import asyncio, json, random, threading, uuid
+import aiohttp
+
+#seconds between pings. A device that does not answer is reconnected
+SHELLY_WS_HEARTBEAT=30
+#backoff before reconnecting: a random delay up to min(max, min * 2^attempts)
+SHELLY_WS_BACKOFF_MIN=1
+SHELLY_WS_BACKOFF_MAX=60
+#seconds to wait for the hub to start or stop
+SHELLY_WS_START_TIMEOUT=5
+SHELLY_WS_NOTIFICATIONS=('NotifyStatus', 'NotifyFullStatus')
+
+
+#seconds to wait before reconnecting after attempts failures in a row. Jitter keeps
+#devices that went away together (a Wi-Fi outage) from all reconnecting at once
+def backoff(attempts:int)->float:
+    return random.uniform(0, min(SHELLY_WS_BACKOFF_MAX, SHELLY_WS_BACKOFF_MIN * pow(2, attempts)))
+
+
+class ShellyWebSocketHub:
+    '''
+        Keeps a WebSocket to the RPC endpoint of every device on one asyncio
+        loop in its own thread. A device only sends notifications to a peer
+        that called it, so each connection starts with Shelly.GetStatus whose
+        result is the full status. After that, the device pushes NotifyStatus
+        with what changed. onStatus(address, status, full) is called on the
+        loop of the hub for both. Devices that drop are reconnected with
+        jittered backoff.
+    '''
+    def __init__(self, onStatus):
+        self.onStatus = onStatus
+        #a peer name unique to this plugin, the devices address their notifications to it
+        self.src = f"iox-{uuid.uuid4().hex[:8]}"
+        #address -> (ip, port)
+        self.devices = {}
+        self.connected = set()
+        self._tasks = {}
+        self._loop = None
+        self._session:aiohttp.ClientSession = None
+        self._thread = None
+
+    def isRunning(self)->bool:
+        return self._thread != None and self._thread.is_alive()
+
+    def isConnected(self, address:str)->bool:
+        return address in self.connected
+
+    def start(self)->bool:
+        if self.isRunning():
+            return True
+        started = threading.Event()
+        self._loop = asyncio.new_event_loop()
+
+        async def openSession():
+            self._session = aiohttp.ClientSession()
+            for address in list(self.devices.keys()):
+                self._connect(address)
+            started.set()
+
+        def run():
+            asyncio.set_event_loop(self._loop)
+            try:
+                self._loop.run_until_complete(openSession())
+                self._loop.run_forever()
+            except Exception as ex:
+                LOGGER.error(f"shelly websocket hub failed: {str(ex)}")
+            finally:
+                started.set()
+                self._loop.close()
+
+        self._thread = threading.Thread(target=run, name='ShellyWebSocketHub', daemon=True)
+        self._thread.start()
+        started.wait(SHELLY_WS_START_TIMEOUT)
+        return self.isRunning()
+
+    def stop(self)->bool:
+        if not self.isRunning():
+            return True
+
+        async def close():
+            for task in list(self._tasks.values()):
+                task.cancel()
+            await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+            self._tasks = {}
+            await self._session.close()
+            self._loop.stop()
+
+        try:
+            asyncio.run_coroutine_threadsafe(close(), self._loop)
+            self._thread.join(SHELLY_WS_START_TIMEOUT)
+            return True
+        except Exception as ex:
+            LOGGER.error(f"failed stopping the shelly websocket hub: {str(ex)}")
+            return False
+        finally:
+            self._thread = None
+            self.connected = set()
+
+    #adds the device or reconnects it if its address changed
+    def add(self, address:str, ip:str, port:int=80):
+        device = (ip, port if port else 80)
+        if address in self.devices and self.devices[address] == device:
+            return
+        self.devices[address] = device
+        if self.isRunning():
+            self._loop.call_soon_threadsafe(self._connect, address)
+
+    def remove(self, address:str):
+        if not address in self.devices:
+            return
+        del self.devices[address]
+        if self.isRunning():
+            self._loop.call_soon_threadsafe(self._disconnect, address)
+
+    #runs on the loop of the hub
+    def _connect(self, address:str):
+        self._disconnect(address)
+        self._tasks[address] = self._loop.create_task(self._run(address))
+
+    def _disconnect(self, address:str):
+        if address in self._tasks:
+            self._tasks.pop(address).cancel()
+        self.connected.discard(address)
+
+    async def _run(self, address:str):
+        attempts = 0
+        while address in self.devices:
+            ip, port = self.devices[address]
+            try:
+                async with self._session.ws_connect(f"ws://{ip}:{port}/rpc", heartbeat=SHELLY_WS_HEARTBEAT) as ws:
+                    await ws.send_json({'id': 1, 'src': self.src, 'method': 'Shelly.GetStatus'})
+                    async for message in ws:
+                        if message.type != aiohttp.WSMsgType.TEXT:
+                            break
+                        if self._receive(address, json.loads(message.data)):
+                            attempts = 0
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                LOGGER.debug(f"websocket to {address} @ {ip}: {str(ex)}")
+            self.connected.discard(address)
+            delay = backoff(attempts)
+            attempts += 1
+            LOGGER.info(f"websocket to {address} @ {ip} closed, reconnecting in {round(delay, 1)} seconds ...")
+            await asyncio.sleep(delay)
+
+    #returns True if the message had a status
+    def _receive(self, address:str, message:dict)->bool:
+        try:
+            if 'result' in message and message['id'] == 1:
+                self.connected.add(address)
+                self.onStatus(address, message['result'], True)
+                return True
+            if 'method' in message and message['method'] in SHELLY_WS_NOTIFICATIONS and 'params' in message:
+                self.onStatus(address, message['params'], message['method'] == 'NotifyFullStatus')
+                return True
+            if 'error' in message:
+                LOGGER.error(f"websocket to {address} failed: {message['error']}")
+            return False
+        except Exception as ex:
+            LOGGER.error(f"failed processing status of {address}: {str(ex)}")
+            return False
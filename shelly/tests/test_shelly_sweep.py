@@ -0,0 +1,124 @@
+"""
+Sweeps of simulated Shelly devices, see shelly_simulator
+"""
+import pytest
+from shelly_simulator import startDevices, deviceMap
+from shelly_sweep import ShellyFleetSweeper
+from shelly_rpc import statusToLevel
+from ShellyProtocolHandler import ShellyProtocolHandler
+
+SLOW_MS = {4: 300, 5: 600}
+STRAGGLER_MS = 200
+
+
+class Node:
+    '''
+        Stands in for a node of the plugin: keeps its drivers and counts queryAll
+    '''
+    def __init__(self, handler, nodedef_id:str, address:str):
+        self.handler = handler
+        self.id = nodedef_id
+        self.address = address
+        self.drivers = {}
+        self.queries = 0
+
+    def setDriver(self, property_id, value, force=False, text=None):
+        self.drivers[property_id] = value
+
+    def getDriver(self, property_id):
+        return self.drivers[property_id] if property_id in self.drivers else None
+
+    def queryAll(self):
+        self.queries += 1
+
+
+@pytest.fixture(scope='module')
+def fleet():
+    devices = startDevices(7)
+    for index, device in enumerate(devices):
+        device.state.update({'output': index % 2 == 1, 'brightness': 10 * index})
+        if index in SLOW_MS:
+            device.latency_ms = SLOW_MS[index]
+    #the last one went off the network
+    devices[-1].stop()
+    return devices
+
+
+@pytest.fixture
+def sweeper():
+    sweeper = ShellyFleetSweeper(max_concurrency=4, timeout=2, straggler_ms=STRAGGLER_MS)
+    yield sweeper
+    sweeper.stop()
+
+
+@pytest.fixture
+def handler(fleet):
+    handler = ShellyProtocolHandler(None)
+    handler.sweeper = ShellyFleetSweeper(timeout=2, straggler_ms=STRAGGLER_MS)
+    handler.registry.load(deviceMap(fleet))
+    for address, device in deviceMap(fleet).items():
+        handler.nodes[address] = Node(handler, device['nodedef_id'], address)
+    yield handler
+    handler.stop()
+
+
+def addresses(fleet):
+    return {device.mac: (device.ip, device.port) for device in fleet}
+
+
+def test_sweep_gets_the_status_of_the_devices_that_answer(fleet, sweeper):
+    result = sweeper.sweep(addresses(fleet))
+    assert result != None
+    assert set(result.statuses.keys()) == {device.mac for device in fleet[:-1]}
+    for device in fleet[:-1]:
+        assert result.statuses[device.mac]['light:0'] == device.state
+    assert set(result.latencies_ms.keys()) == {device.mac for device in fleet}
+
+
+def test_sweep_fails_the_devices_that_do_not_answer(fleet, sweeper):
+    result = sweeper.sweep(addresses(fleet))
+    assert result.failed == [fleet[-1].mac]
+    assert not fleet[-1].mac in result.statuses
+
+
+def test_sweep_waits_for_the_slowest_device_only(fleet, sweeper):
+    result = sweeper.sweep(addresses(fleet))
+    assert result.duration_ms >= max(SLOW_MS.values())
+    assert result.duration_ms < sum(SLOW_MS.values())
+
+
+def test_stragglers_are_the_slow_and_failed_devices_slowest_first(fleet, sweeper):
+    result = sweeper.sweep(addresses(fleet))
+    assert result.getStragglers(STRAGGLER_MS) == [fleet[5].mac, fleet[4].mac, fleet[-1].mac]
+    assert result.latencies_ms[fleet[5].mac] >= SLOW_MS[5]
+    assert result.latencies_ms[fleet[4].mac] >= SLOW_MS[4]
+
+
+def test_sweep_of_no_devices_is_empty(sweeper):
+    result = sweeper.sweep({})
+    assert result.statuses == {} and result.failed == [] and result.duration_ms == 0
+    assert not sweeper.isRunning()
+
+
+def test_short_poll_sets_the_drivers_from_the_sweep(fleet, handler):
+    assert handler.shortPoll()
+    for device in fleet[:-1]:
+        node = handler.nodes[device.mac]
+        assert node.getDriver('ST') == statusToLevel({'light:0': device.state}, 'light')
+        assert node.queries == 0
+    assert handler.nodes[fleet[-1].mac].getDriver('ST') == None
+    assert handler.lastSweep.failed == [fleet[-1].mac]
+
+
+def test_short_poll_follows_a_change_of_state(fleet, handler):
+    fleet[0].state.update({'output': True, 'brightness': 42})
+    assert handler.shortPoll()
+    assert handler.nodes[fleet[0].mac].getDriver('ST') == 42
+
+
+def test_short_poll_queries_every_node_when_the_sweep_cannot_run(fleet, handler):
+    handler.sweeper.sweep = lambda devices: None
+    assert not handler.shortPoll()
+    for device in fleet:
+        assert handler.nodes[device.mac].queries == 1
+        assert handler.nodes[device.mac].getDriver('ST') == None